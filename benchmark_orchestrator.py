@@ -0,0 +1,366 @@
+"""Benchmarks of the orchestrator that can be run on any machine with Python.
+
+The real processors are replaced by stubs, small Python scripts that behave like
+them: they read and write the same directories, write NetCDF files of the
+requested size and print lines on stdout at the requested rate. The amount of
+data is controlled from the command line, e.g.
+
+    python benchmark_orchestrator.py -months 2 -days 5 -nc_size 4194304
+
+runs the whole pipeline (from L1A to all the Level-2 processors with the PAM),
+and then times separately the backup, the restore, the detection of the dates and
+the validation of the NetCDF files. The results are printed and, with -json,
+saved so that different versions of orchestrator.py can be compared.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+import typing
+
+import orchestrator
+from orchestrator import Conf, Proc
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Stubs ########################################################################
+
+class Volume(typing.TypedDict):
+    """How much data the stubs produce."""
+    months: int
+    days: int # For each month.
+    hours: int # Windows for each day, from 1 to 4.
+    nc_per_window: int
+    nc_size: int # In bytes.
+    stdout_lines: int # For each run of a processor.
+    stdout_rate: float # Lines per second, 0 means as fast as possible.
+    hydrognss: str
+
+VOLUME_DEFAULT: Volume = {
+    "months": 1,
+    "days": 2,
+    "hours": 4,
+    "nc_per_window": 2,
+    "nc_size": 1 << 20,
+    "stdout_lines": 1000,
+    "stdout_rate": 0,
+    "hydrognss": "HydroGNSS-1",
+}
+
+EXPERIMENT_NAME = "Bench_01-Jan-2023_00_00_00"
+# How many lines are logged by the logging benchmark.
+LOG_BENCHMARK_LINES = 100_000
+
+# Where the stubs are put, relative to the root of the benchmark, mimicking the
+# default configuration.
+STUB_PATHS = {
+    Conf.L1A_EXE:    os.path.join("L1A", "bin", "HSAVERS.py"),
+    Conf.L1B_EXE:    os.path.join("L1BOP", "scripts", "Run_L1b_Processor_with_dates.py"),
+    Conf.L1B_MM_EXE: os.path.join("L1OP-MM", "scripts", "Run_L1Merge_with_dates.py"),
+    Conf.L1B_CX_EXE: os.path.join("L2OP-SI", "bin", "L1B_CX_DR.py"),
+    Conf.L1B_CC_EXE: os.path.join("L2OP-SI", "bin", "L1B_CC_DR.py"),
+    Conf.L2FB_EXE:   os.path.join("L2OP-FB", "bin", "L2OP_FB.py"),
+    Conf.L2FT_EXE:   os.path.join("L2OP-FT", "bin", "L2PPFT_mainscript.py"),
+    Conf.L2SI_EXE:   os.path.join("L2OP-SI", "bin", "L2OP_SI_DR.py"),
+    Conf.L2SM_EXE:   os.path.join("L2OP-SSM", "bin", "SML2OP_start.py"),
+    Conf.PAM_EXE:    os.path.join("PAM", "bin", "PAM_start.py"),
+}
+
+# The Level-2 output directory of each stub.
+STUB_L2_DIRS = {
+    Conf.L2FB_EXE: orchestrator.PROC_OUTPUT_DIRS[Proc.L2FB],
+    Conf.L2FT_EXE: orchestrator.PROC_OUTPUT_DIRS[Proc.L2FT],
+    Conf.L2SI_EXE: orchestrator.PROC_OUTPUT_DIRS[Proc.L2SI],
+    Conf.L2SM_EXE: orchestrator.PROC_OUTPUT_DIRS[Proc.L2SM],
+}
+
+STUB_TEMPLATE = """import sys
+sys.path.insert(0, {harness_dir!r})
+import benchmark_orchestrator
+sys.exit(benchmark_orchestrator.stub_main({role!r}, {config_path!r}, sys.argv[1:]))
+"""
+
+# What the NetCDF files start with.
+HDF5_MAGIC = b"\x89HDF\r\n\x1a\n"
+
+def _write_netcdf(path: str, size: int) -> None:
+    # Half random and half zeros, to have something in between incompressible
+    # and very compressible data.
+    random_size = max(0, size - len(HDF5_MAGIC))//2
+    with open(path, "wb") as f:
+        f.write(HDF5_MAGIC)
+        f.write(os.urandom(random_size))
+        f.write(bytes(max(0, size - len(HDF5_MAGIC) - random_size)))
+
+def _windows(volume: Volume) -> list[datetime.datetime]:
+    """The start of the six hours windows of the simulation."""
+    res = []
+    for month in range(volume["months"]):
+        for day in range(volume["days"]):
+            for hour in range(volume["hours"]):
+                res.append(datetime.datetime(2021 + (month + 11)//12,
+                    (month + 11)%12 + 1, day + 1, hour*6))
+    return res
+
+def _window_dir(l1a_l1b_dir: str, window: datetime.datetime) -> str:
+    return os.path.join(l1a_l1b_dir, window.strftime("%Y-%m"),
+        window.strftime("%d"), f"H{window.hour:02}")
+
+def _print_lines(role: str, volume: Volume) -> None:
+    for i in range(volume["stdout_lines"]):
+        print(f"{role}: processing record {i} of {volume['stdout_lines']} "
+            f"{'.'*40}", flush=volume["stdout_rate"] > 0)
+        if volume["stdout_rate"] > 0:
+            time.sleep(1/volume["stdout_rate"])
+
+def _l1b_window_range(argv: list[str]) -> tuple[datetime.datetime, datetime.datetime]:
+    """Parses the arguments made by orchestrator._l1b_arguments."""
+    options = dict(option.split("=", 1) for option in " ".join(argv).strip('"').split(","))
+    return (datetime.datetime.strptime(options["StartDateTime"], "%Y%m%dT%H:%M:%S"),
+        datetime.datetime.strptime(options["StopDateTime"], "%Y%m%dT%H:%M:%S"))
+
+def stub_main(role: str, config_path: str, argv: list[str]) -> int:
+    """The entry point of the stubs, role is the name of a Conf member."""
+    with open(config_path) as f:
+        config = json.load(f)
+    volume: Volume = config["volume"]
+    data_release_dir = os.path.join(config["data_dir"], volume["hydrognss"],
+        "DataRelease")
+    l1a_l1b_dir = os.path.join(data_release_dir, "L1A_L1B")
+    windows = _windows(volume)
+
+    _print_lines(role, volume)
+    conf = Conf[role]
+    if conf == Conf.L1A_EXE:
+        l1a_out = os.path.join(config["root"], "HSAVERS_out", EXPERIMENT_NAME,
+            volume["hydrognss"])
+        for window in windows:
+            window_dir = _window_dir(os.path.join(l1a_out, "DataRelease", "L1A_L1B"), window)
+            os.makedirs(window_dir, exist_ok=True)
+            for i in range(volume["nc_per_window"]):
+                _write_netcdf(os.path.join(window_dir, f"L1A_{i}.nc"), volume["nc_size"])
+        with open(os.path.join(l1a_out, f"{EXPERIMENT_NAME[:-21]}_inOutReferenceFile.mat"), "wb") as f:
+            f.write(os.urandom(1024))
+        os.makedirs(os.path.join("..", "conf"), exist_ok=True)
+        with open(os.path.join("..", "conf", "AbsoluteFilePath.txt"), "w") as f:
+            f.write(l1a_out)
+    elif conf == Conf.L1B_EXE:
+        start, stop = _l1b_window_range(argv)
+        for window in windows:
+            if start <= window <= stop:
+                for i in range(volume["nc_per_window"]):
+                    _write_netcdf(os.path.join(_window_dir(l1a_l1b_dir, window),
+                        f"L1B_{i}.nc"), volume["nc_size"])
+    elif conf in (Conf.L1B_MM_EXE, Conf.L1B_CX_EXE, Conf.L1B_CC_EXE):
+        for window in windows:
+            _write_netcdf(os.path.join(_window_dir(l1a_l1b_dir, window),
+                f"{role}.nc"), 1024)
+    elif conf in STUB_L2_DIRS:
+        l2_dir = os.path.join(data_release_dir, STUB_L2_DIRS[conf])
+        os.makedirs(l2_dir, exist_ok=True)
+        for window in windows:
+            if window.hour == 0:
+                _write_netcdf(os.path.join(l2_dir,
+                    f"{role}_{window.strftime('%Y%m%d')}.nc"), volume["nc_size"])
+    elif conf == Conf.PAM_EXE:
+        pam_name, _, backup_dir, _ = argv
+        pam_output = os.path.join(backup_dir, "PAM_Output")
+        os.makedirs(pam_output, exist_ok=True)
+        with open(os.path.join(pam_output, f"{pam_name}.png"), "wb") as f:
+            f.write(os.urandom(16 << 10))
+    else:
+        print(f"unknown role {role}", file=sys.stderr)
+        return 1
+    return 0
+
+def make_installation(root: str, volume: Volume) -> list[str]:
+    """Creates in root the directories and the stubs, returns the configuration
+    to use with them."""
+    conf = list(orchestrator.CONF_VALUES_DEFAULT)
+    conf[Conf.BACKUP_DIR] = os.path.join(root, "E2ES_backups")
+    conf[Conf.DATA_DIR] = os.path.join(root, "PDGS_NAS_folder")
+    os.makedirs(conf[Conf.BACKUP_DIR], exist_ok=True)
+    os.makedirs(os.path.join(conf[Conf.DATA_DIR], "Auxiliary_Data"), exist_ok=True)
+
+    config_path = os.path.join(root, "stubs.json")
+    with open(config_path, "w") as f:
+        json.dump({"root": root, "data_dir": conf[Conf.DATA_DIR], "volume": volume}, f)
+
+    for option, relative_path in STUB_PATHS.items():
+        path = os.path.join(root, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(STUB_TEMPLATE.format(harness_dir=HARNESS_DIR,
+                role=option.name, config_path=config_path))
+        conf[option] = path
+    return conf
+
+# Benchmarks ###################################################################
+
+def _args(start: Proc, end: Proc, pam: bool = False, backup: str = "",
+    extra_ends: list[Proc] = []) -> orchestrator.Args:
+    res = orchestrator.Args(orchestrator.ARGS_DEFAULT)
+    res["start"] = start
+    res["end"] = end
+    res["pam"] = pam
+    res["backup"] = backup
+    res["extra_ends"] = extra_ends
+    return res
+
+def _time(fn: typing.Callable, *args) -> tuple[float, typing.Any]:
+    start = time.perf_counter()
+    res = fn(*args)
+    return time.perf_counter() - start, res
+
+def run_benchmarks(root: str, volume: Volume, settings: orchestrator.Settings,
+    repeat: int) -> dict[str, list[float]]:
+    """Returns the seconds taken by each benchmark in each repetition."""
+    conf = make_installation(root, volume)
+    log_dir = os.path.join(root, "log")
+    os.makedirs(log_dir, exist_ok=True)
+    data_dir = conf[Conf.DATA_DIR]
+    which_hydrognss = volume["hydrognss"]
+    data_release_dir = os.path.join(data_dir, which_hydrognss, "DataRelease")
+    l2_ends = [Proc.L2FB, Proc.L2FT, Proc.L2SI, Proc.L2SM]
+
+    res: dict[str, list[float]] = {}
+    def record(name: str, seconds: float) -> None:
+        res.setdefault(name, []).append(seconds)
+
+    for _ in range(repeat):
+        with orchestrator.LogToFileContext("L1A", "L2SM", log_dir) as log:
+            seconds, backup = _time(orchestrator.run, _args(Proc.L1A,
+                Proc.L2FB, True, extra_ends=l2_ends[1:]), conf, "input.xml", settings)
+        if log.exception is not None:
+            raise Exception("the pipeline failed, see the logs in "
+                f"{log_dir}") from log.exception
+        record("pipeline", seconds)
+
+        with orchestrator.LogToFileContext("L2FB", "L2FB", log_dir) as log:
+            seconds, _ = _time(orchestrator.run, _args(Proc.L2FB, Proc.L2FB,
+                backup=backup), conf, "", settings)
+        if log.exception is not None:
+            raise Exception("the run from the backup failed, see the logs in "
+                f"{log_dir}") from log.exception
+        record("run_from_backup", seconds)
+
+        zip_path = os.path.join(root, "backup.zip")
+        record("backup_zip", _time(orchestrator._make_zip, zip_path, data_dir,
+            which_hydrognss, settings)[0])
+        store_dir = os.path.join(root, "store")
+        os.makedirs(store_dir, exist_ok=True)
+        record("backup_store", _time(orchestrator._backup_to_store, data_dir,
+            which_hydrognss, store_dir, f"{EXPERIMENT_NAME}_{int(time.time())}",
+            orchestrator._io_workers(settings))[0])
+
+        record("verify", _time(orchestrator._verify_backup, zip_path,
+            orchestrator._io_workers(settings))[0])
+        restore_dir = os.path.join(root, "restore")
+        record("restore", _time(orchestrator._restore_backup, zip_path,
+            restore_dir, None, orchestrator._io_workers(settings))[0])
+        record("cleanup", _time(orchestrator._clean_up, restore_dir,
+            dict(settings, background_cleanup=False))[0])
+        names = orchestrator._backup_member_names(zip_path)
+        paths = orchestrator._paths_to_restore(orchestrator._stages_to_run(
+            Proc.L2SM, [Proc.L2SM]))
+        members = orchestrator._members_to_restore(names, which_hydrognss, paths)
+        record("restore_selective", _time(orchestrator._restore_backup, zip_path,
+            restore_dir, members, orchestrator._io_workers(settings))[0])
+        # How long the orchestration waits, not how long the deletion takes.
+        record("cleanup_background", _time(orchestrator._clean_up, restore_dir,
+            dict(settings, background_cleanup=True))[0])
+        orchestrator._trash.wait()
+        os.remove(zip_path)
+
+        record("date_detection", _time(orchestrator._detect_dates,
+            os.path.join(data_release_dir, "L1A_L1B"))[0])
+        orchestrator._write_coverage(data_release_dir, orchestrator._build_coverage(
+            os.path.join(data_release_dir, "L1A_L1B")))
+        record("date_detection_coverage", _time(lambda: orchestrator._dates_of_coverage(
+            orchestrator._coverage(data_release_dir)))[0])
+
+        # After the run from the backup only these have data.
+        coverage = orchestrator._coverage(data_release_dir)
+        def validate_netcdf() -> None:
+            orchestrator._validate_netcdf_output(
+                os.path.join(data_release_dir, "L1A_L1B"),
+                orchestrator._windows_with_data(coverage),
+                orchestrator._io_workers(settings))
+            orchestrator._validate_netcdf_output(
+                os.path.join(data_release_dir, orchestrator.PROC_OUTPUT_DIRS[Proc.L2FB]),
+                workers=orchestrator._io_workers(settings))
+        record("netcdf_validation", _time(validate_netcdf)[0])
+
+        # How long logging the lines of the processors takes, for the run and
+        # until they are all written.
+        def log_lines() -> float:
+            with orchestrator.LogToFileContext("L1B", "L1B", log_dir,
+                settings=settings):
+                orchestrator.logger.setLevel(logging.INFO)
+                seconds = _time(lambda: [orchestrator.logger.info(f"L1B_DR: line {i}")
+                    for i in range(LOG_BENCHMARK_LINES)])[0]
+            return seconds
+        seconds, logging_seconds = _time(log_lines)
+        record("logging", logging_seconds)
+        record("logging_written", seconds)
+
+    return res
+
+def _main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks the orchestrator "
+        "with stub processors.")
+    for key, value in VOLUME_DEFAULT.items():
+        parser.add_argument(f"-{key}", action="store", type=type(value), default=value)
+    parser.add_argument("-repeat", action="store", type=int, default=3)
+    # A JSON object with the settings of the orchestrator to change.
+    parser.add_argument("-settings", action="store", type=str, default="{}")
+    parser.add_argument("-dir", action="store", type=str, default="",
+        help="where to put the data, by default a temporary directory")
+    parser.add_argument("-json", action="store", type=str, default="",
+        help="where to save the results")
+    parsed_args = parser.parse_args()
+
+    volume = typing.cast(Volume, {key: getattr(parsed_args, key) for key in VOLUME_DEFAULT})
+    settings = orchestrator.Settings(orchestrator.SETTINGS_DEFAULT)
+    settings.update(json.loads(parsed_args.settings))
+    if not orchestrator.validate_settings(settings):
+        print("the settings are invalid", file=sys.stderr)
+        return 1
+
+    orchestrator.logger.addHandler(logging.NullHandler())
+    with tempfile.TemporaryDirectory(dir=parsed_args.dir or None) as root:
+        try:
+            results = run_benchmarks(root, volume, settings, parsed_args.repeat)
+        except Exception as ex:
+            print(f"the benchmark failed: {ex!r} caused by {ex.__cause__!r}",
+                file=sys.stderr)
+            return 1
+
+    data_bytes = len(_windows(volume))*volume["nc_per_window"]*volume["nc_size"]
+    print(f"{len(_windows(volume))} windows, {data_bytes >> 20} MB of L1A data, "
+        f"{parsed_args.repeat} repetitions")
+    print(f"{'benchmark':<20} {'min [s]':>10} {'median [s]':>10}")
+    for name, seconds in results.items():
+        print(f"{name:<20} {min(seconds):>10.3f} {statistics.median(seconds):>10.3f}")
+    print(f"logging: {LOG_BENCHMARK_LINES/statistics.median(results['logging']):.0f} "
+        f"lines/s, {LOG_BENCHMARK_LINES/statistics.median(results['logging_written']):.0f} "
+        "lines/s written")
+
+    if parsed_args.json:
+        with open(parsed_args.json, "w") as f:
+            json.dump({
+                "version": orchestrator.VERSION,
+                "volume": volume,
+                "settings": settings,
+                "seconds": results,
+            }, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(_main())
@@ -28,25 +28,52 @@ not tackle it.
 VERSION = "6.5"
 
 import argparse
+import asyncio
+import atexit
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import csv
+import datetime
 import enum
+import fnmatch
 import glob
+import gzip
+import hashlib
+import hmac
+import http.client
+import http.server
 import inspect
 import io
+import itertools
 import json
+import locale
 import logging
+import logging.handlers
 import os
+import queue
 # import pathlib
 import re
+import shlex
 import shutil
+import signal
+import sqlite3
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import tkinter
 import tkinter.filedialog
 import tkinter.messagebox
 import tkinter.ttk
 import typing
+import urllib.parse
 import zipfile
+import zlib
 
 # We do not know if this is really needed for high DPI screens.
 # import ctypes
@@ -87,6 +114,71 @@ PROC_OUTPUT_DIRS = [
 ]
 assert len(Proc) == len(PROC_OUTPUT_DIRS)
 
+# Stages #######################################################################
+
+class Stage(enum.IntEnum):
+    """The steps in which an orchestration is divided. The order is the one in
+    which they are executed when they are run one at a time."""
+    L1A          = 0
+    DATES        = enum.auto() # Detection of the dates of the simulation.
+    L1B          = enum.auto()
+    L1B_MM       = enum.auto()
+    L1B_CX       = enum.auto()
+    L1B_CC       = enum.auto()
+    L1B_MM_AGAIN = enum.auto()
+    L2FB         = enum.auto()
+    L2FT         = enum.auto()
+    L2SI         = enum.auto()
+    L2SM         = enum.auto()
+
+# The inputs and outputs are the names of the data that the stages exchange, a
+# stage can run as soon as all the stages that produce its inputs are done. The
+# inputs that are produced by no stage in the orchestration are expected to be
+# already in the DataRelease directory. Each name must be produced by only one
+# stage.
+# inputs,                         outputs,         processor
+STAGE_TABLE = (
+    ((),                             ("l1a",),        Proc.L1A),
+    (("l1a",),                       ("dates",),      Proc.L1B),
+    (("l1a", "dates"),               ("l1b",),        Proc.L1B),
+    (("l1b", "dates"),               ("l1b_mm",),     Proc.L1B),
+    (("l1b_mm", "dates"),            ("l1b_cx",),     Proc.L1B),
+    (("l1b_mm", "dates"),            ("l1b_cc",),     Proc.L1B),
+    (("l1b_cx", "l1b_cc", "dates"),  ("l1b_final",),  Proc.L1B),
+    (("l1b_final", "dates"),         ("l2fb",),       Proc.L2FB),
+    (("l1b_final", "dates"),         ("l2ft",),       Proc.L2FT),
+    (("l1b_final", "dates"),         ("l2si",),       Proc.L2SI),
+    (("l1b_final", "dates"),         ("l2sm",),       Proc.L2SM),
+)
+assert len(STAGE_TABLE) == len(Stage)
+column_major = tuple(zip(*STAGE_TABLE))
+STAGE_INPUTS  = column_major[0]
+STAGE_OUTPUTS = column_major[1]
+STAGE_PROC    = column_major[2] # The processor that the stage belongs to.
+del column_major
+
+# Where the data exchanged by the stages is kept, relative to DataRelease. When
+# restoring a backup only the data that the stages to run need and that they do
+# not produce themselves is extracted.
+ARTIFACT_PATHS = {
+    "l1a":       "L1A_L1B",
+    "dates":     "L1A_L1B", # The dates are the names of the directories.
+    "l1b":       "L1A_L1B",
+    "l1b_mm":    "L1A_L1B",
+    "l1b_cx":    "L1A_L1B",
+    "l1b_cc":    "L1A_L1B",
+    "l1b_final": "L1A_L1B",
+    "l2fb":      "L2OP-FB",
+    "l2ft":      "L2OP-FT",
+    "l2si":      "L2OP-SI",
+    "l2sm":      "L2OP-SSM",
+}
+assert set(ARTIFACT_PATHS) == {output for outputs in STAGE_OUTPUTS for output in outputs}
+
+# The files in DataRelease that are always restored (they are glob patterns).
+# The reference file of HSAVERS is needed by the PAM.
+RESTORE_ALWAYS = ["experiment_name.txt", "*_inOutReferenceFile.mat"]
+
 # Configuration of the variuous processors #####################################
 
 class Conf(enum.IntEnum):
@@ -190,6 +282,8 @@ class Args(typing.TypedDict):
     pam: bool
     backup: str
     log_level: LogLevel
+    # Other Level-2 processors to run at the same time of end.
+    extra_ends: list[Proc]
 
 ARGS_DEFAULT: Args = {
     "start": Proc.L1A,
@@ -197,6 +291,115 @@ ARGS_DEFAULT: Args = {
     "pam": False,
     "backup": "",
     "log_level": LogLevel.INFO,
+    "extra_ends": [],
+}
+
+# Settings #####################################################################
+
+class Settings(typing.TypedDict):
+    """The tuning knobs of the orchestrator that are not paths. They are stored
+    in the same JSON object of the configuration, next to the keys of Conf."""
+    l1b_shard: str
+    l1b_shard_workers: int
+    max_parallel_stages: int
+    batch_workers: int
+    backup_format: str
+    io_workers: int
+    selective_restore: bool
+    l1a_promotion: str
+    backup_cache_dir: str
+    backup_cache_size_mb: int
+    zip_compression_level: int
+    zip_stored_extensions: list[str]
+    compression_workers: int
+    stage_cache_dir: str
+    stage_cache_size_mb: int
+    processor_timeouts: dict[str, int]
+    processor_stall_timeouts: dict[str, int]
+    background_cleanup: bool
+    cleanup_mode: str
+    trash_size_mb: int
+    workers: list[str]
+    worker_token: str
+    worker_staging: str
+    local_processor_slots: int
+    log_rotate_mb: int
+    log_gzip_after_days: int
+    verify_backup: bool
+
+# How the range of dates is split when running L1B, "" means that L1B is run
+# only once for the whole range. Running more instances of L1B at the same time
+# assumes that they do not step on each other toes in the working directory.
+L1B_SHARD_MODES = ["", "day", "6h"]
+
+# How the backups are made, see the Backup store section for "store".
+BACKUP_FORMATS = ["zip", "store"]
+# How the output of HSAVERS is put in DataRelease. "copy" leaves the output of
+# HSAVERS untouched, "link" hardlinks the files (the processors that modify the
+# files in L1A_L1B modify also the ones of HSAVERS) and "move" renames them.
+# Across volumes "link" and "move" fall back to copying.
+PROMOTION_MODES = ["copy", "link", "move"]
+# What is done to the directories of the previous executions. "recycle" puts
+# them in the recycle bin (only on Windows, elsewhere they are deleted) and
+# "delete" deletes them, which is faster.
+CLEANUP_MODES = ["recycle", "delete"]
+# How the data reaches the worker agents, see the Workers section.
+WORKER_STAGING_MODES = ["shared", "copy"]
+
+SETTINGS_DEFAULT: Settings = {
+    "l1b_shard": "",
+    "l1b_shard_workers": 0, # 0 means as many as the CPUs.
+    # 1 means that the stages are run one after the other in the order of Stage.
+    "max_parallel_stages": 1,
+    "batch_workers": 1,
+    "backup_format": "zip",
+    # Threads used for file operations like hashing and copying, 0 means the
+    # default of concurrent.futures.ThreadPoolExecutor.
+    "io_workers": 0,
+    # Restore from the backup only what is needed by the starting processor.
+    "selective_restore": True,
+    "l1a_promotion": "copy", # One of PROMOTION_MODES.
+    # Where the extracted backups are kept to be reused, "" disables the cache.
+    "backup_cache_dir": "",
+    "backup_cache_size_mb": 20480,
+    # The zlib compression level of the members of the backup zips, from 0 to 9
+    # or -1 for the zlib default.
+    "zip_compression_level": -1,
+    # The members with these extensions are stored without compression in the
+    # backup zips, for example [".nc", ".mat", ".png"] since they are often
+    # already compressed.
+    "zip_stored_extensions": [],
+    "compression_workers": 0, # 0 means as many as the CPUs.
+    # Where the output of the stages is kept to be reused when they are run
+    # again on the same inputs, "" disables the cache.
+    "stage_cache_dir": "",
+    "stage_cache_size_mb": 20480,
+    # The seconds after which the executables, named like in Conf (e.g.
+    # "L1B_EXE"), are killed. The ones that are not here can run forever.
+    "processor_timeouts": {},
+    # The seconds after which the executables that do not write anything are
+    # considered stuck and killed.
+    "processor_stall_timeouts": {},
+    # Moves what has to be cleaned up in a trash directory on the same volume
+    # and deletes it in the background, see the Cleanup section.
+    "background_cleanup": True,
+    "cleanup_mode": "recycle", # One of CLEANUP_MODES.
+    "trash_size_mb": 51200,
+    # The URLs of the worker agents (e.g. "http://host:8765") on which the
+    # stages after L1A can be run, see the Workers section.
+    "workers": [],
+    "worker_token": "",
+    "worker_staging": "shared", # One of WORKER_STAGING_MODES.
+    # How many stages run their processor on this host at the same time when
+    # there are workers, 0 means that they all run on the workers.
+    "local_processor_slots": 1,
+    # The log of a run continues in a new file when it gets bigger than this, 0
+    # means never.
+    "log_rotate_mb": 100,
+    # The logs older than this are compressed, 0 means never.
+    "log_gzip_after_days": 7,
+    # Check the files of the backup against their SHA-256 before restoring it.
+    "verify_backup": True,
 }
 
 ################################################################################
@@ -213,6 +416,15 @@ def _escape_string(s: str) -> str:
     # f"{s!r}"[2:-2]
     return s.encode("unicode_escape").decode("utf-8")
 
+def _submit(executor: concurrent.futures.Executor, fn: typing.Callable,
+    *args: typing.Any) -> concurrent.futures.Future:
+    """Like executor.submit but fn is run in a copy of the current context, so
+    that the context variables are not lost in the threads of the executor."""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+def _io_workers(settings: Settings) -> int:
+    return settings["io_workers"] or min(32, (os.cpu_count() or 1) + 4)
+
 _experiment_name_format = re.compile(
     "_[0-9]{2}-(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)-[0-9]{4}_[0-9]{2}_[0-9]{2}_[0-9]{2}$"
 )
@@ -273,6 +485,169 @@ if os.name == 'nt':
         )
         SHFileOperationA(ctypes.pointer(file_op))
 
+    # Job objects are used to measure the resources used by a processor and by
+    # all the processes that it starts.
+    # https://learn.microsoft.com/en-us/windows/win32/api/winnt/ns-winnt-jobobject_basic_accounting_information
+    class JOBOBJECT_BASIC_ACCOUNTING_INFORMATION(ctypes.Structure):
+        _fields_ = [
+            ("TotalUserTime",             ctypes.wintypes.LARGE_INTEGER),
+            ("TotalKernelTime",           ctypes.wintypes.LARGE_INTEGER),
+            ("ThisPeriodTotalUserTime",   ctypes.wintypes.LARGE_INTEGER),
+            ("ThisPeriodTotalKernelTime", ctypes.wintypes.LARGE_INTEGER),
+            ("TotalPageFaultCount",       ctypes.wintypes.DWORD),
+            ("TotalProcesses",            ctypes.wintypes.DWORD),
+            ("ActiveProcesses",           ctypes.wintypes.DWORD),
+            ("TotalTerminatedProcesses",  ctypes.wintypes.DWORD),
+        ]
+
+    # https://learn.microsoft.com/en-us/windows/win32/api/winnt/ns-winnt-io_counters
+    class IO_COUNTERS(ctypes.Structure):
+        _fields_ = [
+            ("ReadOperationCount",  ctypes.c_ulonglong),
+            ("WriteOperationCount", ctypes.c_ulonglong),
+            ("OtherOperationCount", ctypes.c_ulonglong),
+            ("ReadTransferCount",   ctypes.c_ulonglong),
+            ("WriteTransferCount",  ctypes.c_ulonglong),
+            ("OtherTransferCount",  ctypes.c_ulonglong),
+        ]
+
+    # https://learn.microsoft.com/en-us/windows/win32/api/winnt/ns-winnt-jobobject_basic_and_io_accounting_information
+    class JOBOBJECT_BASIC_AND_IO_ACCOUNTING_INFORMATION(ctypes.Structure):
+        _fields_ = [
+            ("BasicInfo", JOBOBJECT_BASIC_ACCOUNTING_INFORMATION),
+            ("IoInfo",    IO_COUNTERS),
+        ]
+
+    # https://learn.microsoft.com/en-us/windows/win32/api/winnt/ns-winnt-jobobject_basic_limit_information
+    class JOBOBJECT_BASIC_LIMIT_INFORMATION(ctypes.Structure):
+        _fields_ = [
+            ("PerProcessUserTimeLimit", ctypes.wintypes.LARGE_INTEGER),
+            ("PerJobUserTimeLimit",     ctypes.wintypes.LARGE_INTEGER),
+            ("LimitFlags",              ctypes.wintypes.DWORD),
+            ("MinimumWorkingSetSize",   ctypes.c_size_t),
+            ("MaximumWorkingSetSize",   ctypes.c_size_t),
+            ("ActiveProcessLimit",      ctypes.wintypes.DWORD),
+            ("Affinity",                ctypes.c_size_t), # ULONG_PTR
+            ("PriorityClass",           ctypes.wintypes.DWORD),
+            ("SchedulingClass",         ctypes.wintypes.DWORD),
+        ]
+
+    # https://learn.microsoft.com/en-us/windows/win32/api/winnt/ns-winnt-jobobject_extended_limit_information
+    class JOBOBJECT_EXTENDED_LIMIT_INFORMATION(ctypes.Structure):
+        _fields_ = [
+            ("BasicLimitInformation", JOBOBJECT_BASIC_LIMIT_INFORMATION),
+            ("IoInfo",                IO_COUNTERS),
+            ("ProcessMemoryLimit",    ctypes.c_size_t),
+            ("JobMemoryLimit",        ctypes.c_size_t),
+            ("PeakProcessMemoryUsed", ctypes.c_size_t),
+            ("PeakJobMemoryUsed",     ctypes.c_size_t),
+        ]
+
+    JobObjectBasicAndIoAccountingInformation = 8
+    JobObjectExtendedLimitInformation = 9
+    PROCESS_TERMINATE = 0x0001
+    PROCESS_SET_QUOTA = 0x0100
+    PROCESS_SUSPEND_RESUME = 0x0800
+    PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+    CREATE_SUSPENDED = 0x00000004
+
+    _kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    _kernel32.CreateJobObjectW.argtypes = [ctypes.wintypes.LPVOID, ctypes.wintypes.LPCWSTR]
+    _kernel32.CreateJobObjectW.restype = ctypes.wintypes.HANDLE
+    _kernel32.OpenProcess.argtypes = [ctypes.wintypes.DWORD, ctypes.wintypes.BOOL, ctypes.wintypes.DWORD]
+    _kernel32.OpenProcess.restype = ctypes.wintypes.HANDLE
+    _kernel32.AssignProcessToJobObject.argtypes = [ctypes.wintypes.HANDLE, ctypes.wintypes.HANDLE]
+    _kernel32.AssignProcessToJobObject.restype = ctypes.wintypes.BOOL
+    _kernel32.QueryInformationJobObject.argtypes = [ctypes.wintypes.HANDLE,
+        ctypes.c_int, ctypes.wintypes.LPVOID, ctypes.wintypes.DWORD, ctypes.wintypes.LPDWORD]
+    _kernel32.QueryInformationJobObject.restype = ctypes.wintypes.BOOL
+    _kernel32.GetProcessIoCounters.argtypes = [ctypes.wintypes.HANDLE, ctypes.POINTER(IO_COUNTERS)]
+    _kernel32.GetProcessIoCounters.restype = ctypes.wintypes.BOOL
+    _kernel32.GetCurrentProcess.restype = ctypes.wintypes.HANDLE
+    _kernel32.CloseHandle.argtypes = [ctypes.wintypes.HANDLE]
+    _kernel32.CloseHandle.restype = ctypes.wintypes.BOOL
+    _kernel32.TerminateJobObject.argtypes = [ctypes.wintypes.HANDLE, ctypes.wintypes.UINT]
+    _kernel32.TerminateJobObject.restype = ctypes.wintypes.BOOL
+    # There is no documented way to resume a process that has been created
+    # suspended without knowing the handle of its main thread, which
+    # subprocess does not give.
+    # https://learn.microsoft.com/en-us/windows/win32/procthread/process-creation-flags
+    _ntdll = ctypes.WinDLL("ntdll")
+    _ntdll.NtResumeProcess.argtypes = [ctypes.wintypes.HANDLE]
+    _ntdll.NtResumeProcess.restype = ctypes.c_long # NTSTATUS
+
+    def _create_job_for_process(pid: int) -> int:
+        """Returns a job with the process in it. The processes started by the
+        process after this call end up in the job too."""
+        job = _kernel32.CreateJobObjectW(None, None)
+        if not job:
+            raise ctypes.WinError(ctypes.get_last_error())
+        process = _kernel32.OpenProcess(PROCESS_SET_QUOTA | PROCESS_TERMINATE
+            | PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not process:
+            _kernel32.CloseHandle(job)
+            raise ctypes.WinError(ctypes.get_last_error())
+        try:
+            if not _kernel32.AssignProcessToJobObject(job, process):
+                _kernel32.CloseHandle(job)
+                raise ctypes.WinError(ctypes.get_last_error())
+        finally:
+            _kernel32.CloseHandle(process)
+        return job
+
+    def _resume_process(pid: int) -> None:
+        """Resumes a process started with CREATE_SUSPENDED."""
+        process = _kernel32.OpenProcess(PROCESS_SUSPEND_RESUME, False, pid)
+        if not process:
+            raise ctypes.WinError(ctypes.get_last_error())
+        try:
+            status = _ntdll.NtResumeProcess(process)
+            if status < 0:
+                raise OSError(f"unable to resume the process {pid} (NTSTATUS "
+                    f"{status & 0xFFFFFFFF:#010x})")
+        finally:
+            _kernel32.CloseHandle(process)
+
+    def _job_usage(job: int) -> dict:
+        accounting = JOBOBJECT_BASIC_AND_IO_ACCOUNTING_INFORMATION()
+        if not _kernel32.QueryInformationJobObject(job,
+            JobObjectBasicAndIoAccountingInformation, ctypes.byref(accounting),
+            ctypes.sizeof(accounting), None):
+            raise ctypes.WinError(ctypes.get_last_error())
+        limits = JOBOBJECT_EXTENDED_LIMIT_INFORMATION()
+        if not _kernel32.QueryInformationJobObject(job,
+            JobObjectExtendedLimitInformation, ctypes.byref(limits),
+            ctypes.sizeof(limits), None):
+            raise ctypes.WinError(ctypes.get_last_error())
+        # The times are in units of 100 nanoseconds.
+        return {
+            "user_cpu_seconds": accounting.BasicInfo.TotalUserTime/1e7,
+            "system_cpu_seconds": accounting.BasicInfo.TotalKernelTime/1e7,
+            # This is the committed memory, not the working set.
+            "peak_memory_bytes": limits.PeakJobMemoryUsed,
+            "read_bytes": accounting.IoInfo.ReadTransferCount,
+            "write_bytes": accounting.IoInfo.WriteTransferCount,
+        }
+
+    def _terminate_job(job: int) -> None:
+        """Kills all the processes in the job."""
+        if not _kernel32.TerminateJobObject(job, 1):
+            raise ctypes.WinError(ctypes.get_last_error())
+
+    def _self_io_bytes() -> tuple[int, int]:
+        counters = IO_COUNTERS()
+        if not _kernel32.GetProcessIoCounters(_kernel32.GetCurrentProcess(),
+            ctypes.byref(counters)):
+            raise ctypes.WinError(ctypes.get_last_error())
+        return counters.ReadTransferCount, counters.WriteTransferCount
+else:
+    # Elsewhere there is no recycle bin, so things are just deleted.
+    def _recycle(path: str) -> None:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
 # if os.mkdir ever creates problems:
 # https://learn.microsoft.com/en-us/windows/win32/api/shlobj_core/nf-shlobj_core-shcreatedirectoryexa
 
@@ -285,6 +660,7 @@ def validate_arguments(args: Args) -> bool:
     end = args["end"]
     pam = args["pam"]
     backup = args["backup"]
+    extra_ends = args["extra_ends"]
 
     if start > end:
         return False
@@ -294,202 +670,2963 @@ def validate_arguments(args: Args) -> bool:
         return False
     if pam and end < Proc.L1B:
         return False
+    if extra_ends and end <= Proc.L1B:
+        return False
+    if any(extra_end <= Proc.L1B for extra_end in extra_ends):
+        return False
+    if len(set(extra_ends) | {end}) != len(extra_ends) + 1:
+        return False
 
     # NOTE: does it make sense to keep the spec?
     assert start <= end
     assert implies(start > Proc.L1B, start == end)
     assert implies(backup, start > Proc.L1A)
     assert implies(pam, end > Proc.L1A)
+    assert implies(extra_ends, all(e > Proc.L1B for e in [end] + extra_ends))
 
     return True
 
 assert validate_arguments(ARGS_DEFAULT)
 
+def _ends(args: Args) -> list[Proc]:
+    """All the processors at which the orchestration ends, in ascending order."""
+    return sorted([args["end"]] + args["extra_ends"])
+
+def _split_ends(start: Proc, ends: list[Proc]) -> tuple[Proc, list[Proc]]:
+    """Chooses which one of the ends goes in Args' end, the others go in
+    extra_ends. It is the start if it is one of the ends, since when starting
+    from a Level-2 processor start and end must be the same, otherwise the first
+    one."""
+    assert ends
+    end = start if start in ends else min(ends)
+    return end, sorted(set(ends) - {end})
+
+def validate_settings(settings: Settings) -> bool:
+    if settings["l1b_shard"] not in L1B_SHARD_MODES:
+        return False
+    if settings["l1b_shard_workers"] < 0:
+        return False
+    if settings["max_parallel_stages"] < 1:
+        return False
+    if settings["batch_workers"] < 1:
+        return False
+    if settings["backup_format"] not in BACKUP_FORMATS:
+        return False
+    if settings["io_workers"] < 0:
+        return False
+    if settings["l1a_promotion"] not in PROMOTION_MODES:
+        return False
+    if settings["backup_cache_size_mb"] < 0:
+        return False
+    if not -1 <= settings["zip_compression_level"] <= 9:
+        return False
+    if not all(isinstance(ext, str) and ext.startswith(".")
+        for ext in settings["zip_stored_extensions"]):
+        return False
+    if settings["compression_workers"] < 0:
+        return False
+    if settings["stage_cache_size_mb"] < 0:
+        return False
+    if settings["cleanup_mode"] not in CLEANUP_MODES:
+        return False
+    if settings["trash_size_mb"] < 0:
+        return False
+    if not all(isinstance(url, str) and url.startswith("http://")
+        for url in settings["workers"]):
+        return False
+    if settings["worker_staging"] not in WORKER_STAGING_MODES:
+        return False
+    # The agents do not accept requests without it.
+    if settings["workers"] and not settings["worker_token"]:
+        return False
+    if settings["local_processor_slots"] < 0:
+        return False
+    if settings["log_rotate_mb"] < 0 or settings["log_gzip_after_days"] < 0:
+        return False
+    for timeouts in (settings["processor_timeouts"], settings["processor_stall_timeouts"]):
+        for exe, seconds in timeouts.items():
+            if exe not in Conf.__members__ or CONF_KINDS[Conf[exe]] != ConfKind.EXE:
+                return False
+            if type(seconds) != int or seconds < 0:
+                return False
+
+    return True
+
+assert validate_settings(SETTINGS_DEFAULT)
+
+def _settings_from_json(conf_json: dict) -> Settings:
+    """Reads the settings from the JSON object of the configuration, missing or
+    invalid keys are replaced with their default value."""
+    res = SETTINGS_DEFAULT.copy()
+    for key, correct_type in inspect.get_annotations(Settings).items():
+        if key not in conf_json:
+            continue
+        value = conf_json[key]
+        # For generic aliases like list[str] we check only the container, the
+        # content is checked by validate_settings. bool is a subclass of int but
+        # we do not want to accept it.
+        if type(value) != (typing.get_origin(correct_type) or correct_type):
+            logger.warning(f"the setting {key} has type {type(value)} instead "
+                f"of {correct_type}, using the default")
+            continue
+        res[key] = value # type: ignore
+    if not validate_settings(res):
+        logger.warning("the settings have an illegal value, using the default")
+        res = SETTINGS_DEFAULT.copy()
+    return res
+
+# The name of the batch job that the current thread is working on, empty when not
+# in a batch. It is used to send the log of each job only to its own file.
+_batch_job_name: contextvars.ContextVar[str] = \
+    contextvars.ContextVar("_batch_job_name", default="")
+
+# The jobs share the logger, which lets through the records of the job with the
+# lowest level, the handler of each job then drops the ones below its own level.
+_job_log_levels: collections.Counter[int] = collections.Counter()
+_job_log_levels_lock = threading.Lock()
+# The level of the logger before the first job started.
+_log_level_without_jobs = logging.NOTSET
+
+def _update_job_log_levels(level: int, started: bool) -> None:
+    """Called when a job with the level starts or ends."""
+    global _log_level_without_jobs
+    with _job_log_levels_lock:
+        if started:
+            if not _job_log_levels:
+                _log_level_without_jobs = logger.level
+            _job_log_levels[level] += 1
+        else:
+            _job_log_levels[level] -= 1
+            if not _job_log_levels[level]:
+                del _job_log_levels[level]
+        if _job_log_levels:
+            logger.setLevel(min(min(_job_log_levels), _effective_level_without_jobs()))
+        else:
+            logger.setLevel(_log_level_without_jobs)
+
+def _effective_level_without_jobs() -> int:
+    return _log_level_without_jobs or (logger.parent or logging.root).getEffectiveLevel()
+
+def _not_lowered_for_jobs(record: logging.LogRecord) -> bool:
+    """A filter for the handlers that are not of a job, which would otherwise
+    get the records that pass only because a job has a lower level."""
+    return not _batch_job_name.get() or record.levelno >= _effective_level_without_jobs()
+
+# The log of a run is written by a background thread, so that logging a line of
+# a processor costs only putting the record in a queue, and the records are
+# written in batches. When the file gets bigger than log_rotate_mb the log goes
+# on in a new file and the previous parts, named <log>.1.log, <log>.2.log, ...,
+# are compressed with gzip in the background, like the logs of the previous runs
+# older than log_gzip_after_days.
+
+_LOG_BATCH_RECORDS = 1024
+# One thread is enough, the logs are compressed one after the other.
+_log_compressor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="log_gzip")
+
+def _gzip_file(path: str) -> None:
+    """Replaces the file with its compressed version, keeping its modification
+    time."""
+    try:
+        mtime = os.stat(path).st_mtime
+        tmp_path = f"{path}.gz.part"
+        with open(path, "rb") as src, open(tmp_path, "wb") as f, \
+            gzip.GzipFile(os.path.basename(path), "wb", fileobj=f, mtime=int(mtime)) as dst:
+            shutil.copyfileobj(src, dst, _PIPE_CHUNK_SIZE)
+        os.utime(tmp_path, (mtime, mtime))
+        os.replace(tmp_path, f"{path}.gz")
+        os.remove(path)
+    except Exception:
+        logger.exception(f"unable to compress the log {path}")
+
+def _gzip_old_logs(log_dir: str, days: int) -> None:
+    oldest = time.time() - days*24*60*60
+    try:
+        entries = list(os.scandir(log_dir))
+    except OSError:
+        return
+    for entry in entries:
+        if entry.name.endswith(".log") and entry.is_file() \
+            and entry.stat().st_mtime < oldest:
+            _gzip_file(entry.path)
+
+class _LogQueueHandler(logging.handlers.QueueHandler):
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The records are formatted by the writer, not here where the copy and
+        # the formatting done by QueueHandler would cost as much as writing
+        # them. The messages of this module are f-strings, so there are no
+        # arguments that can change in the meantime.
+        return record
+
+class _LogWriter:
+    """Writes the records put in queue in path. Put None in the queue, or call
+    close, to stop it."""
+
+    def __init__(self, path: str, formatter: logging.Formatter, rotate_bytes: int):
+        self.queue: queue.SimpleQueue[typing.Optional[logging.LogRecord]] = queue.SimpleQueue()
+        self.path = path
+        self.formatter = formatter
+        self.rotate_bytes = rotate_bytes
+        self.parts = 0
+        self.file = open(path, "a")
+        self.thread = threading.Thread(target=self._work, name="log_writer", daemon=True)
+        self.thread.start()
+
+    def close(self) -> None:
+        """Waits for what was logged to be written."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def _rotate(self) -> None:
+        self.file.close()
+        self.parts += 1
+        root, ext = os.path.splitext(self.path)
+        part_path = f"{root}.{self.parts}{ext}"
+        os.replace(self.path, part_path)
+        self.file = open(self.path, "w")
+        _log_compressor.submit(_gzip_file, part_path)
+
+    def _work(self) -> None:
+        stop = False
+        while not stop:
+            records = [self.queue.get()]
+            while len(records) < _LOG_BATCH_RECORDS:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for record in records:
+                if record is None:
+                    stop = True
+                    continue
+                try:
+                    lines.append(f"{self.formatter.format(record)}\n")
+                except Exception as ex:
+                    print(f"unable to format a log record: {ex!r}", file=sys.stderr)
+            try:
+                self.file.write("".join(lines))
+                self.file.flush()
+                if self.rotate_bytes and self.file.tell() >= self.rotate_bytes:
+                    self._rotate()
+            except Exception as ex:
+                # This should be warnings.warn
+                print(f"unable to write the log {self.path}: {ex!r}", file=sys.stderr)
+        self.file.close()
+
 class LogToFileContext:
     """Inspired by:
     https://docs.python.org/3/howto/logging-cookbook.html#using-a-context-manager-for-selective-logging
+
+    If job_name is given only the records logged while working on that batch job
+    end up in the file, at the given level.
     """
-    def __init__(self, start_proc: str, end_proc: str, log_dir: str):
+    def __init__(self, start_proc: str, end_proc: str, log_dir: str,
+        job_name: str = "", level: LogLevel = LogLevel.DEBUG,
+        settings: Settings = SETTINGS_DEFAULT):
         start_time = time.gmtime()
         start_time_str = time.strftime("%Y%m%d_%H%M%S", start_time)
         pseudo_module_id = f"{start_proc}{end_proc}"
-        logfile_name = f"{pseudo_module_id}_{start_time_str}.log"
+        logfile_name = f"{pseudo_module_id}_{start_time_str}.log" if not job_name \
+            else f"{job_name}_{pseudo_module_id}_{start_time_str}.log"
         logfile_path = os.path.join(log_dir, logfile_name)
+        self.writer: typing.Optional[_LogWriter] = None
+        handler: logging.Handler
         try:
-            file_handler = logging.FileHandler(logfile_path) if os.name == "nt" \
-                else logging.NullHandler()
+            self.writer = _LogWriter(logfile_path,
+                logging.Formatter("%(asctime)s %(levelname)s: %(funcName)s: %(message)s"),
+                settings["log_rotate_mb"] << 20)
+            # The filters run in the thread that logs, where the context
+            # variables have the right value.
+            handler = _LogQueueHandler(self.writer.queue)
         except Exception as ex:
             logger.exception("unable to create log file for this run")
-            file_handler = logging.NullHandler()
-        file_handler.setFormatter(
-            logging.Formatter("%(asctime)s %(levelname)s: %(funcName)s: %(message)s")
-        )
-        self.handler = file_handler
-        # Because run() can change the log level.
-        self.original_level = logger.getEffectiveLevel()
+            handler = logging.NullHandler()
+        if job_name:
+            handler.setLevel((level+1)*10)
+            handler.addFilter(lambda record: _batch_job_name.get() == job_name)
+        self.handler = handler
+        self.job_name = job_name
+        self.level = (level+1)*10
+        self.log_dir = log_dir
+        self.gzip_after_days = settings["log_gzip_after_days"]
+        self.logfile_path = logfile_path
+        self.telemetry_path = f"{os.path.splitext(logfile_path)[0]}.json"
+        self.telemetry: list[TelemetryRecord] = []
+        self.trace_path = f"{os.path.splitext(logfile_path)[0]}.trace.json"
+        self.trace: list[dict] = []
+        # Because run() can change the log level, but not in a job.
+        self.original_level = logger.level
+        # The exception that terminated the orchestration, if any.
+        self.exception: typing.Optional[BaseException] = None
 
     def __enter__(self):
+        if self.job_name:
+            _update_job_log_levels(self.level, True)
         logger.addHandler(self.handler)
+        self.telemetry_token = _telemetry.set(self.telemetry)
+        self.trace_token = _trace.set(self.trace)
+        if self.gzip_after_days:
+            _log_compressor.submit(_gzip_old_logs, self.log_dir, self.gzip_after_days)
+        return self
 
     def __exit__(self, et, ev, tb):
-        logger.setLevel(self.original_level)
+        _telemetry.reset(self.telemetry_token)
+        _trace.reset(self.trace_token)
+        # The telemetry goes wherever the log goes.
+        if self.writer is not None:
+            try:
+                _write_json_atomically(self.telemetry_path, self.telemetry)
+            except Exception:
+                logger.exception("unable to write the telemetry of the run")
+            try:
+                _write_json_atomically(self.trace_path, _chrome_trace(self.trace))
+            except Exception:
+                logger.exception("unable to write the trace of the run")
+        if not self.job_name:
+            logger.setLevel(self.original_level)
         if et is not None:
             logger.exception("the orchestration encoutered a problem")
         logger.removeHandler(self.handler)
+        if self.job_name:
+            _update_job_log_levels(self.level, False)
         if et is not None:
             logger.error("the orchestration terminated baddly")
+            self.exception = ev
+        if self.writer is not None:
+            self.writer.close()
         return True # To swallow the exception.
 
-def _run_processor(file_path: str, arguments: str) -> None:
-    exe = file_path if file_path.endswith(".exe") \
-        else f"py {file_path}" if file_path.endswith(".py") \
+# The resources used by the processors and by the slow steps of a run are
+# collected in the telemetry of the run, if there is one, and written in a JSON
+# file next to its log.
+
+class TelemetryRecord(typing.TypedDict):
+    name: str
+    kind: str # Either "processor" or "step".
+    started: float # As returned by time.time().
+    wall_seconds: float
+    # The following are None when they can not be measured.
+    user_cpu_seconds: typing.Optional[float]
+    system_cpu_seconds: typing.Optional[float]
+    peak_memory_bytes: typing.Optional[int]
+    read_bytes: typing.Optional[int]
+    write_bytes: typing.Optional[int]
+    returncode: typing.Optional[int] # Only for processors.
+    killed_reason: typing.Optional[str] # Only for processors.
+
+_telemetry: contextvars.ContextVar[typing.Optional[list[TelemetryRecord]]] = \
+    contextvars.ContextVar("telemetry", default=None)
+_telemetry_lock = threading.Lock()
+
+_NO_USAGE = {
+    "user_cpu_seconds": None,
+    "system_cpu_seconds": None,
+    "peak_memory_bytes": None,
+    "read_bytes": None,
+    "write_bytes": None,
+}
+
+def _add_telemetry(record: TelemetryRecord) -> None:
+    records = _telemetry.get()
+    if records is not None:
+        with _telemetry_lock:
+            records.append(record)
+
+# How often the processes are sampled on Linux.
+_PROC_SAMPLING_INTERVAL = 0.2
+
+class _ProcessTreeSampler:
+    """Samples from /proc the resources used by a process and its descendants.
+    For each process the counters are the last ones read before it exited, so
+    what it did in its last _PROC_SAMPLING_INTERVAL can be missed. sample can
+    be called from another thread."""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        # pid -> (user seconds, system seconds, read bytes, written bytes)
+        self.counters: dict[int, tuple[float, float, int, int]] = {}
+        self.peak_memory_bytes = 0
+        self.lock = threading.Lock()
+        # Without CONFIG_PROC_CHILDREN the descendants are found by reading
+        # the parent of every process.
+        self_pid = os.getpid()
+        self.children_files = os.path.exists(f"/proc/{self_pid}/task/{self_pid}/children")
+
+    def _tree(self) -> list[int]:
+        if self.children_files:
+            return self._tree_from_children()
+        children = collections.defaultdict(list)
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            try:
+                with open(f"/proc/{name}/stat") as f:
+                    ppid = int(f.read().rpartition(")")[2].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children[ppid].append(int(name))
+        res = []
+        stack = [self.pid]
+        while stack:
+            pid = stack.pop()
+            res.append(pid)
+            stack.extend(children[pid])
+        return res
+
+    def _tree_from_children(self) -> list[int]:
+        """Like _tree, but looking only at the processes in the tree."""
+        res = []
+        stack = [self.pid]
+        while stack:
+            pid = stack.pop()
+            res.append(pid)
+            try:
+                for tid in os.listdir(f"/proc/{pid}/task"):
+                    with open(f"/proc/{pid}/task/{tid}/children") as f:
+                        stack.extend(int(child) for child in f.read().split())
+            except OSError:
+                continue
+        return res
+
+    def sample(self) -> None:
+        clock_ticks = os.sysconf("SC_CLK_TCK")
+        page_size = os.sysconf("SC_PAGE_SIZE")
+        memory = 0
+        for pid in self._tree():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    # The fields after the name, which is in parenthesis.
+                    stat = f.read().rpartition(")")[2].split()
+                with open(f"/proc/{pid}/io") as f:
+                    io_counters = dict(line.split(": ") for line in f.read().splitlines())
+            except OSError:
+                continue
+            memory += int(stat[21])*page_size
+            with self.lock:
+                self.counters[pid] = (
+                    int(stat[11])/clock_ticks,
+                    int(stat[12])/clock_ticks,
+                    int(io_counters["rchar"]),
+                    int(io_counters["wchar"])
+                )
+        with self.lock:
+            self.peak_memory_bytes = max(self.peak_memory_bytes, memory)
+
+    def usage(self) -> dict:
+        with self.lock:
+            user, system, read, written = (sum(column) for column in
+                zip((0.0, 0.0, 0, 0), *self.counters.values()))
+        return {
+            "user_cpu_seconds": user,
+            "system_cpu_seconds": system,
+            "peak_memory_bytes": self.peak_memory_bytes,
+            "read_bytes": read,
+            "write_bytes": written,
+        }
+
+def _self_usage() -> dict:
+    """The resources used so far by the orchestrator itself."""
+    times = os.times()
+    res = dict(_NO_USAGE, user_cpu_seconds=times.user,
+        system_cpu_seconds=times.system)
+    if os.name == "nt":
+        res["read_bytes"], res["write_bytes"] = _self_io_bytes()
+    elif os.path.exists("/proc/self/io"):
+        import resource # Only on Unix.
+        with open("/proc/self/io") as f:
+            io_counters = dict(line.split(": ") for line in f.read().splitlines())
+        res["read_bytes"] = int(io_counters["rchar"])
+        res["write_bytes"] = int(io_counters["wchar"])
+        # In kilobytes on Linux.
+        res["peak_memory_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+    return res
+
+class _MeasureStep:
+    """Adds to the telemetry the resources used by the orchestrator while in the
+    context. Since they are measured for the whole orchestrator they include
+    whatever else it was doing at the same time. The peak memory is the one of
+    the orchestrator since it started."""
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+        self.start_counter = time.perf_counter()
+        self.start_usage = _self_usage()
+        return self
+
+    def __exit__(self, et, ev, tb):
+        end_usage = _self_usage()
+        usage = {
+            key: None if end_usage[key] is None
+                else end_usage[key] if key == "peak_memory_bytes"
+                else end_usage[key] - self.start_usage[key]
+            for key in end_usage
+        }
+        seconds = time.perf_counter() - self.start_counter
+        _add_telemetry(typing.cast(TelemetryRecord, {
+            "name": self.name,
+            "kind": "step",
+            "started": self.started,
+            "wall_seconds": seconds,
+            **usage,
+            "returncode": None,
+            "killed_reason": None,
+        }))
+        _add_trace_event(self.name, "step", self.started, seconds)
+        return False
+
+# Besides the telemetry a run records a timeline of what it did, written next
+# to its log in the Chrome trace format, that can be opened with
+# chrome://tracing or https://ui.perfetto.dev to see where the time went. Each
+# thread of the orchestrator and each processor has its own track and the spans
+# on the same track nest.
+# https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+
+_trace: contextvars.ContextVar[typing.Optional[list[dict]]] = \
+    contextvars.ContextVar("trace", default=None)
+
+# A processor that does not write anything for longer than this has a stall in
+# its track.
+_STALL_SECONDS = 10.0
+
+def _add_trace_event(name: str, category: str, started: float, seconds: float,
+    track: str = "", args: typing.Optional[dict] = None) -> None:
+    """Adds a span to the trace of the run, if there is one. started is as
+    returned by time.time() and track is the name of the current thread by
+    default."""
+    events = _trace.get()
+    if events is None:
+        return
+    event = {
+        "name": name,
+        "cat": category,
+        "ph": "X",
+        "ts": started*1e6,
+        "dur": seconds*1e6,
+        "track": track or threading.current_thread().name,
+    }
+    if args:
+        event["args"] = args
+    with _telemetry_lock:
+        events.append(event)
+
+def _chrome_trace(events: list[dict]) -> dict:
+    """Converts the events to the Chrome trace format, where the tracks are
+    numbered threads of a single process."""
+    pid = os.getpid()
+    tids: dict[str, int] = {}
+    res = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0,
+        "args": {"name": "orchestrator"}}]
+    for event in sorted(events, key=lambda event: event["ts"]):
+        track = event["track"]
+        if track not in tids:
+            tids[track] = len(tids) + 1
+            res.append({"name": "thread_name", "ph": "M", "pid": pid,
+                "tid": tids[track], "args": {"name": track}})
+        res.append({key: value for key, value in event.items() if key != "track"}
+            | {"pid": pid, "tid": tids[track]})
+    return {"traceEvents": res, "displayTimeUnit": "ms"}
+
+class _TraceSpan:
+    """Adds to the trace of the run a span for the time spent in the
+    context."""
+
+    def __init__(self, name: str, category: str = "step", **args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.started = time.time()
+        self.start_counter = time.perf_counter()
+        return self
+
+    def __exit__(self, et, ev, tb):
+        args = dict(self.args, error=f"{ev}") if et is not None else self.args
+        _add_trace_event(self.name, self.category, self.started,
+            time.perf_counter() - self.start_counter, args=args)
+        return False
+
+# Set by whoever runs the orchestration (like the RunController) to stop it: the
+# running processors are killed and no other stage is started.
+_cancel_event: contextvars.ContextVar[typing.Optional[threading.Event]] = \
+    contextvars.ContextVar("cancel_event", default=None)
+# How often the running processors check if they have been cancelled, if they
+# took too long or if they are stuck.
+_WATCHDOG_INTERVAL = 0.2
+# How long the processes of a processor that has to be killed have to exit by
+# themselves before being killed for real.
+_KILL_GRACE_SECONDS = 5.0
+
+class RunCancelled(Exception):
+    pass
+
+def _raise_if_cancelled() -> None:
+    cancel = _cancel_event.get()
+    if cancel is not None and cancel.is_set():
+        raise RunCancelled("the orchestration has been cancelled")
+
+# Called when a stage starts (with 0 seconds) and when it ends, with how long it
+# took, so that the progress of the orchestration can be shown.
+_stage_listener: contextvars.ContextVar[typing.Optional[
+    typing.Callable[[str, Stage, float], None]]] = \
+    contextvars.ContextVar("stage_listener", default=None)
+
+def _notify_stage(event: str, stage: Stage, seconds: float = 0.0) -> None:
+    listener = _stage_listener.get()
+    if listener is not None:
+        listener(event, stage, seconds)
+
+def _kill_process_tree(pid: int, job: typing.Optional[int]) -> None:
+    """Kills the processor and the processes that it started. On Windows this
+    is done with its job or, if it could not be created, with taskkill, that
+    finds them from their parent process. Elsewhere the processor is the leader
+    of its own process group."""
+    try:
+        if job is not None:
+            _terminate_job(job)
+        elif os.name != "nt":
+            os.killpg(pid, signal.SIGKILL)
+        else:
+            subprocess.run(["taskkill", "/T", "/F", "/PID", str(pid)],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except ProcessLookupError:
+        pass
+    except OSError:
+        logger.exception("unable to kill the processor")
+
+async def _terminate_process_tree(pid: int, job: typing.Optional[int],
+    exited: asyncio.Event) -> None:
+    """Like _kill_process_tree but, where possible, the processes are first
+    asked to terminate and given _KILL_GRACE_SECONDS to do so."""
+    if job is None and os.name != "nt":
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            return
+        try:
+            await asyncio.wait_for(exited.wait(), _KILL_GRACE_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+    # Also the processes that outlived the processor.
+    _kill_process_tree(pid, job)
+
+class ProcessResult(typing.NamedTuple):
+    name: str
+    returncode: int
+    started: float # As returned by time.time().
+    seconds: float
+    usage: dict # Like the resources in TelemetryRecord.
+    # Why the processor was killed, empty if it exited by itself.
+    killed_reason: str = ""
+
+# How much of the output of a processor is read at a time.
+_PIPE_CHUNK_SIZE = 64 << 10
+
+def _split_arguments(arguments: str) -> list[str]:
+    """Splits the arguments like a POSIX shell would, quotes included, but
+    without expanding or redirecting anything, since no shell is involved. On
+    Windows the backslashes separate directories and are kept as they are, so
+    that what comes out is what subprocess.list2cmdline puts back together."""
+    lexer = shlex.shlex(arguments, posix=True)
+    lexer.whitespace_split = True
+    lexer.commenters = ""
+    if os.name == "nt":
+        lexer.escape = ""
+    return list(lexer)
+
+def _processor_command(file_path: str, arguments: str) -> list[str]:
+    # Outside of Windows there is no py launcher, so the scripts are run with
+    # the same interpreter of the orchestrator (this is useful for testing).
+    python = "py" if os.name == "nt" else sys.executable
+    exe = [file_path] if file_path.endswith(".exe") \
+        else [python, file_path] if file_path.endswith(".py") \
         else None
 
     if exe is None:
         raise ValueError(f"only python and exe files are supported, "
             f"{file_path} is not supported")
 
-    working_dir, _, _ = file_path.rpartition('\\')
+    return exe + _split_arguments(arguments)
+
+def _command_line(command: list[str]) -> str:
+    """The command as it would be typed, for the logs."""
+    return subprocess.list2cmdline(command) if os.name == "nt" else shlex.join(command)
+
+class _ProcessorProtocol(asyncio.SubprocessProtocol):
+    """Queues the output of a processor, that ends with b"", and tells when it
+    exits. Unlike with asyncio.subprocess.Process, the exit can be waited
+    without waiting also for the pipe to be closed, that the processes that
+    survived the processor can keep open."""
+
+    def __init__(self) -> None:
+        self.output: asyncio.Queue[bytes] = asyncio.Queue()
+        self.exited = asyncio.Event()
+
+    def pipe_data_received(self, fd: int, data: bytes) -> None:
+        self.output.put_nowait(data)
+
+    def pipe_connection_lost(self, fd: int, exc: typing.Optional[Exception]) -> None:
+        self.output.put_nowait(b"")
+
+    def process_exited(self) -> None:
+        self.exited.set()
+
+async def _pump_output(output: asyncio.Queue[bytes], name: str,
+    track: str = "", on_output: typing.Optional[typing.Callable[[], None]] = None
+    ) -> None:
+    """Logs the lines in the output, tagged with name, as soon as they are
+    complete. The long pauses in the output, also the one before the end, are
+    added to the trace in track and on_output is called every time something is
+    read."""
+    decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False))("replace")
+    pending = ""
+    last_output = time.time()
+    while chunk := await output.get():
+        if on_output is not None:
+            on_output()
+        now = time.time()
+        if now - last_output > _STALL_SECONDS:
+            _add_trace_event("no output", "stall", last_output, now - last_output, track)
+        last_output = now
+        pending += decoder.decode(chunk)
+        lines, sep, pending = pending.rpartition("\n")
+        if sep:
+            # One record for all the lines in the chunk is much cheaper than one
+            # for each line.
+            logger.info("\n".join(f"{name}: {line.rstrip()}"
+                for line in lines.split("\n")))
+        # TODO: Sometimes the output seems to stop in the console
+        # until you press enter it is the so called "mark mode" and
+        # it can be programmatically detected and disabled. For now the
+        # processor_stall_timeouts setting at least kills the stuck processor.
+        # https://stackoverflow.com/questions/13599822/command-prompt-gets-stuck-and-continues-on-enter-key-press
+        # https://stackoverflow.com/questions/41409727/turn-off-windows-10-console-mark-mode-from-my-application
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        logger.info(f"{name}: {pending.rstrip()}")
+    now = time.time()
+    if now - last_output > _STALL_SECONDS:
+        _add_trace_event("no output", "stall", last_output, now - last_output, track)
+
+async def run_processor_async(file_path: str, arguments: str, name: str = "",
+    timeout: float = 0, stall_timeout: float = 0) -> ProcessResult:
+    """Runs the processor logging its stdout and stderr. Since it does not block
+    many processors can be run at the same time, e.g. with asyncio.gather. The
+    lines are tagged with name (the name of the executable by default).
+
+    The processor, with all the processes that it started, is killed if it runs
+    for more than timeout seconds, if it does not write anything for
+    stall_timeout seconds (0 disables them) or if the orchestration is
+    cancelled."""
+    command = _processor_command(file_path, arguments)
+    cmd_with_args = _command_line(command)
+    working_dir, exe_name = os.path.split(file_path)
+    name = name or os.path.splitext(exe_name)[0]
+
+    logger.info(f"launching '{cmd_with_args}'")
+    started = time.time()
+    start_counter = time.perf_counter()
+    # There is no shell in between: the arguments cannot run anything else and
+    # the pid is the one of the processor. stderr goes in the same pipe of
+    # stdout, so that their lines are logged in the order in which they were
+    # written.
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.subprocess_exec(
+        _ProcessorProtocol,
+        *command,
+        stdin=None,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        cwd=working_dir or None,
+        # So that the processes that it starts can be killed with it.
+        start_new_session=os.name != "nt",
+        # So that it cannot start any process before it is in its job.
+        creationflags=CREATE_SUSPENDED if os.name == "nt" else 0
+    )
+    pid = transport.get_pid()
+    # Processors with the same name that run at the same time (like the shards
+    # of L1B) get a track each.
+    track = f"{name} {pid}"
+    _add_trace_event("launch", "processor", started,
+        time.perf_counter() - start_counter, track)
+
+    job = None
+    sampler = None
+    try:
+        if os.name == "nt":
+            job = _create_job_for_process(pid)
+        elif os.path.isdir("/proc"):
+            sampler = _ProcessTreeSampler(pid)
+    except OSError:
+        logger.warning(f"unable to measure the resources used by {name}")
+    if os.name == "nt":
+        try:
+            _resume_process(pid)
+        except OSError:
+            transport.close()
+            raise
+
+    async def sample() -> None:
+        assert sampler is not None # Just for mypy.
+        while True:
+            # Reading /proc blocks, and the output has to be pumped meanwhile.
+            await loop.run_in_executor(None, sampler.sample)
+            await asyncio.sleep(_PROC_SAMPLING_INTERVAL)
+
+    cancel = _cancel_event.get()
+    last_output = time.monotonic()
+    killed_reason = ""
+    def on_output() -> None:
+        nonlocal last_output
+        last_output = time.monotonic()
+    async def watchdog() -> None:
+        nonlocal killed_reason
+        while True:
+            await asyncio.sleep(_WATCHDOG_INTERVAL)
+            if cancel is not None and cancel.is_set():
+                killed_reason = "the orchestration has been cancelled"
+            elif timeout and time.perf_counter() - start_counter > timeout:
+                killed_reason = f"it ran for more than {timeout:g} seconds"
+            elif stall_timeout and time.monotonic() - last_output > stall_timeout:
+                killed_reason = f"it wrote nothing for {stall_timeout:g} seconds"
+            else:
+                continue
+            logger.warning(f"killing {name} because {killed_reason}")
+            await _terminate_process_tree(pid, job, protocol.exited)
+            return
+
+    sampling = asyncio.create_task(sample()) if sampler is not None else None
+    pumping = asyncio.create_task(_pump_output(protocol.output, name, track, on_output))
+    watching = asyncio.create_task(watchdog()) \
+        if cancel is not None or timeout or stall_timeout else None
+    try:
+        await protocol.exited.wait()
+        # The processes that survived the processor (e.g. the ones in a session
+        # of their own, or on Windows those that are not in the job) may keep
+        # the pipe open: their output is waited for at most as long.
+        try:
+            await asyncio.wait_for(asyncio.shield(pumping), _KILL_GRACE_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning(f"some processes started by {name} are still "
+                f"running, their output is ignored")
+            transport.close()
+            await pumping
+    except BaseException:
+        # For example on KeyboardInterrupt, since in its own session the
+        # processor does not get it.
+        _kill_process_tree(pid, job)
+        pumping.cancel()
+        if watching is not None:
+            watching.cancel()
+        raise
+    finally:
+        if sampling is not None:
+            sampling.cancel()
+        transport.close()
+    returncode = transport.get_returncode()
+    assert returncode is not None # Just for mypy.
+    if watching is not None:
+        # If it is killing the processor it has to finish, so that the processes
+        # that outlived it are killed too.
+        if killed_reason:
+            await watching
+        else:
+            watching.cancel()
+    seconds = time.perf_counter() - start_counter
+
+    usage = _NO_USAGE
+    if job is not None:
+        try:
+            usage = _job_usage(job)
+        except OSError:
+            logger.warning(f"unable to measure the resources used by {name}")
+        finally:
+            _kernel32.CloseHandle(job)
+    elif sampler is not None:
+        usage = sampler.usage()
+    _add_telemetry(typing.cast(TelemetryRecord, {
+        "name": name,
+        "kind": "processor",
+        "started": started,
+        "wall_seconds": seconds,
+        **usage,
+        "returncode": returncode,
+        "killed_reason": killed_reason or None,
+    }))
+    _add_trace_event(name, "processor", started, seconds, track,
+        {"command": cmd_with_args, "returncode": returncode}
+        | ({"killed_reason": killed_reason} if killed_reason else {}))
+    return ProcessResult(name, returncode, started, seconds, usage, killed_reason)
+
+# The timeout and the stall timeout of the executables of the orchestration,
+# set by run() from the configuration and the settings.
+_processor_timeouts: contextvars.ContextVar[dict[str, tuple[float, float]]] = \
+    contextvars.ContextVar("processor_timeouts", default={})
+
+def _timeouts_of_executables(conf: list[str], settings: Settings
+    ) -> dict[str, tuple[float, float]]:
+    return {
+        conf[option]: (settings["processor_timeouts"].get(option.name, 0),
+            settings["processor_stall_timeouts"].get(option.name, 0))
+        for option in Conf if CONF_KINDS[option] == ConfKind.EXE
+    }
 
-    # We expect %COMSPEC% to be cmd.exe or something like that.
+def _run_processor(file_path: str, arguments: str) -> None:
+    timeout, stall_timeout = _processor_timeouts.get().get(file_path, (0, 0))
     try:
-        cmd_with_args = f"{exe} {arguments}"
-        logger.info(f"launching '{cmd_with_args}'")
-        # NOTE: should I worry about 'universal_newlines'?
-        with subprocess.Popen(
-            args=cmd_with_args,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            cwd=working_dir,
-            text=True
-            ) as p:
-            assert p.stdout is not None # Just for mypy.
-            for line in p.stdout:
-                # Since in io.TextIOBase lines are split on '\n' if there are
-                # any \r in the sequence we just ignore it.
-                logger.info(line.rstrip())
-                # TODO: Sometimes the output seems to stop in the console
-                # until you press enter it is the so called "mark mode" and
-                # it can be programmatically detected and disabled.
-                # https://stackoverflow.com/questions/13599822/command-prompt-gets-stuck-and-continues-on-enter-key-press
-                # https://stackoverflow.com/questions/41409727/turn-off-windows-10-console-mark-mode-from-my-application
-
-            if p.wait() != 0:
-                raise ChildProcessError(f"{file_path} exited with error code {p.returncode}")
+        res = asyncio.run(run_processor_async(file_path, arguments,
+            timeout=timeout, stall_timeout=stall_timeout))
+        logger.info(f"{file_path} exited with code {res.returncode} after "
+            f"{res.seconds:.1f} seconds")
+        if res.killed_reason:
+            raise ChildProcessError(f"{file_path} was killed because "
+                f"{res.killed_reason}")
+        if res.returncode != 0:
+            raise ChildProcessError(f"{file_path} exited with error code {res.returncode}")
     except Exception as ex:
         raise Exception(f"something went wrong during the execution of "
             f"{file_path}") from ex
 
-def _check_existence_of_netcdf_file(start_dir: str):
+# The signatures of NetCDF-4 (that is HDF5) and of the classic, 64-bit offset
+# and CDF-5 NetCDF files.
+NETCDF_MAGICS = [b"\x89HDF\r\n\x1a\n", b"CDF\x01", b"CDF\x02", b"CDF\x05"]
+# HDF5 files can have a user block before the superblock, in which case the
+# signature is at one of these offsets.
+_HDF5_MAGIC_OFFSETS = [0, 512, 1024, 2048]
+_window_path_format = re.compile(r"(?:^|/)([0-9]{4}-[0-9]{2})/([0-9]{2})/(H[0-9]{2})(?:/|$)")
+
+class NetcdfReport(typing.NamedTuple):
+    files: int # The valid ones.
+    bytes: int
+    empty: list[str] # Paths relative to the directory that was checked.
+    invalid: list[str]
+    # The windows that have no valid file, only for trees organized by window.
+    windows_without_output: list[tuple[str, str]]
+
+    def summary(self, max_examples: int = 5) -> str:
+        def examples(paths: list) -> str:
+            shown = ", ".join(" ".join(path) if isinstance(path, tuple) else path
+                for path in paths[:max_examples])
+            return shown + (", ..." if len(paths) > max_examples else "")
+        res = f"{self.files} NetCDF files ({self.bytes >> 20} MB)"
+        if self.empty:
+            res += f"; {len(self.empty)} empty: {examples(self.empty)}"
+        if self.invalid:
+            res += f"; {len(self.invalid)} not NetCDF: {examples(self.invalid)}"
+        if self.windows_without_output:
+            res += f"; {len(self.windows_without_output)} windows without " \
+                f"output: {examples(self.windows_without_output)}"
+        return res
+
+def _netcdf_file_problem(path: str) -> tuple[str, int]:
+    """Returns "empty", "invalid" or "" if the file looks like a NetCDF file,
+    and its size."""
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return "empty", size
+        head = f.read(8)
+        if any(head.startswith(magic) for magic in NETCDF_MAGICS):
+            return "", size
+        for offset in _HDF5_MAGIC_OFFSETS[1:]:
+            if offset + 8 > size:
+                break
+            f.seek(offset)
+            if f.read(8) == NETCDF_MAGICS[0]:
+                return "", size
+    return "invalid", size
+
+def _validate_netcdf_output(start_dir: str,
+    windows: typing.Optional[list[tuple[str, str]]] = None,
+    workers: int = 0) -> NetcdfReport:
+    """Checks all the .nc files in start_dir, workers at a time (0 means the
+    default of concurrent.futures.ThreadPoolExecutor). If windows is given and
+    the files are in YYYY-MM/DD/Hxx directories every window must have at least
+    one valid file. Raises ChildProcessError with a summary of the problems."""
+    paths = []
     walker = os.walk(
         start_dir,
         onerror=lambda ex: logger.exception("an error occured while traversing"
             f"'{ex.filename}' we ignore it and keep going"))
     for dirpath, dirnames, filenames in walker:
-        if any(filename.endswith(".nc") for filename in filenames):
-            return
+        paths.extend(os.path.join(dirpath, filename)
+            for filename in filenames if filename.endswith(".nc"))
+    if not paths:
+        raise ChildProcessError(f"no NetCDF file generated in '{start_dir}'")
+
+    with concurrent.futures.ThreadPoolExecutor(workers or None) as executor:
+        problems = list(executor.map(_netcdf_file_problem, paths))
+
+    files, size, empty, invalid = 0, 0, [], []
+    windows_with_output = set()
+    by_window = False
+    for path, (problem, file_size) in zip(paths, problems):
+        relative_path = os.path.relpath(path, start_dir).replace(os.sep, "/")
+        if problem == "empty":
+            empty.append(relative_path)
+        elif problem == "invalid":
+            invalid.append(relative_path)
+        else:
+            files += 1
+            size += file_size
+        if match := _window_path_format.search(relative_path):
+            by_window = True
+            if not problem:
+                windows_with_output.add((f"{match[1]}-{match[2]}", match[3]))
+    windows_without_output = [window for window in windows or []
+        if window not in windows_with_output] if by_window else []
+
+    report = NetcdfReport(files, size, sorted(empty), sorted(invalid),
+        windows_without_output)
+    if empty or invalid or windows_without_output or not files:
+        raise ChildProcessError(f"invalid NetCDF output in '{start_dir}': "
+            f"{report.summary()}")
+    logger.info(f"{start_dir}: {report.summary()}")
+    return report
+
+# The coverage of a simulation is the list of the six hours windows in
+# L1A_L1B/YYYY-MM/DD/Hxx with how many files and bytes they have. It is made in
+# a single pass over the directory tree when the output of L1A is promoted (or
+# on demand for restored backups) and saved in DataRelease, so that the dates of
+# the simulation and the windows without data are known without listing the
+# directories on the NAS again.
+
+COVERAGE_FILE = "orchestrator_coverage.json"
+COVERAGE_VERSION = 1
+COVERAGE_HOURS = ["H00", "H06", "H12", "H18"]
+
+class CoverageWindow(typing.TypedDict):
+    date: str # Like 2021-12-31.
+    hour: str # One of COVERAGE_HOURS.
+    files: int
+    bytes: int
+
+class Coverage(typing.TypedDict):
+    version: int
+    windows: list[CoverageWindow] # In chronological order.
+    # The windows between the first and the last one that have no directory or
+    # no files in it, as [date, hour].
+    missing: list[list[str]]
+
+def _build_coverage(l1a_l1b_dir: str) -> Coverage:
+    year_month_format = re.compile("^[0-9]{4}-[0-9]{2}$")
+    day_format = re.compile("^[0-9]{2}$")
+
+    def tree_size(path: str) -> tuple[int, int]:
+        files, size = 0, 0
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    sub_files, sub_size = tree_size(entry.path)
+                    files += sub_files
+                    size += sub_size
+                else:
+                    files += 1
+                    size += entry.stat().st_size
+        return files, size
 
-    raise ChildProcessError(f"no NetCDF file generated in '{start_dir}'")
+    windows: list[CoverageWindow] = []
+    for year_month in sorted(os.listdir(l1a_l1b_dir)):
+        if not year_month_format.search(year_month):
+            raise Exception("there are files which are not directories of year and month of the data")
+        year_month_dir = os.path.join(l1a_l1b_dir, year_month)
+        days = sorted(os.listdir(year_month_dir))
+        if not all(day_format.search(day) for day in days):
+            raise Exception(f"there are files which are not named as days in {year_month}")
+        for day in days:
+            hours = sorted(os.listdir(os.path.join(year_month_dir, day)))
+            if not all(hour in COVERAGE_HOURS for hour in hours):
+                raise Exception(f"there are directories that have incorrect hour names in {hours}")
+            for hour in hours:
+                files, size = tree_size(os.path.join(year_month_dir, day, hour))
+                windows.append({"date": f"{year_month}-{day}", "hour": hour,
+                    "files": files, "bytes": size})
+    if not windows:
+        raise Exception(f"there is no data in {l1a_l1b_dir}")
+
+    with_data = {(window["date"], window["hour"]) for window in windows if window["files"]}
+    missing = []
+    step = datetime.timedelta(hours=6)
+    first = datetime.datetime.strptime(f"{windows[0]['date']} {windows[0]['hour'][1:]}", "%Y-%m-%d %H")
+    last = datetime.datetime.strptime(f"{windows[-1]['date']} {windows[-1]['hour'][1:]}", "%Y-%m-%d %H")
+    while first <= last:
+        window = [first.strftime("%Y-%m-%d"), f"H{first.hour:02}"]
+        if tuple(window) not in with_data:
+            missing.append(window)
+        first += step
+
+    return {"version": COVERAGE_VERSION, "windows": windows, "missing": missing}
+
+def _write_coverage(data_release_dir: str, coverage: Coverage) -> None:
+    _write_json_atomically(os.path.join(data_release_dir, COVERAGE_FILE), coverage)
+
+def _coverage(data_release_dir: str) -> Coverage:
+    """Reads the coverage of the simulation in DataRelease, making it if it is
+    not there."""
+    try:
+        with open(os.path.join(data_release_dir, COVERAGE_FILE)) as f:
+            coverage = json.load(f)
+        if coverage.get("version") == COVERAGE_VERSION:
+            return coverage
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+    coverage = _build_coverage(os.path.join(data_release_dir, PROC_OUTPUT_DIRS[Proc.L1A]))
+    _write_coverage(data_release_dir, coverage)
+    return coverage
+
+def _dates_of_coverage(coverage: Coverage) -> tuple[str, str, str, str]:
+    """Returns the start date, start hour, end date and end hour of the
+    simulation."""
+    first, last = coverage["windows"][0], coverage["windows"][-1]
+    return first["date"], first["hour"], last["date"], last["hour"]
+
+def _windows_with_data(coverage: Coverage) -> list[tuple[str, str]]:
+    return [(window["date"], window["hour"]) for window in coverage["windows"]
+        if window["files"]]
+
+def _detect_dates(l1a_l1b_dir: str) -> tuple[str, str, str, str]:
+    """Returns the start date, start hour, end date and end hour of the
+    simulation from the names of the directories in L1A_L1B."""
+    return _dates_of_coverage(_build_coverage(l1a_l1b_dir))
+
+def _l1b_date_time(date: str, hour: str) -> str:
+    """Converts a date like 2021-12-12 and an hour like H06 in the format
+    expected by L1B, i.e. 20211212T06:00:00."""
+    return f"{date.replace('-','')}T{hour[1:]}:00:00"
+
+def _l1b_arguments(config_file: str, start_date_time: str, stop_date_time: str) -> str:
+    # config=C:\L1BOP\conf\hgdevConfiguration0p7_ReadL1a.xml,StartDateTime=20211212T00:00:00,StopDateTime=20211212T06:00:00
+    return f"\"config={config_file}," \
+        f"StartDateTime={start_date_time}," \
+        f"StopDateTime={stop_date_time}\""
+
+def _l1b_windows(l1a_l1b_dir: str) -> list[tuple[str, str]]:
+    """Returns, in chronological order, all the (date, hour) windows that have a
+    directory in the L1A_L1B/YYYY-MM/DD/Hxx tree."""
+    return [(window["date"], window["hour"])
+        for window in _build_coverage(l1a_l1b_dir)["windows"]]
+
+def _l1b_shards(windows: list[tuple[str, str]], mode: str) -> list[tuple[str, str]]:
+    """Groups the windows according to the shard mode and returns the
+    StartDateTime and StopDateTime of each shard."""
+    assert mode in L1B_SHARD_MODES and mode
+    if mode == "6h":
+        return [(_l1b_date_time(*window), _l1b_date_time(*window))
+            for window in windows]
+    res = []
+    for date, group in itertools.groupby(windows, key=lambda window: window[0]):
+        hours = [hour for _, hour in group]
+        res.append((_l1b_date_time(date, hours[0]), _l1b_date_time(date, hours[-1])))
+    return res
+
+def _run_l1b_sharded(l1b_exe: str, config_file: str,
+    shards: list[tuple[str, str]], workers: int) -> None:
+    """Runs an instance of L1B for each shard, at most workers at a time. All
+    shards are run even if some of them fail, the failed ones are reported at the
+    end."""
+    assert workers > 0
+
+    logger.info(f"running L1B on {len(shards)} shards with {workers} workers")
+    failed_shards = []
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        future_to_shard = {
+            _submit(executor, _run_processor, l1b_exe,
+                _l1b_arguments(config_file, *shard)): shard
+            for shard in shards
+        }
+        for future in concurrent.futures.as_completed(future_to_shard):
+            start_date_time, stop_date_time = future_to_shard[future]
+            try:
+                future.result()
+            except Exception:
+                logger.exception(f"L1B failed on the shard from "
+                    f"{start_date_time} to {stop_date_time}")
+                failed_shards.append((start_date_time, stop_date_time))
+            else:
+                logger.info(f"L1B finished the shard from {start_date_time} to "
+                    f"{stop_date_time}")
+
+    if failed_shards:
+        failed_shards.sort()
+        raise ChildProcessError(f"L1B failed on {len(failed_shards)} shards out "
+            f"of {len(shards)}: " + ", ".join(f"{start}..{stop}"
+            for start, stop in failed_shards))
+
+def _stages_to_run(start: Proc, ends: list[Proc]) -> list[Stage]:
+    """Returns the stages needed to go from start to all the ends in the order
+    of Stage."""
+    assert ends == sorted(ends)
+    assert start <= ends[-1]
+
+    res = []
+    if start == Proc.L1A:
+        res.append(Stage.L1A)
+    if ends[-1] == Proc.L1A:
+        return res
+    res.append(Stage.DATES)
+    if start <= Proc.L1B:
+        res += [Stage.L1B, Stage.L1B_MM, Stage.L1B_CX, Stage.L1B_CC,
+            Stage.L1B_MM_AGAIN]
+    res += [Stage(STAGE_PROC.index(end)) for end in ends if end > Proc.L1B]
+    return res
+
+def _run_stage_graph(stages: list[Stage],
+    run_stage: typing.Callable[[Stage], None], max_parallel: int,
+    max_parallel_l2: int = 0) -> None:
+    """Runs each stage as soon as the stages that produce its inputs are done,
+    with at most max_parallel stages running at the same time, but the Level-2
+    stages can also start if less than max_parallel_l2 of them are running. If
+    both are 1 (or less) the stages are run one after the other, in the order in
+    which they are given, on the calling thread. When a stage fails no other
+    stage is started, the running ones are waited for and the exception of the
+    first failed stage is raised."""
+    assert max_parallel > 0
+    assert stages == sorted(stages)
+
+    if max_parallel == 1 and max_parallel_l2 <= 1:
+        for stage in stages:
+            run_stage(stage)
+        return
 
-# NOTE: make which_hydrognss an enum?
-def _do_backup_and_pam(start: Proc, end: Proc, conf: list[str],
-    experiment_name: str, which_hydrognss: str, pam: bool) -> None:
+    producer = {output: stage for stage in stages for output in STAGE_OUTPUTS[stage]}
+    dependencies = {
+        stage: {producer[input] for input in STAGE_INPUTS[stage] if input in producer}
+        for stage in stages
+    }
+    pending = list(stages)
+    done: set[Stage] = set()
+    running: dict[concurrent.futures.Future, Stage] = {}
+    failures: list[tuple[Stage, BaseException]] = []
+    is_l2 = lambda stage: STAGE_PROC[stage] >= Proc.L2FB
+    with concurrent.futures.ThreadPoolExecutor(max_parallel + max_parallel_l2) as executor:
+        while pending or running:
+            if not failures:
+                for stage in list(pending):
+                    if len(running) >= max_parallel and not (is_l2(stage)
+                        and sum(map(is_l2, running.values())) < max_parallel_l2):
+                        continue
+                    if dependencies[stage] <= done:
+                        pending.remove(stage)
+                        running[_submit(executor, run_stage, stage)] = stage
+            if not running:
+                break
+            finished, _ = concurrent.futures.wait(running,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                ex = future.exception()
+                if ex is None:
+                    done.add(stage)
+                else:
+                    logger.error(f"the stage {stage.name} failed")
+                    failures.append((stage, ex))
+
+    if failures:
+        if len(failures) > 1:
+            logger.error("also the stages " + ", ".join(stage.name
+                for stage, _ in failures[1:]) + " failed")
+        raise failures[0][1]
+    assert not pending, "there is a cycle in the stages"
+
+# Journal ######################################################################
+
+# The journal records the stages of an orchestration as they end, so that an
+# orchestration that failed can be resumed from where it stopped. It is kept in
+# DataRelease, next to the data that it describes.
+
+JOURNAL_FILE = "orchestrator_journal.json"
+JOURNAL_VERSION = 1
+
+class JournalStage(typing.TypedDict):
+    status: str # Either "finished" or "failed".
+    started: float # As returned by time.time().
+    ended: float
+    inputs: list[str] # Paths relative to DataRelease.
+    outputs: list[str]
+    # For the stages in _STAGES_IN_FILLED_DIRS, the _dir_summary of the
+    # directories that they share with the earlier stages when they ended, empty
+    # for the others. Missing in the journals written before it was added.
+    dir_summaries: dict[str, list[int]]
+    error: str
+
+class Journal(typing.TypedDict):
+    version: int
+    experiment_name: str
+    which_hydrognss: str
+    start: str
+    ends: list[str]
+    pam: bool
+    log_level: str
+    # Start date, start hour, end date and end hour, once detected.
+    dates: list[str]
+    stages: dict[str, JournalStage]
+    backup: str
 
-    assert start <= end
-    assert _experiment_name_format.search(experiment_name)
-    assert which_hydrognss == "HydroGNSS-1" or which_hydrognss == "HydroGNSS-2"
+def _new_journal(args: Args) -> Journal:
+    return {
+        "version": JOURNAL_VERSION,
+        "experiment_name": "",
+        "which_hydrognss": "",
+        "start": args["start"].name,
+        "ends": [end.name for end in _ends(args)],
+        "pam": args["pam"],
+        "log_level": args["log_level"].name,
+        "dates": [],
+        "stages": {},
+        "backup": "",
+    }
+
+def _read_journal(data_release_dir: str) -> Journal:
+    with open(os.path.join(data_release_dir, JOURNAL_FILE)) as f:
+        journal = json.load(f)
+    if journal.get("version") != JOURNAL_VERSION:
+        raise ValueError(f"unsupported journal version {journal.get('version')}")
+    return journal
+
+def _find_journal(data_dir: str) -> Journal:
+    """Reads the journal of the orchestration in data_dir."""
+    for which_hydrognss in ["HydroGNSS-1", "HydroGNSS-2"]:
+        data_release_dir = os.path.join(data_dir, which_hydrognss, "DataRelease")
+        if os.path.exists(os.path.join(data_release_dir, JOURNAL_FILE)):
+            return _read_journal(data_release_dir)
+    raise FileNotFoundError(f"no journal in {data_dir}")
+
+def _args_from_journal(journal: Journal) -> Args:
+    start = Proc[journal["start"]]
+    end, extra_ends = _split_ends(start, [Proc[end] for end in journal["ends"]])
+    return {
+        "start": start,
+        "end": end,
+        "pam": journal["pam"],
+        "backup": "",
+        "log_level": LogLevel[journal["log_level"]],
+        "extra_ends": extra_ends,
+    }
+
+def _filled_dirs(stage: Stage) -> list[str]:
+    """The directories (relative to DataRelease) in which the stage writes that
+    an earlier stage already filled."""
+    return sorted({ARTIFACT_PATHS[output] for output in STAGE_OUTPUTS[stage]}
+        & {ARTIFACT_PATHS[output] for earlier in Stage if earlier < stage
+            for output in STAGE_OUTPUTS[earlier]})
+
+# The stages whose output cannot be told apart from the one of the earlier
+# stages (the whole chain of L1B writes in L1A_L1B, which L1A fills anyway).
+# Listing the files that each of them writes would mean walking L1A_L1B before
+# and after each of them, so the journal records only a summary of the
+# directory when they end: if the directory did not change since the last of
+# them ended their output is still there, otherwise they are all run again.
+_STAGES_IN_FILLED_DIRS = {stage for stage in Stage if _filled_dirs(stage)}
+
+def _dir_summary(path: str) -> list[int]:
+    """The number of files in the directory tree, their bytes and the newest
+    modification time (0 if there are none). os.scandir gets them while
+    listing the directories, at least on Windows."""
+    files = size = newest = 0
+    to_scan = [path]
+    while to_scan:
+        try:
+            with os.scandir(to_scan.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        to_scan.append(entry.path)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        files += 1
+                        size += stat.st_size
+                        newest = max(newest, stat.st_mtime_ns)
+        except FileNotFoundError:
+            pass
+    return [files, size, newest]
+
+def _unchanged_filled_dirs(data_release_dir: str, journal: Journal) -> set[str]:
+    """The directories that did not change since the last stage that recorded
+    their summary, either finished or failed, ended."""
+    last_summaries = {}
+    for entry in sorted(journal["stages"].values(), key=lambda entry: entry["ended"]):
+        last_summaries.update(entry.get("dir_summaries", {}))
+    return {path for path, summary in last_summaries.items()
+        if _dir_summary(os.path.join(data_release_dir, path)) == summary}
+
+def _stage_output_on_disk(data_release_dir: str, stage: Stage,
+    unchanged_dirs: set[str]) -> bool:
+    """Checks that what the stage produced is still there. The output of the
+    stages in _STAGES_IN_FILLED_DIRS is considered gone if their directories
+    changed (or with a journal without their summaries)."""
+    if not set(_filled_dirs(stage)) <= unchanged_dirs:
+        return False
+    for output in STAGE_OUTPUTS[stage]:
+        try:
+            _validate_netcdf_output(os.path.join(data_release_dir,
+                ARTIFACT_PATHS[output]))
+        except ChildProcessError:
+            return False
+    return True
 
-    timestamp = f"{int(time.time())}"
-    assert len(timestamp) == 10
-    backup_name = f"{experiment_name}_{timestamp}"
+def _stages_to_resume(stages: list[Stage], journal: Journal,
+    data_release_dir: str) -> list[Stage]:
+    """The stages that have to be run again: the ones that did not finish (or
+    whose output is gone) and the ones that depend on them."""
+    redone_outputs: set[str] = set()
+    unchanged_dirs = _unchanged_filled_dirs(data_release_dir, journal)
+    res = []
+    for stage in stages: # Stage is in topological order.
+        entry = journal["stages"].get(stage.name)
+        done = entry is not None and entry["status"] == "finished" \
+            and _stage_output_on_disk(data_release_dir, stage, unchanged_dirs) \
+            and (stage != Stage.DATES or len(journal["dates"]) == 4)
+        if done and not redone_outputs.intersection(STAGE_INPUTS[stage]):
+            continue
+        res.append(stage)
+        redone_outputs.update(STAGE_OUTPUTS[stage])
+    return res
+
+def _write_journal(data_release_dir: str, journal: Journal) -> None:
+    """Writes the journal making sure that it is on disk, so that it survives
+    crashes."""
+    path = os.path.join(data_release_dir, JOURNAL_FILE)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(journal, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+_pam_lock = threading.Lock()
+
+def _do_pam(start: Proc, ends: list[Proc], conf: list[str],
+    backup_name: str, which_hydrognss: str,
+    settings: Settings = SETTINGS_DEFAULT) -> None:
+    """Runs the PAM (and the compare tool if L1B was executed) on the backup and
+    adds their outputs to it."""
     backup_path_noext = os.path.join(conf[Conf.BACKUP_DIR], backup_name)
-    logger.info("doing the backup")
     data_dir = conf[Conf.DATA_DIR]
-    try:
-        shutil.make_archive(backup_path_noext, "zip", data_dir, which_hydrognss)
-    except Exception as ex:
-        raise Exception("unable to make backup archive") from ex
-    if pam:
-        logger.info("running the PAM")
-        auxiliary_data_dir = os.path.join(data_dir, "Auxiliary_Data")
-        _run_processor(
-            conf[Conf.PAM_EXE],
-            f"{PROC_NAMES_PAM[end]} {auxiliary_data_dir} "
-            f"{conf[Conf.BACKUP_DIR]} {backup_name}"
-        )
+    auxiliary_data_dir = os.path.join(data_dir, "Auxiliary_Data")
+    pam_output = os.path.join(conf[Conf.BACKUP_DIR], "PAM_Output")
+    for end in ends:
+        logger.info(f"running the PAM for {end.name}")
+        with _TraceSpan(f"PAM {end.name}", "pam"):
+            _run_processor(
+                conf[Conf.PAM_EXE],
+                f"{PROC_NAMES_PAM[end]} {auxiliary_data_dir} "
+                f"{conf[Conf.BACKUP_DIR]} {backup_name}"
+            )
 
-        pam_output = os.path.join(conf[Conf.BACKUP_DIR], "PAM_Output")
+        # When the PAM is run more than once each output goes in its own
+        # directory, to not mix them up.
+        pam_output_in_backup = f"{which_hydrognss}/DataRelease/PAM_Output" \
+            if len(ends) == 1 \
+            else f"{which_hydrognss}/DataRelease/PAM_Output/{PROC_NAMES_PAM[end]}"
         try:
-            with zipfile.ZipFile(f"{backup_path_noext}.zip", 'a') as zipf:
+            with _TraceSpan("add the PAM output to the backup"), \
+                zipfile.ZipFile(f"{backup_path_noext}.zip", 'a') as zipf:
                 for file in os.listdir(pam_output):
                     file_path = os.path.join(pam_output, file)
-                    zipf.write(file_path, f"{which_hydrognss}\\DataRelease\\PAM_Output\\{file}")
+                    zipf.write(file_path, f"{pam_output_in_backup}/{file}")
         except Exception as ex:
             raise Exception("unable to add the PAM output figures to the "
                 "backup") from ex
-        _recycle(pam_output)
-
-        if start <= Proc.L1B <= end: # If L1B was executed.
-            logger.info("running the compare tool")
-            # Wee peel of two files from the L1B executable path.
-            should_be_bin, _, _ = conf[Conf.L1B_EXE].rpartition("\\")
-            should_be_L1B, _, _ = should_be_bin.rpartition("\\")
-            compare_L1B_exe: typing.Union[list[str], str] = glob.glob('**/compareL1B.exe',
-                root_dir=should_be_L1B, recursive=True)
-            if len(compare_L1B_exe) != 1:
-                logger.info("skipping compare L1B because too many were found {compare_L1B_exe}")
-                return
-            compare_L1B_exe = compare_L1B_exe[0]
-            compare_L1B_exe = os.path.join(should_be_L1B, compare_L1B_exe)
-            if not os.path.isfile(compare_L1B_exe):
-                logger.info("skipping compare L1B because it was not found")
-                return
+        with _TraceSpan("clean up"):
+            _clean_up(pam_output, settings)
+
+    if start <= Proc.L1B <= ends[-1]: # If L1B was executed.
+        logger.info("running the compare tool")
+        # Wee peel of two files from the L1B executable path.
+        should_be_bin = os.path.dirname(conf[Conf.L1B_EXE])
+        should_be_L1B = os.path.dirname(should_be_bin)
+        compare_L1B_exe: typing.Union[list[str], str] = glob.glob('**/compareL1B.exe',
+            root_dir=should_be_L1B, recursive=True)
+        if len(compare_L1B_exe) != 1:
+            logger.info("skipping compare L1B because too many were found {compare_L1B_exe}")
+            return
+        compare_L1B_exe = compare_L1B_exe[0]
+        compare_L1B_exe = os.path.join(should_be_L1B, compare_L1B_exe)
+        if not os.path.isfile(compare_L1B_exe):
+            logger.info("skipping compare L1B because it was not found")
+            return
+        with _TraceSpan("compare tool", "pam"):
             _run_processor(
                 compare_L1B_exe,
                 f"{backup_path_noext}.zip"
             )
-            compare_tool_out_path = os.path.join(f"{conf[Conf.BACKUP_DIR]}",
-                    "compareL1B_output")
-            # As far as we understand there can either be SSTLplots_1_RR and
-            # SSTLplots_1_LR or the previous two with SSTLplots_5_RR and
-            # SSTLplots_5_LR. We are not so sure about this so the code
-            # looks like this (we do not really now what to consider an
-            # error condition or not.)
-            with zipfile.ZipFile(f"{backup_path_noext}.zip", 'a') as zipf:
-                for i in ['1', '5']:
-                    RR_plots_dir = os.path.join(compare_tool_out_path,
-                        f"{backup_name}_SSTLplots_{i}_RR")
-                    LR_plots_dir = os.path.join(compare_tool_out_path,
-                        f"{backup_name}_SSTLplots_{i}_LR")
-                    try:
-                        for file in os.listdir(RR_plots_dir):
-                            file_path = os.path.join(RR_plots_dir, file)
-                            zipf.write(file_path, f"{which_hydrognss}\\DataRelease\\SSTLplots_{i}_RR\\{file}")
-                    except FileNotFoundError:
-                        if i == '1':
-                            logger.exception("an error occurred while putting RR in the backup")
-                    try:
-                        for file in os.listdir(LR_plots_dir):
-                            file_path = os.path.join(LR_plots_dir, file)
-                            zipf.write(file_path, f"{which_hydrognss}\\DataRelease\\SSTLplots_{i}_LR\\{file}")
-                    except FileNotFoundError:
-                        if i == '1':
-                            logger.exception("an error occurred while putting LR in the backup")
-            _recycle(compare_tool_out_path)
+        compare_tool_out_path = os.path.join(f"{conf[Conf.BACKUP_DIR]}",
+                "compareL1B_output")
+        # As far as we understand there can either be SSTLplots_1_RR and
+        # SSTLplots_1_LR or the previous two with SSTLplots_5_RR and
+        # SSTLplots_5_LR. We are not so sure about this so the code
+        # looks like this (we do not really now what to consider an
+        # error condition or not.)
+        with _TraceSpan("add the compare tool output to the backup"), \
+            zipfile.ZipFile(f"{backup_path_noext}.zip", 'a') as zipf:
+            for i in ['1', '5']:
+                RR_plots_dir = os.path.join(compare_tool_out_path,
+                    f"{backup_name}_SSTLplots_{i}_RR")
+                LR_plots_dir = os.path.join(compare_tool_out_path,
+                    f"{backup_name}_SSTLplots_{i}_LR")
+                try:
+                    for file in os.listdir(RR_plots_dir):
+                        file_path = os.path.join(RR_plots_dir, file)
+                        zipf.write(file_path, f"{which_hydrognss}/DataRelease/SSTLplots_{i}_RR/{file}")
+                except FileNotFoundError:
+                    if i == '1':
+                        logger.exception("an error occurred while putting RR in the backup")
+                try:
+                    for file in os.listdir(LR_plots_dir):
+                        file_path = os.path.join(LR_plots_dir, file)
+                        zipf.write(file_path, f"{which_hydrognss}/DataRelease/SSTLplots_{i}_LR/{file}")
+                except FileNotFoundError:
+                    if i == '1':
+                        logger.exception("an error occurred while putting LR in the backup")
+        with _TraceSpan("clean up"):
+            _clean_up(compare_tool_out_path, settings)
+
+# Cleanup ######################################################################
+
+# Deleting (or recycling) big directories can take minutes, so instead they are
+# renamed in a trash directory next to them, which is on the same volume and
+# therefore makes the rename instantaneous, and deleted by a background thread.
+# The trash is bounded: when what is waiting to be deleted is more than
+# trash_size_mb the cleanups wait for the background thread to catch up. What is
+# left in a trash directory (e.g. because the orchestrator was closed) is deleted
+# the next time something is put in it.
+
+TRASH_DIR = ".orchestrator_trash"
+# How many times the background thread tries to delete something before giving
+# up (until the next time the trash is used) and the seconds between the first
+# two attempts, which are doubled each time.
+_TRASH_ATTEMPTS = 5
+_TRASH_RETRY_SECONDS = 1.0
+
+def _remove(path: str, mode: str) -> None:
+    if mode == "recycle":
+        _recycle(path)
+    elif os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+class _Trash:
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        # Path in the trash, mode and size (None until it is measured).
+        self.pending: collections.deque[list] = collections.deque()
+        self.pending_bytes = 0
+        self.known_dirs: set[str] = set()
+        self.thread: typing.Optional[threading.Thread] = None
+
+    def put(self, path: str, mode: str, max_bytes: int) -> None:
+        """Moves path in the trash, it is then deleted in the background."""
+        trash_dir = os.path.join(os.path.dirname(os.path.abspath(path)), TRASH_DIR)
+        os.makedirs(trash_dir, exist_ok=True)
+        with self.condition:
+            while self.pending_bytes > max_bytes:
+                logger.info("waiting for the trash to be emptied")
+                self.condition.wait()
+            trashed = os.path.join(trash_dir,
+                f"{os.path.basename(path)}_{time.time_ns()}")
+            os.rename(path, trashed)
+            if trash_dir not in self.known_dirs:
+                self.known_dirs.add(trash_dir)
+                # The leftovers of the previous executions.
+                for name in os.listdir(trash_dir):
+                    leftover = os.path.join(trash_dir, name)
+                    if leftover != trashed:
+                        self.pending.append([leftover, mode, None])
+            self.pending.append([trashed, mode, None])
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._work,
+                    name="trash", daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def wait(self) -> None:
+        """Waits for the trash to be emptied."""
+        with self.condition:
+            while self.pending:
+                self.condition.wait()
+
+    def _work(self) -> None:
+        while True:
+            with self.condition:
+                if not self.pending:
+                    self.condition.notify_all()
+                    self.thread = None
+                    return
+                # First the sizes are measured, which is quick compared to
+                # deleting, so that the bound on the trash is respected.
+                unmeasured = next((entry for entry in self.pending
+                    if entry[2] is None), None)
+                entry = unmeasured or self.pending[0]
+            path, mode, size = entry
+            if size is None:
+                try:
+                    size = _dir_size(path) if os.path.isdir(path) else os.path.getsize(path)
+                except OSError:
+                    size = 0
+                with self.condition:
+                    entry[2] = size
+                    self.pending_bytes += size
+                continue
+            for attempt in range(_TRASH_ATTEMPTS):
+                try:
+                    if os.path.lexists(path):
+                        _remove(path, mode)
+                    break
+                except Exception:
+                    if attempt == _TRASH_ATTEMPTS - 1:
+                        logger.exception(f"unable to delete {path}, it is left "
+                            "in the trash")
+                    else:
+                        time.sleep(_TRASH_RETRY_SECONDS*2**attempt)
+            with self.condition:
+                self.pending.remove(entry)
+                self.pending_bytes -= size
+                self.condition.notify_all()
+
+_trash = _Trash()
+# What is still in the trash is deleted before exiting.
+atexit.register(_trash.wait)
+
+def _clean_up(path: str, settings: Settings = SETTINGS_DEFAULT) -> None:
+    """Deletes or recycles path, in the background if background_cleanup."""
+    if settings["background_cleanup"]:
+        try:
+            _trash.put(path, settings["cleanup_mode"],
+                settings["trash_size_mb"] << 20)
+            return
+        except OSError:
+            # For example on Windows when a file in it is open.
+            logger.warning(f"unable to move {path} in the trash, deleting it "
+                "right away", exc_info=True)
+    _remove(path, settings["cleanup_mode"])
+
+# Promotion ####################################################################
+
+# Big files are copied in chunks of this size in parallel.
+_COPY_CHUNK_SIZE = 64 << 20
+
+def _copy_chunk(src: str, dst: str, offset: int, length: int) -> None:
+    with open(src, "rb") as fsrc, open(dst, "r+b") as fdst:
+        fsrc.seek(offset)
+        fdst.seek(offset)
+        while length > 0:
+            chunk = fsrc.read(min(length, 1 << 20))
+            if not chunk:
+                raise EOFError(f"{src} got shorter while copying it")
+            fdst.write(chunk)
+            length -= len(chunk)
+
+def _promote_files(files: list[tuple[str, str]], mode: str, workers: int
+    ) -> tuple[int, int]:
+    """Links, moves or copies each (src, dst) pair of files and checks that the
+    sizes match. Returns how many bytes were linked or moved and how many were
+    copied."""
+    assert mode in PROMOTION_MODES
+
+    sizes = {src: os.path.getsize(src) for src, _ in files}
+    linked_bytes = 0
+    to_copy = []
+    for src, dst in files:
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if mode != "copy":
+            if os.path.exists(dst):
+                os.remove(dst)
+            try:
+                if mode == "link":
+                    os.link(src, dst)
+                else:
+                    os.rename(src, dst)
+                linked_bytes += sizes[src]
+                continue
+            except OSError:
+                # Most likely src and dst are on different volumes.
+                pass
+        to_copy.append((src, dst))
+
+    chunks = []
+    for src, dst in to_copy:
+        with open(dst, "wb") as f:
+            f.truncate(sizes[src])
+        chunks.extend((src, dst, offset, min(_COPY_CHUNK_SIZE, sizes[src] - offset))
+            for offset in range(0, sizes[src], _COPY_CHUNK_SIZE))
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = [_submit(executor, _copy_chunk, *chunk) for chunk in chunks]
+        for future in futures:
+            future.result()
+    for src, dst in to_copy:
+        shutil.copystat(src, dst)
+        if mode == "move":
+            os.remove(src)
+
+    for src, dst in files:
+        if os.path.getsize(dst) != sizes[src]:
+            raise Exception(f"{dst} has not the same size of {src}")
+
+    return linked_bytes, sum(sizes[src] for src, _ in to_copy)
+
+def _files_of_tree(src_dir: str, dst_dir: str) -> list[tuple[str, str]]:
+    """The (src, dst) pairs to promote all the files in src_dir to dst_dir."""
+    res = []
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        relative_dir = os.path.relpath(dirpath, src_dir)
+        for name in dirnames:
+            os.makedirs(os.path.join(dst_dir, relative_dir, name), exist_ok=True)
+        for name in filenames:
+            res.append((os.path.join(dirpath, name),
+                os.path.join(dst_dir, relative_dir, name)))
+    return res
+
+# Archives #####################################################################
+
+# shutil.make_archive compresses the members one after the other on a single
+# core. Here the members are compressed in parallel by a pool of threads (zlib
+# releases the GIL) into temporary files and then they are copied in the archive
+# by the calling thread in a fixed order, so that the archive is always the
+# same. Since zipfile does not let you add members that are already compressed
+# the archive is written by _ZipWriter, that knows only what we need of the
+# format (no encryption, no data descriptors, a single disk), and it is read
+# back with zipfile as usual.
+
+# Compressed members smaller than this stay in memory.
+_ZIP_SPOOL_MAX_SIZE = 8 << 20
+
+# Sizes, offsets and counts from here on need the ZIP64 extensions.
+_ZIP64_LIMIT = 0xFFFFFFFF
+_ZIP64_COUNT_LIMIT = 0xFFFF
+
+# The SHA-256 of the members of the zip, computed while compressing them, are
+# written in this member, in the satellite directory, so that the backup can be
+# verified before restoring it (the CRC of zip can only tell that a member is
+# damaged after extracting it). It is never put in a backup from the data
+# directory, where it ends up when a backup is restored completely.
+BACKUP_INTEGRITY_FILE = "orchestrator_integrity.json"
+BACKUP_INTEGRITY_VERSION = 1
+
+class _ZipMember(typing.NamedTuple):
+    zinfo: zipfile.ZipInfo
+    source: typing.Optional[str] # The file with the content, None for directories.
+
+def _zip_compress_type(arcname: str, stored_extensions: list[str]) -> int:
+    _, ext = os.path.splitext(arcname)
+    return zipfile.ZIP_STORED if ext.lower() in stored_extensions \
+        else zipfile.ZIP_DEFLATED
+
+def _compress_zip_member(member: _ZipMember, level: int
+    ) -> tuple[zipfile.ZipInfo, typing.Optional[typing.BinaryIO], typing.Optional[str]]:
+    """Computes the CRC, SHA-256 and sizes of the member and, if it has to be
+    deflated, its compressed content. Stored members are copied later directly
+    from their source."""
+    zinfo = member.zinfo
+    if member.source is None:
+        zinfo.compress_type = zipfile.ZIP_STORED
+        zinfo.file_size = zinfo.compress_size = zinfo.CRC = 0
+        return zinfo, None, None
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15) \
+        if zinfo.compress_type == zipfile.ZIP_DEFLATED else None
+    spool = tempfile.SpooledTemporaryFile(_ZIP_SPOOL_MAX_SIZE) \
+        if compressor is not None else None
+    crc = 0
+    hasher = hashlib.sha256()
+    file_size = 0
+    with open(member.source, "rb") as f:
+        while chunk := f.read(1 << 20):
+            crc = zlib.crc32(chunk, crc)
+            hasher.update(chunk)
+            file_size += len(chunk)
+            if compressor is not None:
+                assert spool is not None # Just for mypy.
+                spool.write(compressor.compress(chunk))
+    zinfo.CRC = crc
+    zinfo.file_size = file_size
+    if compressor is not None:
+        assert spool is not None # Just for mypy.
+        spool.write(compressor.flush())
+        zinfo.compress_size = spool.tell()
+        spool.seek(0)
+    else:
+        zinfo.compress_size = file_size
+    return zinfo, spool, hasher.hexdigest()
+
+class _ZipWriter:
+    """Writes a zip whose members are given already compressed, with their
+    ZipInfo filled in (CRC, file_size and compress_size included)."""
+
+    def __init__(self, fp: typing.BinaryIO):
+        self.fp = fp
+        self.entries: list[tuple[zipfile.ZipInfo, int]] = [] # With the header offset.
+
+    @staticmethod
+    def _encoded_name(zinfo: zipfile.ZipInfo) -> tuple[bytes, int]:
+        try:
+            return zinfo.filename.encode("ascii"), zinfo.flag_bits
+        except UnicodeEncodeError:
+            return zinfo.filename.encode("utf-8"), zinfo.flag_bits | 0x800
+
+    @staticmethod
+    def _dos_date_time(zinfo: zipfile.ZipInfo) -> tuple[int, int]:
+        year, month, day, hour, minute, second = zinfo.date_time
+        return (year - 1980) << 9 | month << 5 | day, \
+            hour << 11 | minute << 5 | second // 2
+
+    @staticmethod
+    def _version(zinfo: zipfile.ZipInfo, zip64: bool) -> int:
+        if zip64:
+            return 45
+        return 20 if zinfo.compress_type == zipfile.ZIP_DEFLATED else 10
+
+    def write(self, zinfo: zipfile.ZipInfo, compressed: typing.Optional[typing.BinaryIO]) -> None:
+        """Appends the member, copying its compressed content from compressed."""
+        offset = self.fp.tell()
+        name, flags = self._encoded_name(zinfo)
+        date, time_ = self._dos_date_time(zinfo)
+        zip64 = zinfo.file_size >= _ZIP64_LIMIT or zinfo.compress_size >= _ZIP64_LIMIT
+        extra = struct.pack("<HHQQ", 1, 16, zinfo.file_size, zinfo.compress_size) \
+            if zip64 else b""
+        self.fp.write(struct.pack("<IHHHHHIIIHH", 0x04034b50,
+            self._version(zinfo, zip64), flags, zinfo.compress_type, time_, date,
+            zinfo.CRC,
+            0xFFFFFFFF if zip64 else zinfo.compress_size,
+            0xFFFFFFFF if zip64 else zinfo.file_size,
+            len(name), len(extra)))
+        self.fp.write(name)
+        self.fp.write(extra)
+        if compressed is not None:
+            shutil.copyfileobj(compressed, self.fp, 1 << 20)
+        self.entries.append((zinfo, offset))
+
+    def close(self) -> None:
+        """Writes the central directory."""
+        start = self.fp.tell()
+        for zinfo, offset in self.entries:
+            name, flags = self._encoded_name(zinfo)
+            date, time_ = self._dos_date_time(zinfo)
+            values = []
+            file_size, compress_size = zinfo.file_size, zinfo.compress_size
+            if file_size >= _ZIP64_LIMIT:
+                values.append(file_size)
+                file_size = 0xFFFFFFFF
+            if compress_size >= _ZIP64_LIMIT:
+                values.append(compress_size)
+                compress_size = 0xFFFFFFFF
+            if offset >= _ZIP64_LIMIT:
+                values.append(offset)
+                offset = 0xFFFFFFFF
+            extra = struct.pack(f"<HH{len(values)}Q", 1, 8*len(values), *values) \
+                if values else b""
+            version = self._version(zinfo, bool(values))
+            self.fp.write(struct.pack("<IBBHHHHHIIIHHHHHII", 0x02014b50,
+                max(version, zinfo.create_version), zinfo.create_system, version,
+                flags, zinfo.compress_type, time_, date, zinfo.CRC,
+                compress_size, file_size, len(name), len(extra), 0, 0, 0,
+                zinfo.external_attr, offset))
+            self.fp.write(name)
+            self.fp.write(extra)
+        end = self.fp.tell()
+        count, size, offset = len(self.entries), end - start, start
+        if count >= _ZIP64_COUNT_LIMIT or size >= _ZIP64_LIMIT or offset >= _ZIP64_LIMIT:
+            self.fp.write(struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, 45, 45, 0, 0,
+                count, count, size, offset))
+            self.fp.write(struct.pack("<IIQI", 0x07064b50, 0, end, 1))
+            count = min(count, 0xFFFF)
+            size = min(size, 0xFFFFFFFF)
+            offset = min(offset, 0xFFFFFFFF)
+        self.fp.write(struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, count, count,
+            size, offset, 0))
+
+def _write_zip(zip_path: str, members: list[_ZipMember], settings: Settings,
+    integrity_member: str = "") -> None:
+    """Writes the members in a new zip compressing them in parallel, according
+    to the compression settings. If integrity_member is given the SHA-256 of the
+    members is written in it, as the last member."""
+    level = settings["zip_compression_level"]
+    stored_extensions = [ext.lower() for ext in settings["zip_stored_extensions"]]
+    workers = settings["compression_workers"] or os.cpu_count() or 1
+    for member in members:
+        member.zinfo.compress_type = _zip_compress_type(member.zinfo.filename,
+            stored_extensions)
+
+    with open(zip_path, "wb") as f, \
+        concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        writer = _ZipWriter(f)
+        # We keep only a few members compressed in advance to bound the space
+        # that they occupy.
+        in_flight: collections.deque = collections.deque()
+        sha256s = {}
+        members_iter = iter(members)
+        for member in itertools.islice(members_iter, 2*workers):
+            in_flight.append((member, executor.submit(_compress_zip_member, member, level)))
+        while in_flight:
+            member, future = in_flight.popleft()
+            zinfo, compressed, sha256 = future.result()
+            if compressed is not None:
+                with compressed:
+                    writer.write(zinfo, compressed)
+            elif member.source is not None:
+                with open(member.source, "rb") as source:
+                    writer.write(zinfo, source)
+            else:
+                writer.write(zinfo, None)
+            if sha256 is not None:
+                sha256s[zinfo.filename] = sha256
+            for member in itertools.islice(members_iter, 1):
+                in_flight.append((member, executor.submit(_compress_zip_member, member, level)))
+        if integrity_member:
+            data = json.dumps({
+                "version": BACKUP_INTEGRITY_VERSION,
+                "sha256": sha256s,
+            }, indent=0).encode()
+            # Like ZipFile.writestr.
+            zinfo = zipfile.ZipInfo(integrity_member, time.localtime(time.time())[:6])
+            zinfo.external_attr = 0o600 << 16
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            compressed_data = compressor.compress(data) + compressor.flush()
+            zinfo.CRC = zlib.crc32(data)
+            zinfo.file_size = len(data)
+            zinfo.compress_size = len(compressed_data)
+            writer.write(zinfo, io.BytesIO(compressed_data))
+        writer.close()
+
+def _make_zip(zip_path: str, root_dir: str, base_dir: str, settings: Settings) -> None:
+    """Like shutil.make_archive(zip_path[:-4], "zip", root_dir, base_dir) but
+    using _write_zip, with the integrity manifest."""
+    _write_zip(zip_path, [
+        _ZipMember(zipfile.ZipInfo.from_file(path, arcname),
+            None if os.path.isdir(path) else path)
+        for path, arcname in _zip_members_of_dir(root_dir, base_dir)
+    ], settings, f"{base_dir}/{BACKUP_INTEGRITY_FILE}")
+
+def _zip_members_of_dir(root_dir: str, base_dir: str) -> list[tuple[str, str]]:
+    """Returns the (path, arcname) of the members that shutil.make_archive would
+    put in the zip, in the same order, without the integrity manifest."""
+    res = [(os.path.join(root_dir, base_dir), base_dir)]
+    integrity_path = os.path.join(root_dir, base_dir, BACKUP_INTEGRITY_FILE)
+    for dirpath, dirnames, filenames in os.walk(os.path.join(root_dir, base_dir)):
+        # Like shutil.make_archive only the directories are sorted.
+        for name in sorted(dirnames):
+            path = os.path.join(dirpath, name)
+            res.append((path, os.path.relpath(path, root_dir)))
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.isfile(path) and path != integrity_path:
+                res.append((path, os.path.relpath(path, root_dir)))
+    return res
+
+# Backup store #################################################################
+
+# Instead of a zip for each backup the content of every file can be stored only
+# once, in a file named after its SHA-256, in the store directory inside the
+# backup directory. Each backup is then just a JSON manifest, named like the zip
+# would have been, that lists the members that the zip would have had with their
+# metadata, so that the zip can be rebuilt when needed.
+BACKUP_STORE_DIR = "store"
+BACKUP_STORE_MANIFEST_VERSION = 1
+
+# Guards the hash cache of the store, which can be updated by the jobs of a
+# batch at the same time.
+_backup_store_lock = threading.Lock()
+
+def _backup_store_object_path(backup_dir: str, sha256: str) -> str:
+    return os.path.join(backup_dir, BACKUP_STORE_DIR, "objects", sha256[:2], sha256)
+
+def _sha256_of_file(file_path: str) -> str:
+    # hashlib releases the GIL for big buffers, so this can be run in threads.
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def _read_hash_cache(cache_path: str) -> dict[str, list]:
+    """The hash cache maps the path of the files that have already been hashed
+    to their size, modification time and hash, so that unchanged files do not
+    need to be read again."""
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def _update_hash_cache(cache_path: str, entries: dict[str, list],
+    lock: threading.Lock) -> None:
+    with lock:
+        cache = _read_hash_cache(cache_path)
+        cache.update(entries)
+        _write_json_atomically(cache_path, cache)
+
+def _read_backup_store_hash_cache(backup_dir: str) -> dict[str, list]:
+    return _read_hash_cache(os.path.join(backup_dir, BACKUP_STORE_DIR, "hash_cache.json"))
+
+def _update_backup_store_hash_cache(backup_dir: str, entries: dict[str, list]) -> None:
+    _update_hash_cache(os.path.join(backup_dir, BACKUP_STORE_DIR, "hash_cache.json"),
+        entries, _backup_store_lock)
+
+def _write_json_atomically(path: str, obj: typing.Any) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+def _backup_to_store(data_dir: str, which_hydrognss: str, backup_dir: str,
+    backup_name: str, workers: int) -> str:
+    """Puts the which_hydrognss directory in the store and returns the path of
+    the manifest of the backup."""
+    members = []
+    paths = {}
+    for path, arcname in _zip_members_of_dir(data_dir, which_hydrognss):
+        zinfo = zipfile.ZipInfo.from_file(path, arcname)
+        members.append(zinfo)
+        paths[zinfo.filename] = path
+
+    hash_cache = _read_backup_store_hash_cache(backup_dir)
+    def hash_member(zinfo: zipfile.ZipInfo) -> tuple[str, list]:
+        path = paths[zinfo.filename]
+        stat = os.stat(path)
+        cached = hash_cache.get(path)
+        if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns] \
+            and os.path.exists(_backup_store_object_path(backup_dir, cached[2])):
+            return cached[2], cached
+        sha256 = _sha256_of_file(path)
+        object_path = _backup_store_object_path(backup_dir, sha256)
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            tmp_path = f"{object_path}.{threading.get_ident()}.tmp"
+            shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, object_path)
+            logger.debug(f"{zinfo.filename} added to the store")
+        return sha256, [stat.st_size, stat.st_mtime_ns, sha256]
+
+    files = [zinfo for zinfo in members if not zinfo.is_dir()]
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        hashes = list(executor.map(hash_member, files))
+    _update_backup_store_hash_cache(backup_dir, {
+        paths[zinfo.filename]: cache_entry
+        for zinfo, (_, cache_entry) in zip(files, hashes)
+    })
+    sha256_of = {zinfo.filename: sha256 for zinfo, (sha256, _) in zip(files, hashes)}
+
+    manifest_path = os.path.join(backup_dir, f"{backup_name}.json")
+    _write_json_atomically(manifest_path, {
+        "version": BACKUP_STORE_MANIFEST_VERSION,
+        "members": [_backup_store_member(zinfo, sha256_of.get(zinfo.filename))
+            for zinfo in members],
+    })
+    return manifest_path
+
+def _backup_store_member(zinfo: zipfile.ZipInfo, sha256: typing.Optional[str]) -> dict:
+    return {
+        "name": zinfo.filename,
+        "date_time": zinfo.date_time,
+        "external_attr": zinfo.external_attr,
+        "size": zinfo.file_size,
+        "sha256": sha256,
+    }
+
+def _read_backup_store_manifest(manifest_path: str) -> list[dict]:
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get("version") != BACKUP_STORE_MANIFEST_VERSION:
+        raise ValueError(f"unsupported backup manifest version in {manifest_path}")
+    return manifest["members"]
+
+def _add_zip_to_store(zip_path: str, manifest_path: str, backup_dir: str) -> None:
+    """Adds to the store, and to the manifest, the members of the zip that are
+    not already in the manifest."""
+    members = _read_backup_store_manifest(manifest_path)
+    names = {member["name"] for member in members}
+    tmp_dir = os.path.join(backup_dir, BACKUP_STORE_DIR, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    with zipfile.ZipFile(zip_path) as zipf:
+        for zinfo in zipf.infolist():
+            # The store has its own hashes, the integrity manifest would end up
+            # twice in the zips rebuilt from it.
+            if zinfo.filename in names \
+                or zinfo.filename.split("/", 1)[1:] == [BACKUP_INTEGRITY_FILE]:
+                continue
+            sha256 = None
+            if not zinfo.is_dir():
+                # We can not read a zip member twice cheaply, so we hash it
+                # while copying it.
+                hasher = hashlib.sha256()
+                with zipf.open(zinfo) as src, tempfile.NamedTemporaryFile(
+                    dir=tmp_dir, delete=False) as dst:
+                    while chunk := src.read(1 << 20):
+                        hasher.update(chunk)
+                        dst.write(chunk)
+                sha256 = hasher.hexdigest()
+                object_path = _backup_store_object_path(backup_dir, sha256)
+                if os.path.exists(object_path):
+                    os.remove(dst.name)
+                else:
+                    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                    os.replace(dst.name, object_path)
+            members.append(_backup_store_member(zinfo, sha256))
+            names.add(zinfo.filename)
+    _write_json_atomically(manifest_path, {
+        "version": BACKUP_STORE_MANIFEST_VERSION,
+        "members": members,
+    })
+
+def _restore_from_store(manifest_path: str, data_dir: str, workers: int,
+    names: typing.Optional[list[str]] = None) -> None:
+    """Recreates in data_dir the files listed in the manifest (only the ones in
+    names if given), like extracting the zip would do."""
+    backup_dir = os.path.dirname(manifest_path)
+    members = _read_backup_store_manifest(manifest_path)
+    if names is not None:
+        names_set = set(names)
+        members = [member for member in members if member["name"] in names_set]
+
+    for member in members:
+        if member["sha256"] is None:
+            os.makedirs(os.path.join(data_dir, member["name"]), exist_ok=True)
+
+    def restore_member(member: dict) -> tuple[str, list]:
+        path = os.path.join(data_dir, member["name"])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(_backup_store_object_path(backup_dir, member["sha256"]), path)
+        mtime = time.mktime(tuple(member["date_time"]) + (0, 0, -1))
+        os.utime(path, (mtime, mtime))
+        stat = os.stat(path)
+        return path, [stat.st_size, stat.st_mtime_ns, member["sha256"]]
+
+    files = [member for member in members if member["sha256"] is not None]
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        cache_entries = dict(executor.map(restore_member, files))
+    # So that the next backup does not need to hash again the restored files.
+    _update_backup_store_hash_cache(backup_dir, cache_entries)
+
+def _rebuild_zip_from_store(manifest_path: str, zip_path: str,
+    settings: Settings = SETTINGS_DEFAULT) -> None:
+    """Writes the zip that the manifest describes."""
+    backup_dir = os.path.dirname(manifest_path)
+    members = []
+    for member in _read_backup_store_manifest(manifest_path):
+        zinfo = zipfile.ZipInfo(member["name"], tuple(member["date_time"]))
+        zinfo.external_attr = member["external_attr"]
+        members.append(_ZipMember(zinfo, None if member["sha256"] is None
+            else _backup_store_object_path(backup_dir, member["sha256"])))
+    satellite = members[0].zinfo.filename.split("/")[0] if members else ""
+    _write_zip(zip_path, members, settings,
+        f"{satellite}/{BACKUP_INTEGRITY_FILE}" if satellite else "")
+
+def _paths_to_restore(stages: list[Stage]) -> list[str]:
+    """The paths (relative to DataRelease) of the data that the stages need and
+    that they do not produce."""
+    produced = {output for stage in stages for output in STAGE_OUTPUTS[stage]}
+    needed = {artifact for stage in stages for artifact in STAGE_INPUTS[stage]} - produced
+    return sorted({ARTIFACT_PATHS[artifact] for artifact in needed}) + RESTORE_ALWAYS
+
+def _paths_produced(stages: list[Stage]) -> list[str]:
+    """The paths (relative to DataRelease) in which the stages write."""
+    return sorted({ARTIFACT_PATHS[output]
+        for stage in stages for output in STAGE_OUTPUTS[stage]})
+
+def _members_to_restore(names: list[str], which_hydrognss: str,
+    paths: list[str]) -> list[str]:
+    """Selects the members of the backup that are in (or match) the paths."""
+    data_release_prefix = f"{which_hydrognss}/DataRelease/"
+    res = []
+    for name in names:
+        if not name.startswith(data_release_prefix):
+            continue
+        relative_name = name[len(data_release_prefix):]
+        if any(relative_name.startswith(f"{path}/") or fnmatch.fnmatchcase(relative_name, path)
+            for path in paths):
+            res.append(name)
+    return res
+
+def _restore_backup(backup: str, data_dir: str, members: typing.Optional[list[str]],
+    workers: int) -> None:
+    """Extracts the members (all of them if None) of the backup in data_dir."""
+    if backup.endswith(".json"):
+        _restore_from_store(backup, data_dir, workers, members)
+    else:
+        with zipfile.ZipFile(backup) as zipf:
+            zipf.extractall(data_dir, members)
+
+def _backup_member_names(backup: str) -> list[str]:
+    """The names of the members of a backup, either a zip or a manifest."""
+    if backup.endswith(".json"):
+        return [member["name"] for member in _read_backup_store_manifest(backup)]
+    with zipfile.ZipFile(backup) as zipf:
+        return zipf.namelist()
+
+def _backup_sha256s(backup: str) -> dict[str, str]:
+    """Maps the files in the backup to their SHA-256, as written in its
+    integrity manifest or in the manifest of the store. Empty for the zips
+    without the integrity manifest."""
+    if backup.endswith(".json"):
+        return {member["name"]: member["sha256"]
+            for member in _read_backup_store_manifest(backup)
+            if member["sha256"] is not None}
+    with zipfile.ZipFile(backup) as zipf:
+        names = zipf.namelist()
+        satellite = min(names, default="").split("/")[0]
+        integrity_name = f"{satellite}/{BACKUP_INTEGRITY_FILE}"
+        if integrity_name not in names:
+            return {}
+        integrity = json.loads(zipf.read(integrity_name))
+    if integrity.get("version") != BACKUP_INTEGRITY_VERSION:
+        raise ValueError(f"unsupported integrity manifest version in {backup}")
+    return integrity["sha256"]
+
+class IntegrityReport(typing.NamedTuple):
+    files: int # The ones that were checked.
+    bytes: int
+    corrupt: list[str] # The SHA-256 or the CRC does not match, or unreadable.
+    missing: list[str] # In the manifest but not in the backup.
+    # Checked only with the CRC, because they are not in the manifest (like the
+    # output of the PAM) or because the backup has no manifest.
+    unlisted: list[str]
+
+    def ok(self) -> bool:
+        return not self.corrupt and not self.missing
+
+    def summary(self, max_examples: int = 5) -> str:
+        def examples(names: list[str]) -> str:
+            return ", ".join(names[:max_examples]) \
+                + (", ..." if len(names) > max_examples else "")
+        res = f"{self.files} files ({self.bytes >> 20} MB) checked"
+        if self.corrupt:
+            res += f", {len(self.corrupt)} corrupt: {examples(self.corrupt)}"
+        if self.missing:
+            res += f", {len(self.missing)} missing: {examples(self.missing)}"
+        if self.unlisted:
+            res += f", {len(self.unlisted)} without a SHA-256"
+        return res
+
+def _verify_backup(backup: str, workers: int,
+    names: typing.Optional[list[str]] = None) -> IntegrityReport:
+    """Reads the members (all of them if None) of the backup in parallel and
+    compares them with the SHA-256 in its integrity manifest, or in the manifest
+    of the store."""
+    sha256s: dict[str, str]
+    open_archive: typing.Callable[[], typing.ContextManager[
+        typing.Callable[[str], typing.BinaryIO]]]
+    if backup.endswith(".json"):
+        backup_dir = os.path.dirname(backup)
+        sha256s = {member["name"]: member["sha256"]
+            for member in _read_backup_store_manifest(backup)
+            if member["sha256"] is not None}
+        present = set(sha256s)
+        open_archive = lambda: contextlib.nullcontext(lambda name: open(
+            _backup_store_object_path(backup_dir, sha256s[name]), "rb"))
+    else:
+        with zipfile.ZipFile(backup) as zipf:
+            present = {info.filename for info in zipf.infolist() if not info.is_dir()}
+            satellite = min(present, default="").split("/")[0]
+            integrity_name = f"{satellite}/{BACKUP_INTEGRITY_FILE}"
+            sha256s = {}
+            if integrity_name in present:
+                integrity = json.loads(zipf.read(integrity_name))
+                if integrity.get("version") != BACKUP_INTEGRITY_VERSION:
+                    raise ValueError(f"unsupported integrity manifest version in {backup}")
+                sha256s = integrity["sha256"]
+                present.remove(integrity_name)
+        @contextlib.contextmanager
+        def open_zip() -> typing.Iterator[typing.Callable[[str], typing.BinaryIO]]:
+            # Each thread opens the zip once, they can not share the file.
+            with zipfile.ZipFile(backup) as zipf:
+                yield lambda name: typing.cast(typing.BinaryIO, zipf.open(name))
+        open_archive = open_zip
+    to_check = sorted(present) if names is None \
+        else [name for name in names if name in present]
+    missing = set(sha256s) - present
+
+    def check(batch: list[str]) -> list[tuple[str, int, str]]:
+        res = []
+        with open_archive() as open_member:
+            for name in batch:
+                hasher = hashlib.sha256()
+                size = 0
+                try:
+                    with open_member(name) as f:
+                        while chunk := f.read(1 << 20):
+                            hasher.update(chunk)
+                            size += len(chunk)
+                except FileNotFoundError:
+                    res.append((name, size, "missing"))
+                    continue
+                except (OSError, zipfile.BadZipFile, zlib.error):
+                    # Also a wrong CRC.
+                    res.append((name, size, "corrupt"))
+                    continue
+                expected = sha256s.get(name)
+                res.append((name, size, "unlisted" if expected is None
+                    else "ok" if hasher.hexdigest() == expected else "corrupt"))
+        return res
+
+    # A few batches for each thread, so that the zip is opened only a few times.
+    batches_count = max(1, min(len(to_check), 4*workers))
+    batches = [to_check[i::batches_count] for i in range(batches_count)]
+    files = 0
+    total_bytes = 0
+    found: dict[str, list[str]] = {"corrupt": [], "missing": [], "unlisted": []}
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        for results in executor.map(check, batches):
+            for name, size, status in results:
+                files += 1
+                total_bytes += size
+                if status != "ok":
+                    found[status].append(name)
+    return IntegrityReport(files, total_bytes, sorted(found["corrupt"]),
+        sorted(missing | set(found["missing"])), sorted(found["unlisted"]))
+
+# Backup cache #################################################################
+
+# The backups that were restored recently are kept, fully extracted, in the
+# backup cache directory, so that running again from the same backup needs just
+# to link or copy its files. Each entry is a directory named after the key of
+# the backup and the index keeps the size and the last use of the entries. The
+# least recently used entries are deleted when the cache gets bigger than
+# backup_cache_size_mb.
+# NOTE: the cache is not safe to share between orchestrators running at the
+# same time.
+
+BACKUP_CACHE_INDEX = "index.json"
+
+_backup_cache_lock = threading.Lock()
+
+class BackupCacheEntry(typing.TypedDict):
+    backup: str
+    size: int # The bytes of the extracted files.
+    last_used: float
+
+def _backup_cache_key(backup: str) -> str:
+    """Identifies the content of the backup by its path, size, mtime and a CRC
+    (of the CRCs of the members for a zip)."""
+    stat = os.stat(backup)
+    crc = 0
+    if backup.endswith(".json"):
+        with open(backup, "rb") as f:
+            crc = zlib.crc32(f.read())
+    else:
+        with zipfile.ZipFile(backup) as zipf:
+            for zinfo in zipf.infolist():
+                crc = zlib.crc32(f"{zinfo.filename}\0{zinfo.CRC}\0".encode(), crc)
+    key = f"{os.path.abspath(backup)}\0{stat.st_size}\0{stat.st_mtime_ns}\0{crc}"
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+def _read_backup_cache_index(cache_dir: str) -> dict[str, BackupCacheEntry]:
+    try:
+        with open(os.path.join(cache_dir, BACKUP_CACHE_INDEX)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def _dir_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(dirpath, filename))
+        for dirpath, _, filenames in os.walk(path) for filename in filenames)
+
+def _evict_lru(cache_dir: str, index: dict, max_bytes: int, keep: str = "") -> None:
+    """Deletes the least recently used entries of a cache (which have a size and
+    a last_used time), except keep, until the cache is not bigger than
+    max_bytes."""
+    total = sum(entry["size"] for entry in index.values())
+    for key in sorted(index, key=lambda key: index[key]["last_used"]):
+        if total <= max_bytes:
+            break
+        if key == keep:
+            continue
+        logger.info(f"evicting {key} from {cache_dir}")
+        total -= index[key]["size"]
+        del index[key]
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+
+def _restore_backup_cached(backup: str, data_dir: str, members: list[str],
+    copied_members: set[str], cache_dir: str, max_bytes: int, workers: int) -> bool:
+    """Like _restore_backup but going through the cache. The members are
+    hardlinked from the cache, except the ones in copied_members, which are the
+    ones that are going to be overwritten by the processors. Returns True if the
+    backup was already in the cache."""
+    with _backup_cache_lock:
+        os.makedirs(cache_dir, exist_ok=True)
+        key = _backup_cache_key(backup)
+        entry_dir = os.path.join(cache_dir, key)
+        index = _read_backup_cache_index(cache_dir)
+        hit = key in index and os.path.isdir(entry_dir)
+        if hit:
+            size = index[key]["size"]
+        else:
+            # The entry appears only when it is complete.
+            tmp_dir = f"{entry_dir}.tmp"
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            _restore_backup(backup, tmp_dir, None, workers)
+            os.rename(tmp_dir, entry_dir)
+            size = _dir_size(entry_dir)
+        index[key] = {"backup": backup, "size": size, "last_used": time.time()}
+        _evict_lru(cache_dir, index, max_bytes, key)
+        _write_json_atomically(os.path.join(cache_dir, BACKUP_CACHE_INDEX), index)
+
+        def fill_member(name: str) -> None:
+            src = os.path.join(entry_dir, name)
+            dst = os.path.join(data_dir, name)
+            if os.path.isdir(src):
+                os.makedirs(dst, exist_ok=True)
+                return
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if name not in copied_members:
+                try:
+                    os.link(src, dst)
+                    return
+                except OSError:
+                    # e.g. the cache is on another volume.
+                    pass
+            shutil.copy2(src, dst)
+
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            for _ in executor.map(fill_member, members):
+                pass
+
+        # An entry bigger than the whole cache is used only once.
+        if size > max_bytes:
+            del index[key]
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            _write_json_atomically(os.path.join(cache_dir, BACKUP_CACHE_INDEX), index)
+    return hit
+
+def _purge_backup_cache(cache_dir: str) -> None:
+    with _backup_cache_lock:
+        for name in os.listdir(cache_dir) if os.path.isdir(cache_dir) else []:
+            path = os.path.join(cache_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+# Backup catalog ###############################################################
+
+# What is in each backup of the backup directory is recorded in an SQLite
+# database next to them, so that the backups can be searched, and checked
+# before restoring them, without opening them. The catalog is brought up to date
+# by looking at the size and modification time of the backups, so only the new
+# or changed ones are read. When the catalog cannot be used (e.g. the backup
+# directory is read-only) the backups are read as if they were not in it.
+# NOTE: SQLite relies on the file locks, which do not work on many network
+# file systems: the catalog is safe only if the backup directory is used by
+# the orchestrators of a single host, otherwise it can be corrupted.
+BACKUP_CATALOG = "orchestrator_catalog.sqlite3"
+_backup_name_format = re.compile(r"^(.+)_([0-9]{10})\.(zip|json)$")
+_CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    name            TEXT PRIMARY KEY, -- The file name in the backup directory.
+    size            INTEGER NOT NULL,
+    mtime_ns        INTEGER NOT NULL,
+    experiment_name TEXT NOT NULL,
+    timestamp       INTEGER NOT NULL,
+    satellite       TEXT NOT NULL,
+    first_window    TEXT NOT NULL, -- Like "2021-12-31 H00".
+    last_window     TEXT NOT NULL,
+    windows         INTEGER NOT NULL,
+    outputs         TEXT NOT NULL, -- JSON list of the DataRelease directories with files.
+    stages          TEXT NOT NULL, -- JSON list of the stages finished according to the journal.
+    pam             INTEGER NOT NULL,
+    members         INTEGER NOT NULL,
+    names           BLOB NOT NULL, -- zlib compressed JSON list of the member names.
+    error           TEXT NOT NULL -- Why the backup can not be restored, if it can not.
+);
+"""
+
+class CatalogEntry(typing.TypedDict):
+    name: str
+    size: int
+    mtime_ns: int
+    experiment_name: str
+    timestamp: int
+    satellite: str
+    first_window: str
+    last_window: str
+    windows: int
+    outputs: list[str]
+    stages: list[str]
+    pam: bool
+    members: int
+    error: str
+
+def _open_catalog(backup_dir: str) -> sqlite3.Connection:
+    # More orchestrators of the same host can use the same backup directory,
+    # they wait for each other.
+    res = sqlite3.connect(os.path.join(backup_dir, BACKUP_CATALOG), timeout=60)
+    res.row_factory = sqlite3.Row
+    res.executescript(_CATALOG_SCHEMA)
+    return res
+
+def _read_backup_for_catalog(backup: str) -> tuple[CatalogEntry, list[str]]:
+    """Reads the backup, the only time that it is opened for the catalog."""
+    match = _backup_name_format.search(os.path.basename(backup))
+    if match is None:
+        raise ValueError(f"{backup} is not named like a backup")
+    stat = os.stat(backup)
+    journal_json = None
+    if backup.endswith(".json"):
+        members = _read_backup_store_manifest(backup)
+        names = [member["name"] for member in members]
+        for member in members:
+            if member["name"].endswith(f"/DataRelease/{JOURNAL_FILE}"):
+                with open(_backup_store_object_path(os.path.dirname(backup),
+                    member["sha256"]), "rb") as f:
+                    journal_json = f.read()
+    else:
+        with zipfile.ZipFile(backup) as zipf:
+            names = zipf.namelist()
+            for name in names:
+                if name.endswith(f"/DataRelease/{JOURNAL_FILE}"):
+                    journal_json = zipf.read(name)
+
+    error = ""
+    satellite = names[0].split("/")[0] if names else ""
+    if satellite not in ("HydroGNSS-1", "HydroGNSS-2"):
+        error = f"the backup contains a bad file: {names[0] if names else 'nothing'!r}"
+    elif not all(name.startswith(f"{satellite}/") for name in names):
+        error = f"not all the files in the backup are in the {satellite} directory"
+
+    data_release_prefix = f"{satellite}/DataRelease/"
+    windows = set()
+    outputs = set()
+    for name in names:
+        if not name.startswith(data_release_prefix) or name.endswith("/"):
+            continue
+        relative_name = name[len(data_release_prefix):]
+        if "/" in relative_name:
+            outputs.add(relative_name.split("/")[0])
+        window_match = _window_path_format.search(relative_name)
+        if relative_name.startswith("L1A_L1B/") and window_match:
+            month, day, hour = window_match.groups()
+            windows.add(f"{month}-{day} {hour}")
+    stages = []
+    if journal_json is not None:
+        try:
+            journal = json.loads(journal_json)
+            stages = [name for name, stage in journal["stages"].items()
+                if stage["status"] == "finished"]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            logger.warning(f"the journal in {backup} is not readable")
+    entry: CatalogEntry = {
+        "name": os.path.basename(backup),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "experiment_name": match.group(1),
+        "timestamp": int(match.group(2)),
+        "satellite": satellite,
+        "first_window": min(windows, default=""),
+        "last_window": max(windows, default=""),
+        "windows": len(windows),
+        "outputs": sorted(outputs),
+        "stages": stages,
+        "pam": any(name.startswith(f"{data_release_prefix}PAM_Output/") for name in names),
+        "members": len(names),
+        "error": error,
+    }
+    return entry, names
+
+def _put_in_catalog(catalog: sqlite3.Connection, entry: CatalogEntry,
+    names: list[str]) -> None:
+    row = dict(entry, outputs=json.dumps(entry["outputs"]),
+        stages=json.dumps(entry["stages"]), pam=int(entry["pam"]),
+        names=zlib.compress(json.dumps(names).encode()))
+    catalog.execute(f"INSERT OR REPLACE INTO backups ({', '.join(row)}) "
+        f"VALUES ({', '.join('?'*len(row))})", list(row.values()))
+
+def _catalog_entry_of_row(row: sqlite3.Row) -> CatalogEntry:
+    res = {key: row[key] for key in inspect.get_annotations(CatalogEntry)}
+    res["outputs"] = json.loads(res["outputs"])
+    res["stages"] = json.loads(res["stages"])
+    res["pam"] = bool(res["pam"])
+    return typing.cast(CatalogEntry, res)
+
+def _update_catalog(backup_dir: str, workers: int) -> tuple[int, int]:
+    """Reads the backups that are not in the catalog, or that changed, and
+    forgets the ones that are not there anymore. Returns how many were read and
+    how many were forgotten."""
+    backups = {}
+    for entry in os.scandir(backup_dir):
+        if _backup_name_format.search(entry.name) and entry.is_file():
+            stat = entry.stat()
+            backups[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    with contextlib.closing(_open_catalog(backup_dir)) as catalog:
+        known = {row["name"]: (row["size"], row["mtime_ns"]) for row in
+            catalog.execute("SELECT name, size, mtime_ns FROM backups")}
+        to_read = sorted(name for name, stat in backups.items() if known.get(name) != stat)
+        to_forget = [name for name in known if name not in backups]
+
+        def read(name: str) -> typing.Optional[tuple[CatalogEntry, list[str]]]:
+            try:
+                return _read_backup_for_catalog(os.path.join(backup_dir, name))
+            except Exception:
+                logger.warning(f"unable to read the backup {name}", exc_info=True)
+                return None
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            read_backups = list(executor.map(read, to_read))
+        with catalog:
+            for read_backup in read_backups:
+                if read_backup is not None:
+                    _put_in_catalog(catalog, *read_backup)
+            catalog.executemany("DELETE FROM backups WHERE name = ?",
+                [(name,) for name in to_forget])
+    return len(to_read), len(to_forget)
+
+def _catalog_entry(backup: str) -> tuple[CatalogEntry, list[str]]:
+    """The entry of the backup and the names of its members, read from the
+    catalog of its directory if it is up to date. If the catalog cannot be used
+    the backup is read without it."""
+    stat = os.stat(backup)
+    try:
+        catalog = _open_catalog(os.path.dirname(os.path.abspath(backup)))
+    except sqlite3.Error:
+        logger.warning("unable to open the catalog of the backups", exc_info=True)
+        return _read_backup_for_catalog(backup)
+    with contextlib.closing(catalog):
+        try:
+            row = catalog.execute("SELECT * FROM backups WHERE name = ?",
+                (os.path.basename(backup),)).fetchone()
+        except sqlite3.Error:
+            logger.warning("unable to read the catalog of the backups", exc_info=True)
+            row = None
+        if row is not None and (row["size"], row["mtime_ns"]) \
+            == (stat.st_size, stat.st_mtime_ns):
+            return _catalog_entry_of_row(row), json.loads(zlib.decompress(row["names"]))
+        entry, names = _read_backup_for_catalog(backup)
+        try:
+            with catalog:
+                _put_in_catalog(catalog, entry, names)
+        except sqlite3.Error:
+            logger.warning("unable to add the backup to the catalog", exc_info=True)
+        return entry, names
+
+def _query_catalog(backup_dir: str, experiment_pattern: str = "*", date: str = "",
+    outputs: list[str] = []) -> list[CatalogEntry]:
+    """The backups, oldest first, of the experiments that match the pattern,
+    that cover the date (like 2021-12-31) and have all the outputs."""
+    with contextlib.closing(_open_catalog(backup_dir)) as catalog:
+        rows = catalog.execute("SELECT * FROM backups ORDER BY timestamp, name").fetchall()
+    res = []
+    for row in rows:
+        entry = _catalog_entry_of_row(row)
+        if not fnmatch.fnmatchcase(entry["experiment_name"], experiment_pattern):
+            continue
+        if date and not entry["first_window"][:10] <= date <= entry["last_window"][:10]:
+            continue
+        if not set(outputs) <= set(entry["outputs"]):
+            continue
+        res.append(entry)
+    return res
+
+# Stage cache ##################################################################
+
+# When enabled, the output of the stages is kept in the stage cache directory,
+# under a key made from everything the stage depends on: the executable (path,
+# size and modification time), its arguments, the configuration file of the
+# satellite and the content of its inputs. When a stage has to run again with
+# the same key its output is copied from the cache instead of running the
+# processor. Since the stages write in directories shared with other stages
+# (e.g. L1A_L1B) the output of a stage is what changed in its output directories
+# while it was running, for this reason the stages that write in the same
+# directory are not run at the same time when the cache is enabled.
+# The inputs are hashed only when their size or modification time changed.
+# The files restored from a backup all have new modification times, so they go
+# in the hash cache with the SHA-256 that the backup keeps for them, otherwise
+# the first stages would read the whole L1A_L1B again after every restore (the
+# backups made before the integrity manifest do not have them).
+# NOTE: the cache is not safe to share between orchestrators running at the
+# same time.
+
+STAGE_CACHE_INDEX = "index.json"
+STAGE_CACHE_STATS = "stats.json"
+STAGE_CACHE_HASHES = "hash_cache.json"
+STAGE_CACHE_MANIFEST = "manifest.json"
+
+# The executable of the stages that can be cached.
+STAGE_EXES = {
+    Stage.L1B:          Conf.L1B_EXE,
+    Stage.L1B_MM:       Conf.L1B_MM_EXE,
+    Stage.L1B_CX:       Conf.L1B_CX_EXE,
+    Stage.L1B_CC:       Conf.L1B_CC_EXE,
+    Stage.L1B_MM_AGAIN: Conf.L1B_MM_EXE,
+    Stage.L2FB:         Conf.L2FB_EXE,
+    Stage.L2FT:         Conf.L2FT_EXE,
+    Stage.L2SI:         Conf.L2SI_EXE,
+    Stage.L2SM:         Conf.L2SM_EXE,
+}
+
+_stage_cache_lock = threading.Lock()
+
+class StageCacheEntry(typing.TypedDict):
+    stage: str
+    size: int # The bytes of the output.
+    last_used: float
+
+def _snapshot_dirs(data_release_dir: str, paths: list[str]) -> dict[str, tuple[int, int]]:
+    """Maps the files in the paths (relative to DataRelease) to their size and
+    modification time."""
+    res = {}
+    for path in paths:
+        for dirpath, _, filenames in os.walk(os.path.join(data_release_dir, path)):
+            for filename in filenames:
+                file_path = os.path.join(dirpath, filename)
+                stat = os.stat(file_path)
+                relative_path = os.path.relpath(file_path, data_release_dir).replace(os.sep, "/")
+                res[relative_path] = (stat.st_size, stat.st_mtime_ns)
+    return res
+
+def _hash_data_release_files(data_release_dir: str, relative_paths: list[str],
+    cache_dir: str, workers: int) -> dict[str, str]:
+    """The SHA-256 of the files, using the hash cache of the stage cache."""
+    hashes_path = os.path.join(cache_dir, STAGE_CACHE_HASHES)
+    hash_cache = _read_hash_cache(hashes_path)
+    def hash_file(relative_path: str) -> tuple[str, list]:
+        path = os.path.join(data_release_dir, relative_path)
+        stat = os.stat(path)
+        cached = hash_cache.get(path)
+        if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2], cached
+        return (sha256 := _sha256_of_file(path)), [stat.st_size, stat.st_mtime_ns, sha256]
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        hashes = list(executor.map(hash_file, relative_paths))
+    _update_hash_cache(hashes_path, {
+        os.path.join(data_release_dir, relative_path): cache_entry
+        for relative_path, (_, cache_entry) in zip(relative_paths, hashes)
+    }, _stage_cache_lock)
+    return {relative_path: sha256
+        for relative_path, (sha256, _) in zip(relative_paths, hashes)}
+
+def _add_restored_to_hash_cache(cache_dir: str, data_release_dir: str,
+    data_release_prefix: str, sha256s: dict[str, str]) -> None:
+    """Puts the restored files in the hash cache with the SHA-256 that the
+    backup has for them (sha256s maps the names of the members to them), since
+    they have been given new modification times they would be read again to
+    compute the key of the first stages otherwise."""
+    entries = {}
+    for name, sha256 in sha256s.items():
+        if not name.startswith(data_release_prefix):
+            continue
+        path = os.path.join(data_release_dir, name[len(data_release_prefix):])
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            # Not restored.
+            continue
+        entries[path] = [stat.st_size, stat.st_mtime_ns, sha256]
+    os.makedirs(cache_dir, exist_ok=True)
+    _update_hash_cache(os.path.join(cache_dir, STAGE_CACHE_HASHES), entries,
+        _stage_cache_lock)
+
+def _stage_cache_key(stage: Stage, exe: str, arguments: str, config_file: str,
+    data_release_dir: str, cache_dir: str, workers: int) -> str:
+    stat = os.stat(exe)
+    try:
+        with open(config_file, "rb") as f:
+            config_sha256 = hashlib.sha256(f.read()).hexdigest()
+    except FileNotFoundError:
+        config_sha256 = ""
+    input_paths = sorted({ARTIFACT_PATHS[artifact] for artifact in STAGE_INPUTS[stage]})
+    input_files = sorted(_snapshot_dirs(data_release_dir, input_paths))
+    inputs = _hash_data_release_files(data_release_dir, input_files, cache_dir, workers)
+    key = json.dumps([stage.name, os.path.abspath(exe), stat.st_size,
+        stat.st_mtime_ns, arguments, config_sha256, sorted(inputs.items())])
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+def _read_stage_cache_json(cache_dir: str, name: str) -> dict:
+    try:
+        with open(os.path.join(cache_dir, name)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def _count_stage_cache_use(cache_dir: str, stage: Stage, hit: bool) -> None:
+    with _stage_cache_lock:
+        stats = _read_stage_cache_json(cache_dir, STAGE_CACHE_STATS)
+        counts = stats.setdefault(stage.name, {"hits": 0, "misses": 0})
+        counts["hits" if hit else "misses"] += 1
+        _write_json_atomically(os.path.join(cache_dir, STAGE_CACHE_STATS), stats)
+
+def _fill_from_stage_cache(cache_dir: str, key: str, data_release_dir: str,
+    workers: int) -> bool:
+    """Copies the output of the stage in DataRelease if it is in the cache."""
+    with _stage_cache_lock:
+        index = _read_stage_cache_json(cache_dir, STAGE_CACHE_INDEX)
+        if key not in index:
+            return False
+        index[key]["last_used"] = time.time()
+        _write_json_atomically(os.path.join(cache_dir, STAGE_CACHE_INDEX), index)
+    entry_dir = os.path.join(cache_dir, key)
+    with open(os.path.join(entry_dir, STAGE_CACHE_MANIFEST)) as f:
+        manifest = json.load(f)
+
+    def copy_file(relative_path: str) -> None:
+        dst = os.path.join(data_release_dir, relative_path)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copy2(os.path.join(entry_dir, "data", relative_path), dst)
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        for _ in executor.map(copy_file, [file[0] for file in manifest["files"]]):
+            pass
+    for relative_path in manifest["deleted"]:
+        try:
+            os.remove(os.path.join(data_release_dir, relative_path))
+        except FileNotFoundError:
+            pass
+
+    # So that the stages that follow do not need to hash the files again.
+    cache_entries = {}
+    for relative_path, _, sha256 in manifest["files"]:
+        path = os.path.join(data_release_dir, relative_path)
+        stat = os.stat(path)
+        cache_entries[path] = [stat.st_size, stat.st_mtime_ns, sha256]
+    _update_hash_cache(os.path.join(cache_dir, STAGE_CACHE_HASHES), cache_entries,
+        _stage_cache_lock)
+    return True
+
+def _add_to_stage_cache(cache_dir: str, key: str, stage: Stage,
+    data_release_dir: str, before: dict[str, tuple[int, int]],
+    after: dict[str, tuple[int, int]], max_bytes: int, workers: int) -> None:
+    """Puts in the cache the files that the stage created or changed."""
+    changed = sorted(path for path, stat in after.items() if before.get(path) != stat)
+    deleted = sorted(set(before) - set(after))
+    hashes = _hash_data_release_files(data_release_dir, changed, cache_dir, workers)
+
+    entry_dir = os.path.join(cache_dir, key)
+    # The entry appears only when it is complete.
+    tmp_dir = f"{entry_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    def copy_file(relative_path: str) -> None:
+        dst = os.path.join(tmp_dir, "data", relative_path)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copy2(os.path.join(data_release_dir, relative_path), dst)
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        for _ in executor.map(copy_file, changed):
+            pass
+    _write_json_atomically(os.path.join(tmp_dir, STAGE_CACHE_MANIFEST), {
+        "files": [[path, after[path][0], hashes[path]] for path in changed],
+        "deleted": deleted,
+    })
+
+    with _stage_cache_lock:
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.rename(tmp_dir, entry_dir)
+        index = _read_stage_cache_json(cache_dir, STAGE_CACHE_INDEX)
+        index[key] = {
+            "stage": stage.name,
+            "size": sum(after[path][0] for path in changed),
+            "last_used": time.time(),
+        }
+        _evict_lru(cache_dir, index, max_bytes)
+        _write_json_atomically(os.path.join(cache_dir, STAGE_CACHE_INDEX), index)
+
+def _invalidate_stage_cache(cache_dir: str, names: list[str]) -> int:
+    """Deletes the entries of the given processors (like L1B) or stages (like
+    L1B_CX). Returns how many entries were deleted."""
+    with _stage_cache_lock:
+        index = _read_stage_cache_json(cache_dir, STAGE_CACHE_INDEX)
+        to_delete = [key for key, entry in index.items()
+            if entry["stage"] in names or STAGE_PROC[Stage[entry["stage"]]].name in names]
+        for key in to_delete:
+            del index[key]
+            shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+        _write_json_atomically(os.path.join(cache_dir, STAGE_CACHE_INDEX), index)
+    return len(to_delete)
+
+# NOTE: make which_hydrognss an enum?
+def _do_backup_and_pam(start: Proc, ends: list[Proc], conf: list[str],
+    experiment_name: str, which_hydrognss: str, pam: bool,
+    settings: Settings = SETTINGS_DEFAULT) -> str:
+    """Returns the path of the backup, either a zip archive or the manifest of
+    the backup store."""
+
+    assert ends == sorted(ends)
+    assert start <= ends[-1]
+    assert _experiment_name_format.search(experiment_name)
+    assert which_hydrognss == "HydroGNSS-1" or which_hydrognss == "HydroGNSS-2"
+
+    # A run that ends in the same second of the previous one of the same
+    # experiment (e.g. a short run from its backup) must not overwrite it.
+    seconds = int(time.time())
+    while any(os.path.exists(os.path.join(conf[Conf.BACKUP_DIR],
+        f"{experiment_name}_{seconds}{ext}")) for ext in [".zip", ".json"]):
+        seconds += 1
+    timestamp = f"{seconds}"
+    assert len(timestamp) == 10
+    backup_name = f"{experiment_name}_{timestamp}"
+    backup_path_noext = os.path.join(conf[Conf.BACKUP_DIR], backup_name)
+    logger.info("doing the backup")
+    data_dir = conf[Conf.DATA_DIR]
+    backup_path = f"{backup_path_noext}.zip"
+    if settings["backup_format"] == "store":
+        try:
+            with _MeasureStep("backup"):
+                backup_path = _backup_to_store(data_dir, which_hydrognss,
+                    conf[Conf.BACKUP_DIR], backup_name, _io_workers(settings))
+        except Exception as ex:
+            raise Exception("unable to put the backup in the store") from ex
+    else:
+        try:
+            with _MeasureStep("backup"):
+                _make_zip(backup_path, data_dir, which_hydrognss, settings)
+        except Exception as ex:
+            raise Exception("unable to make backup archive") from ex
+    if pam:
+        # The PAM and the compare tool want a zip, so with the store we build a
+        # temporary one and we put in the store what they add to it.
+        if settings["backup_format"] == "store":
+            try:
+                with _TraceSpan("rebuild the zip for the PAM"):
+                    _rebuild_zip_from_store(backup_path, f"{backup_path_noext}.zip",
+                        settings)
+            except Exception as ex:
+                raise Exception("unable to rebuild the backup archive for the "
+                    "PAM") from ex
+        # The PAM and the compare tool always write in the same directories of
+        # the backup directory, so they can not be run at the same time by the
+        # jobs of a batch.
+        with _TraceSpan("wait for the PAM lock"):
+            _pam_lock.acquire()
+        try:
+            with _TraceSpan("PAM", "pam"):
+                _do_pam(start, ends, conf, backup_name, which_hydrognss, settings)
+        finally:
+            _pam_lock.release()
+        if settings["backup_format"] == "store":
+            try:
+                with _TraceSpan("put the PAM output in the store"):
+                    _add_zip_to_store(f"{backup_path_noext}.zip", backup_path,
+                        conf[Conf.BACKUP_DIR])
+                os.remove(f"{backup_path_noext}.zip")
+            except Exception as ex:
+                raise Exception("unable to put the output of the PAM in the "
+                    "store") from ex
+
+    try:
+        _catalog_entry(backup_path)
+    except Exception:
+        logger.warning("unable to add the backup to the catalog", exc_info=True)
 
     logger.info("orchestration finished")
     # NOTE: it would be cool to send a notificaiton:
     # https://github.com/jithurjacob/Windows-10-Toast-Notifications/blob/master/win10toast/__init__.py
     # https://learn.microsoft.com/en-us/windows/win32/api/shellapi/nf-shellapi-shell_notifyicona
     print("\a", end='')
+    return backup_path
 
 # NOTE: more than 'conf' the name should be 'conf_paths'
-def run(args: Args, conf: list[str], l1a_input_file: str) -> None:
+def run(args: Args, conf: list[str], l1a_input_file: str,
+    settings: Settings = SETTINGS_DEFAULT, resume: bool = False) -> str:
     """If anything goes wrong this function throws an exception with an
-    explenation of what went wrong."""
+    explenation of what went wrong. Returns the path of the backup archive.
+
+    With resume the orchestration in the data directory, that has to be the one
+    described by args, is continued from the stages that did not finish
+    according to its journal."""
 
     assert validate_arguments(args)
     assert len(conf) == len(Conf)
+    assert validate_settings(settings)
 
     data_dir = conf[Conf.DATA_DIR]
     auxiliary_data_dir = os.path.join(data_dir, "Auxiliary_Data")
@@ -508,26 +3645,28 @@ def run(args: Args, conf: list[str], l1a_input_file: str) -> None:
     experiment_name_file = lambda: os.path.join(data_release_dir(), "experiment_name.txt")
 
     start = args["start"]
-    end = args["end"]
+    ends = _ends(args)
     pam = args["pam"]
     backup = args["backup"]
-    should_clean = bool(start == Proc.L1A or backup)
+    should_clean = bool(start == Proc.L1A or backup) and not resume
     # Given the fact that Python allows you to create custom error levels here
     # we just ignore the ones in between and the ones above and below them.
     # Maybe we should throw an exception if we detect extraneous log levels.
     log_level = args["log_level"]
 
     # We convert our log level number to Python's standard library log level number.
-    logger.setLevel((log_level+1)*10)
+    # The jobs of a batch share the logger, so their level is set on the handler
+    # of their log file instead.
+    if not _batch_job_name.get():
+        logger.setLevel((log_level+1)*10)
 
-    logger.info(f"running orchestrator version {VERSION} with:\n{args=}\n{conf=}\n{l1a_input_file=}")
+    # The token is the secret shared with the workers and the service.
+    shown_settings = dict(settings,
+        worker_token="***" if settings["worker_token"] else "")
+    logger.info(f"running orchestrator version {VERSION} with:\n{args=}\n{conf=}\n{l1a_input_file=}\nsettings={shown_settings}\n{resume=}")
 
     # Doing some minimal validation here.
 
-    if os.name != "nt":
-        logger.info("skipping the run because we are not on windows")
-        return
-
     for file, kind in zip(conf, CONF_KINDS):
         if not os.path.exists(file):
             raise FileNotFoundError(file)
@@ -540,34 +3679,86 @@ def run(args: Args, conf: list[str], l1a_input_file: str) -> None:
     if backup and not os.path.isfile(backup):
         raise FileNotFoundError(backup)
 
+    # This stays set after the run, but every run sets its own.
+    _processor_timeouts.set(_timeouts_of_executables(conf, settings))
+
     if should_clean:
-        logger.info("cleaning up from previous execution")
-        if os.path.exists(hydrognss_1_dir):
-            _recycle(hydrognss_1_dir)
-        if os.path.exists(hydrognss_2_dir):
-            _recycle(hydrognss_2_dir)
         if backup:
-            backup_name_format = re.compile("_[0-9]{10}\.zip$")
-            experiment_name = backup_name_format.sub("", backup).split("\\")[-1]
-            if experiment_name == backup:
+            # The backup is either a zip or the manifest of the backup store.
+            backup_name_format = re.compile(r"_[0-9]{10}\.(zip|json)$")
+            backup_noext = backup_name_format.sub("", backup)
+            if backup_noext == backup:
                 raise Exception("invalud backup file selected")
+            experiment_name = os.path.basename(backup_noext)
             logger.info("loading the backup")
-            with zipfile.ZipFile(backup) as zipf:
-                name_list = zipf.namelist()
-                if name_list[0].startswith("HydroGNSS-1"):
-                    which_hydrognss = "HydroGNSS-1"
-                elif name_list[0].startswith("HydroGNSS-2"):
-                    which_hydrognss = "HydroGNSS-2"
-                else:
-                    raise ValueError("the backup contains a bad file: {name_list[0]!r}")
-                if not all(name.startswith(which_hydrognss) for name in name_list):
-                    raise ValueError("not all the files in the backup are in "
-                        "the {which_hydrognss} directory")
-                if os.path.exists(hydrognss_1_dir) and os.path.exists(hydrognss_2_dir):
-                    raise Exception("Both HydroGNSS-1 and HydroGNSS-2 are present. Please "
-                        "delete one of the two.")
             try:
-                shutil.unpack_archive(backup, data_dir)
+                catalog_entry, name_list = _catalog_entry(backup)
+            except Exception as ex:
+                raise Exception("unable to read the backup") from ex
+            if catalog_entry["error"]:
+                raise ValueError(catalog_entry["error"])
+            which_hydrognss = catalog_entry["satellite"]
+            stages = _stages_to_run(start, ends)
+            if settings["selective_restore"]:
+                paths = _paths_to_restore(stages)
+                members = _members_to_restore(name_list, which_hydrognss, paths)
+                logger.info(f"restoring {len(members)} of the {len(name_list)} "
+                    f"files in the backup ({', '.join(paths)})")
+            else:
+                members = None
+            # Before touching the data directory, so that a damaged backup does
+            # not leave it half restored.
+            if settings["verify_backup"]:
+                try:
+                    with _MeasureStep("verify"):
+                        report = _verify_backup(backup, _io_workers(settings), members)
+                except Exception as ex:
+                    raise Exception("unable to verify the backup") from ex
+                if not report.ok():
+                    raise ValueError(f"the backup is damaged, {report.summary()}")
+                logger.info(f"backup verified, {report.summary()}")
+        logger.info("cleaning up from previous execution")
+        with _TraceSpan("clean up"):
+            if os.path.exists(hydrognss_1_dir):
+                _clean_up(hydrognss_1_dir, settings)
+            if os.path.exists(hydrognss_2_dir):
+                _clean_up(hydrognss_2_dir, settings)
+        if backup:
+            if os.path.exists(hydrognss_1_dir) and os.path.exists(hydrognss_2_dir):
+                raise Exception("Both HydroGNSS-1 and HydroGNSS-2 are present. Please "
+                    "delete one of the two.")
+            try:
+                with _MeasureStep("restore"):
+                    if settings["backup_cache_dir"]:
+                        copied_members = set(_members_to_restore(name_list,
+                            which_hydrognss, _paths_produced(stages)))
+                        hit = _restore_backup_cached(backup, data_dir,
+                            name_list if members is None else members, copied_members,
+                            settings["backup_cache_dir"],
+                            settings["backup_cache_size_mb"] << 20,
+                            _io_workers(settings))
+                        logger.info("backup restored from the cache" if hit
+                            else "backup added to the cache")
+                    else:
+                        _restore_backup(backup, data_dir, members, _io_workers(settings))
+                    # The directories that were not restored are still expected to
+                    # be there.
+                    for direc in DATA_RELEASE_SUBDIRS:
+                        os.makedirs(os.path.join(data_release_dir(), direc), exist_ok=True)
+                    # The coverage in the backup may be out of date, it is made
+                    # again when needed.
+                    try:
+                        os.remove(os.path.join(data_release_dir(), COVERAGE_FILE))
+                    except FileNotFoundError:
+                        pass
+                    if settings["stage_cache_dir"]:
+                        try:
+                            _add_restored_to_hash_cache(settings["stage_cache_dir"],
+                                data_release_dir(), f"{which_hydrognss}/DataRelease/",
+                                _backup_sha256s(backup))
+                        except Exception:
+                            logger.warning("unable to add the restored files to the "
+                                "hash cache of the stage cache", exc_info=True)
             except Exception as ex:
                 raise Exception("unable to extract the backup") from ex
     else:
@@ -588,242 +3779,1470 @@ def run(args: Args, conf: list[str], l1a_input_file: str) -> None:
 
     # The actual "orchestration" starts here.
 
-    if start == Proc.L1A:
-        logger.info("runnning L1A")
-        _run_processor(
-            conf[Conf.L1A_EXE],
-            # No validation is performed on this argument because L1A should do
-            # it any way.
-            l1a_input_file
-        )
+    # Assigned by the DATES stage.
+    start_date = ""
+    start_hour = ""
+    end_date = ""
+    end_hour = ""
 
-        l1a_work_dir, _, _ = conf[Conf.L1A_EXE].rpartition('\\')
-        l1a_output_file = os.path.join(
-            l1a_work_dir,
-            "..\conf\AbsoluteFilePath.txt"
-        )
+    stages = _stages_to_run(start, ends)
+    journal = _new_journal(args)
+    if resume:
         try:
-            with open(l1a_output_file) as f:
-                l1a_out = f.read().strip()
+            journal = _read_journal(data_release_dir())
         except Exception as ex:
-            raise Exception("unable to get L1A output path") from ex
+            raise Exception("unable to read the journal of the orchestration "
+                "to resume") from ex
+        if journal["experiment_name"] != experiment_name \
+            or journal["start"] != start.name \
+            or journal["ends"] != [end.name for end in ends]:
+            raise ValueError("the journal is of a different orchestration")
+        stages = _stages_to_resume(stages, journal, data_release_dir())
+        if Stage.L1A in stages:
+            raise Exception("L1A did not finish, the orchestration can not be "
+                "resumed and has to be run again from the start")
+        if Stage.DATES not in stages:
+            start_date, start_hour, end_date, end_hour = journal["dates"]
+        logger.info("resuming the orchestration, the stages to run are: "
+            + (", ".join(stage.name for stage in stages) or "none"))
+    journal_lock = threading.Lock()
+
+    def config_file_to_use() -> str:
+        return os.path.join("..", "conf", "config_H1.txt") if which_hydrognss == "HydroGNSS-1" \
+            else os.path.join("..", "conf", "config_H2.txt")
+
+    def stage_arguments(stage: Stage) -> str:
+        match stage:
+            case Stage.L1B:
+                if settings["l1b_shard"]:
+                    # The shards are run with their own dates, this is what
+                    # identifies them in the stage cache.
+                    return f"{args_for_l1b()} shard={settings['l1b_shard']}"
+                return args_for_l1b()
+            case Stage.L1B_MM | Stage.L1B_MM_AGAIN:
+                return args_for_l1b()
+            case Stage.L1B_CX:
+                # f"-P {data_release_dir()} --Log {LOG_LEVELS_IEEC[log_level]}"
+                # f"--StartDateTime {start_date}T00:00 --StopDateTime {end_date}T23:59 --ConfigFile {config_file_to_use()}"
+                return f"--StartDateTime {start_date}T00:00 --StopDateTime {end_date}T23:59"
+            case Stage.L1B_CC:
+                # f"-P {data_release_dir()}" # Is this done by IEEC too?
+                # f"--StartDateTime {start_date}T00:00 --StopDateTime {end_date}T23:59 --ConfigFile {config_file_to_use()}"
+                return f"--StartDateTime {start_date}T00:00 --StopDateTime {end_date}T23:59"
+            case Stage.L2FT | Stage.L2FB:
+                return f"{start_date} {end_date} {config_file_to_use()}"
+            case Stage.L2SM:
+                return f"{start_date}T00:00 {end_date}T23:59 {config_file_to_use()}"
+            case Stage.L2SI:
+                # f"--StartDateTime {start_date}T00:00 --StopDateTime {end_date}T23:59 --ConfigFile {config_file_to_use()}"
+                return f"--StartDateTime {start_date}T00:00 --StopDateTime {end_date}T23:59"
+            case other:
+                assert False
 
-        if not os.path.exists(l1a_out):
-            raise Exception(
-                f"L1A produced output in a non existing directory: {l1a_out}"
-            )
+    def run_processor_of_stage(stage: Stage) -> None:
+        # The paths that the agents need when the data is copied to them.
+        relative = lambda paths: [os.path.relpath(path, data_dir).replace(os.sep, "/")
+            for path in paths]
+        inputs = relative([experiment_name_file()] + sorted({os.path.join(
+            data_release_dir(), ARTIFACT_PATHS[artifact])
+            for artifact in STAGE_INPUTS[stage]}))
+        outputs = relative(sorted({os.path.join(data_release_dir(),
+            ARTIFACT_PATHS[artifact]) for artifact in STAGE_OUTPUTS[stage]}))
+        _run_stage_processor(stage, conf, stage_arguments(stage), data_dir,
+            (inputs, outputs), settings)
+
+    def run_stage(stage: Stage) -> None:
+        nonlocal which_hydrognss, experiment_name
+        nonlocal start_date, start_hour, end_date, end_hour
+
+        match stage:
+            case Stage.L1A:
+                logger.info("runnning L1A")
+                _run_processor(
+                    conf[Conf.L1A_EXE],
+                    # No validation is performed on this argument because L1A
+                    # should do it any way.
+                    l1a_input_file
+                )
+
+                l1a_work_dir = os.path.dirname(conf[Conf.L1A_EXE])
+                l1a_output_file = os.path.join(
+                    l1a_work_dir,
+                    "..", "conf", "AbsoluteFilePath.txt"
+                )
+                try:
+                    with open(l1a_output_file) as f:
+                        l1a_out = f.read().strip()
+                except Exception as ex:
+                    raise Exception("unable to get L1A output path") from ex
+
+                if not os.path.exists(l1a_out):
+                    raise Exception(
+                        f"L1A produced output in a non existing directory: {l1a_out}"
+                    )
+
+                l1a_out_parts = list(filter(None, os.path.normpath(l1a_out).split(os.sep)))
+                which_hydrognss = l1a_out_parts[-1]
+                if which_hydrognss != "HydroGNSS-1" and which_hydrognss != "HydroGNSS-2":
+                    raise ValueError("HSAVERS did not put the satellite in the path '{l1a_out}'")
+                experiment_name = l1a_out_parts[-2]
+                if not _experiment_name_format.search(experiment_name):
+                    raise ValueError("the L1A output directory has not the correct format")
+
+                try:
+                    os.mkdir(hydrognss_dir())
+                    for direc in DATA_RELEASE_SUBDIRS:
+                        direc = os.path.join(data_release_dir(), direc)
+                        os.makedirs(direc)
+                    del direc
+                except Exception as ex:
+                    raise Exception("unable to create the directory structure") from ex
+
+                # This is needed for when not should_clean, so that the PAM can
+                # read the appropriate file from the PAM directory in the backup
+                # folder.
+                try:
+                    with open(os.path.join(data_release_dir(), "experiment_name.txt"), 'w') as f:
+                        f.write(experiment_name)
+                except Exception as ex:
+                    raise Exception("unable to write the experiment name in the file") from ex
+
+                l1a_out_dir = os.path.join(l1a_out, "DataRelease", PROC_OUTPUT_DIRS[Proc.L1A])
+                # The last 21 characters are the ones of the timestamp.
+                l1a_file_for_pam = os.path.join(l1a_out,
+                    f"{experiment_name[:-21]}_inOutReferenceFile.mat")
+
+                try:
+                    files_to_promote = _files_of_tree(l1a_out_dir, l1a_l1b_dir())
+                    files_to_promote.append((l1a_file_for_pam, os.path.join(
+                        data_release_dir(), os.path.basename(l1a_file_for_pam))))
+                    with _MeasureStep("promotion"):
+                        linked_bytes, copied_bytes = _promote_files(files_to_promote,
+                            settings["l1a_promotion"], _io_workers(settings))
+                except Exception as ex:
+                    raise Exception(f"unable to put the output of L1A in "
+                        f"{data_release_dir()}") from ex
+                logger.info(f"L1A output promoted ({settings['l1a_promotion']}): "
+                    f"{linked_bytes} bytes linked or moved, {copied_bytes} bytes copied")
+
+                try:
+                    coverage = _build_coverage(l1a_l1b_dir())
+                    _write_coverage(data_release_dir(), coverage)
+                except Exception as ex:
+                    raise Exception("unable to record the coverage of the L1A output") from ex
+                _validate_netcdf_output(l1a_l1b_dir(), _windows_with_data(coverage),
+                    _io_workers(settings))
+            case Stage.DATES:
+                assert _experiment_name_format.search(experiment_name), \
+                    "This variable should have been assigned by now"
+                assert which_hydrognss == "HydroGNSS-1" or which_hydrognss == "HydroGNSS-2", \
+                    "This variable should have been assigned by now"
+
+                logger.info("detecting the dates of the simulation")
+                try:
+                    coverage = _coverage(data_release_dir())
+                except Exception as ex:
+                    raise Exception("unable to detect the dates of the simulation") from ex
+                start_date, start_hour, end_date, end_hour = _dates_of_coverage(coverage)
+                logger.info(f"the simulation goes from {start_date} {start_hour} "
+                    f"to {end_date} {end_hour}, {len(coverage['windows'])} windows "
+                    f"with {sum(window['files'] for window in coverage['windows'])} files")
+                if coverage["missing"]:
+                    logger.warning(f"{len(coverage['missing'])} windows have no data: "
+                        + ", ".join(f"{date} {hour}" for date, hour in coverage["missing"]))
+            # Here we expect to have QGIS correctly put in the path
+            case Stage.L1B:
+                if settings["l1b_shard"]:
+                    try:
+                        # The windows without data are not given to L1B.
+                        l1b_shards = _l1b_shards(
+                            _windows_with_data(_coverage(data_release_dir())),
+                            settings["l1b_shard"])
+                    except Exception as ex:
+                        raise Exception("unable to split the dates of the "
+                            "simulation in shards") from ex
+                    _run_l1b_sharded(
+                        conf[Conf.L1B_EXE],
+                        config_file_to_use(),
+                        l1b_shards,
+                        settings["l1b_shard_workers"] or os.cpu_count() or 1
+                    )
+                else:
+                    logger.info("runnning L1B")
+                    run_processor_of_stage(stage)
+            case Stage.L1B_MM:
+                logger.info("runnning L1B_MM")
+                run_processor_of_stage(stage)
+            case Stage.L1B_CX:
+                logger.info("runnning L1B_CX")
+                run_processor_of_stage(stage)
+            case Stage.L1B_CC:
+                logger.info("runnning L1B_CC")
+                run_processor_of_stage(stage)
+            case Stage.L1B_MM_AGAIN:
+                logger.info("running L1B_MM again")
+                run_processor_of_stage(stage)
+            case Stage.L2FT:
+                logger.info("running L2FT")
+                # This does not support logging options apparently.
+                # To decide if repr or oper shall be run the appropriate
+                # processor can be selected from the options.
+                run_processor_of_stage(stage)
+            case Stage.L2FB:
+                logger.info("running L2FB")
+                run_processor_of_stage(stage)
+            case Stage.L2SM:
+                logger.info("running L2SM")
+                run_processor_of_stage(stage)
+            case Stage.L2SI:
+                logger.info("running L2SI")
+                run_processor_of_stage(stage)
+            case other:
+                assert False
 
-        which_hydrognss = list(filter(None, l1a_out.split("\\")))[-1]
-        if which_hydrognss != "HydroGNSS-1" and which_hydrognss != "HydroGNSS-2":
-            raise ValueError("HSAVERS did not put the satellite in the path '{l1a_out}'")
-        experiment_name = list(filter(None, l1a_out.split("\\")))[-2]
-        if not _experiment_name_format.search(experiment_name):
-            raise ValueError("the L1A output directory has not the correct format")
+        if stage >= Stage.L2FB:
+            _validate_netcdf_output(os.path.join(data_release_dir(),
+                PROC_OUTPUT_DIRS[STAGE_PROC[stage]]), workers=_io_workers(settings))
 
-        try:
-            os.mkdir(hydrognss_dir())
-            for direc in DATA_RELEASE_SUBDIRS:
-                direc = os.path.join(data_release_dir(), direc)
-                os.makedirs(direc)
-            del direc
-        except Exception as ex:
-            raise Exception("unable to create the directory structure") from ex
+    def args_for_l1b() -> str:
+        return _l1b_arguments(
+            config_file_to_use(),
+            _l1b_date_time(start_date, start_hour),
+            _l1b_date_time(end_date, end_hour)
+        )
 
-        # This is needed for when not should_clean, so that the PAM can read the
-        # appropriate file from the PAM directory in the backup folder.
-        try:
-            with open(os.path.join(data_release_dir(), "experiment_name.txt"), 'w') as f:
-                f.write(experiment_name)
-        except Exception as ex:
-            raise Exception("unable to write the experiment name in the file") from ex
+    # When the stage cache is enabled the stages that write in the same
+    # directory can not run at the same time, otherwise the output of one would
+    # end up in the cache entry of the other.
+    output_locks = {path: threading.Lock() for path in set(ARTIFACT_PATHS.values())}
 
-        l1a_out_dir = os.path.join(l1a_out, f"DataRelease\\{PROC_OUTPUT_DIRS[Proc.L1A]}")
+    def run_stage_cached(stage: Stage) -> None:
+        cache_dir = settings["stage_cache_dir"]
+        if not cache_dir or stage not in STAGE_EXES:
+            run_stage(stage)
+            return
+        outputs = sorted({ARTIFACT_PATHS[artifact] for artifact in STAGE_OUTPUTS[stage]})
+        workers = _io_workers(settings)
+        with contextlib.ExitStack() as stack:
+            for path in outputs:
+                stack.enter_context(output_locks[path])
+            exe = conf[STAGE_EXES[stage]]
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                key = _stage_cache_key(stage, exe, stage_arguments(stage),
+                    os.path.join(os.path.dirname(exe), config_file_to_use()),
+                    data_release_dir(), cache_dir, workers)
+                hit = _fill_from_stage_cache(cache_dir, key, data_release_dir(), workers)
+            except Exception:
+                logger.exception(f"unable to use the stage cache for {stage.name}")
+                run_stage(stage)
+                return
+            _count_stage_cache_use(cache_dir, stage, hit)
+            if hit:
+                logger.info(f"{stage.name} output taken from the stage cache")
+                return
+            before = _snapshot_dirs(data_release_dir(), outputs)
+            run_stage(stage)
+            try:
+                _add_to_stage_cache(cache_dir, key, stage, data_release_dir(),
+                    before, _snapshot_dirs(data_release_dir(), outputs),
+                    settings["stage_cache_size_mb"] << 20, workers)
+            except Exception:
+                logger.exception(f"unable to put the output of {stage.name} in the stage cache")
+
+    def write_journal() -> None:
+        # If L1A fails there is no DataRelease directory.
+        if not which_hydrognss or not os.path.isdir(data_release_dir()):
+            return
+        journal["experiment_name"] = experiment_name
+        journal["which_hydrognss"] = which_hydrognss
+        try:
+            _write_journal(data_release_dir(), journal)
+        except Exception:
+            logger.exception("unable to write the journal of the orchestration")
+
+    def run_stage_and_journal(stage: Stage) -> None:
+        _raise_if_cancelled()
+        started = time.time()
+        start_counter = time.perf_counter()
+        error = ""
+        outputs = sorted({ARTIFACT_PATHS[artifact] for artifact in STAGE_OUTPUTS[stage]})
+        _notify_stage("started", stage)
         try:
-            shutil.copytree(l1a_out_dir, l1a_l1b_dir(), dirs_exist_ok=True)
+            with _TraceSpan(stage.name, "stage"):
+                run_stage_cached(stage)
         except Exception as ex:
-            raise Exception("unable to copy {l1a_out_dir} to "
-                "{data_release_dir()}") from ex
+            error = f"{ex}"
+            _notify_stage("failed", stage, time.perf_counter() - start_counter)
+            raise
+        else:
+            _notify_stage("finished", stage, time.perf_counter() - start_counter)
+        finally:
+            with journal_lock:
+                # Under the lock, so that the last summary recorded is the
+                # most recent one. Also a failed stage records it, so that
+                # the stages before it are not run again.
+                dir_summaries = {path: _dir_summary(os.path.join(
+                    data_release_dir(), path)) for path in _filled_dirs(stage)} \
+                    if which_hydrognss else {}
+                if stage == Stage.DATES and not error:
+                    journal["dates"] = [start_date, start_hour, end_date, end_hour]
+                journal["stages"][stage.name] = {
+                    "status": "failed" if error else "finished",
+                    "started": started,
+                    "ended": time.time(),
+                    "inputs": sorted({ARTIFACT_PATHS[artifact]
+                        for artifact in STAGE_INPUTS[stage]}),
+                    "outputs": outputs,
+                    "dir_summaries": dir_summaries,
+                    "error": error,
+                }
+                write_journal()
+
+    # The Level-2 processors of a multi-target run are meant to run at the same
+    # time.
+    _run_stage_graph(
+        stages,
+        run_stage_and_journal,
+        settings["max_parallel_stages"],
+        len(ends)
+    )
 
-        # The last 21 characters are the ones of the timestamp.
-        l1a_file_for_pam = os.path.join(l1a_out,
-            f"{experiment_name[:-21]}_inOutReferenceFile.mat")
+    _raise_if_cancelled()
+    with _TraceSpan("backup and PAM"):
+        backup_path = _do_backup_and_pam(start, ends, conf, experiment_name,
+            which_hydrognss, pam, settings)
+    with journal_lock:
+        journal["backup"] = backup_path
+        write_journal()
+    return backup_path
+
+# Batch ########################################################################
+
+class BatchJob(typing.TypedDict):
+    """One of the orchestrations of a batch."""
+    name: str
+    args: Args
+    conf: list[str]
+    l1a_input_file: str
+
+BATCH_RESULT_COLUMNS = ["name", "status", "start", "end", "input", "started",
+    "finished", "seconds", "log", "backup", "error"]
+
+def _batch_jobs_from_json(manifest_json: typing.Any, conf: list[str],
+    allow_exes: bool = True) -> list[BatchJob]:
+    """The manifest is a JSON list of objects like the one below, only start and
+    end are mandatory and backup can be given instead of hsavers. The paths in
+    conf replace the ones in the configuration only for that job, the ones of
+    the executables only if allow_exes.
+
+    {"name": "run1", "hsavers": "C:\\input.xml", "start": "L1A",
+     "end": "L2FB,L2SM", "pam": true, "log_level": "INFO",
+     "conf": {"DATA_DIR": "D:\\PDGS_NAS_folder"}}
+    """
+    if not isinstance(manifest_json, list):
+        raise TypeError("the batch manifest must be a list of jobs")
 
+    res: list[BatchJob] = []
+    for i, job_json in enumerate(manifest_json):
         try:
-            shutil.copy2(l1a_file_for_pam, data_release_dir())
-        except Exception as ex:
-            raise Exception("unable to copy files for the PAM") from ex
+            name = job_json.get("name", f"job{i:04}")
+            start = Proc[job_json["start"]]
+            end, extra_ends = _split_ends(start,
+                [Proc[proc] for proc in job_json["end"].split(",")])
+            args: Args = {
+                "start": start,
+                "end": end,
+                "pam": bool(job_json.get("pam", False)),
+                "backup": job_json.get("backup", ""),
+                "log_level": LogLevel[job_json.get("log_level", "INFO")],
+                "extra_ends": extra_ends,
+            }
+            if not validate_arguments(args):
+                raise ValueError("the argument combination is invalid")
+            job_conf = list(conf)
+            for key, value in job_json.get("conf", {}).items():
+                if type(value) != str:
+                    raise TypeError(f"the path {key} is not a string")
+                if not allow_exes and CONF_KINDS[Conf[key]] == ConfKind.EXE:
+                    raise ValueError(f"the executable {key} cannot be changed")
+                job_conf[Conf[key]] = value
+        except (AttributeError, KeyError, TypeError, ValueError) as ex:
+            raise ValueError(f"the job number {i} of the batch manifest is "
+                "invalid") from ex
+        res.append({
+            "name": name,
+            "args": args,
+            "conf": job_conf,
+            "l1a_input_file": job_json.get("hsavers", ""),
+        })
+
+    if len({job["name"] for job in res}) != len(res):
+        raise ValueError("the jobs in the batch manifest must have different names")
+    return res
+
+def _read_batch_results(results_path: str) -> dict[str, dict[str, str]]:
+    try:
+        with open(results_path, newline="") as f:
+            return {row["name"]: row for row in csv.DictReader(f)}
+    except FileNotFoundError:
+        return {}
+
+def _write_batch_results(results_path: str, results: dict[str, dict[str, str]]) -> None:
+    # We write on a temporary file first so that a crash in the middle of the
+    # write does not lose the results of the jobs that are already done.
+    tmp_path = f"{results_path}.tmp"
+    with open(tmp_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, BATCH_RESULT_COLUMNS)
+        writer.writeheader()
+        writer.writerows(results.values())
+    os.replace(tmp_path, results_path)
+
+def run_batch(jobs: list[BatchJob], log_dir: str, results_path: str,
+    settings: Settings = SETTINGS_DEFAULT) -> int:
+    """Runs the jobs, at most settings["batch_workers"] at the same time, keeping
+    a CSV table with the result of each job in results_path. The jobs that are
+    marked as done in the table are skipped, so that an interrupted batch can be
+    resumed by running it again. The jobs that use the same data directory are
+    never run at the same time. Returns the number of failed jobs."""
+    assert validate_settings(settings)
+
+    results = _read_batch_results(results_path)
+    results_lock = threading.Lock()
+    data_dir_locks = {
+        os.path.normcase(job["conf"][Conf.DATA_DIR]): threading.Lock()
+        for job in jobs
+    }
+
+    def run_job(job: BatchJob) -> bool:
+        name = job["name"]
+        args = job["args"]
+        row = dict.fromkeys(BATCH_RESULT_COLUMNS, "")
+        row["name"] = name
+        row["start"] = args["start"].name
+        row["end"] = ",".join(proc.name for proc in _ends(args))
+        row["input"] = args["backup"] or job["l1a_input_file"]
+
+        with data_dir_locks[os.path.normcase(job["conf"][Conf.DATA_DIR])]:
+            with results_lock:
+                row["status"] = "running"
+                row["started"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+                results[name] = row
+                _write_batch_results(results_path, results)
+
+            logger.info(f"starting the batch job {name}")
+            _batch_job_name.set(name)
+            backup_path = ""
+            start_time = time.monotonic()
+            with LogToFileContext(row["start"], row["end"].replace(",", "+"),
+                log_dir, name, args["log_level"], settings) as log_context:
+                backup_path = run(args, job["conf"], job["l1a_input_file"], settings)
+            seconds = time.monotonic() - start_time
+
+        ok = log_context.exception is None
+        logger.info(f"the batch job {name} " + ("is done" if ok else "failed"))
+        with results_lock:
+            row["status"] = "done" if ok else "failed"
+            row["finished"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+            row["seconds"] = f"{seconds:.1f}"
+            row["log"] = log_context.logfile_path
+            row["backup"] = backup_path
+            row["error"] = "" if ok else str(log_context.exception)
+            _write_batch_results(results_path, results)
+        return ok
+
+    jobs_to_run = []
+    for job in jobs:
+        if results.get(job["name"], {}).get("status") == "done":
+            logger.info(f"skipping the batch job {job['name']} because it is "
+                "already done")
+        else:
+            jobs_to_run.append(job)
+
+    logger.info(f"running {len(jobs_to_run)} batch jobs out of {len(jobs)} with "
+        f"{settings['batch_workers']} workers")
+    with concurrent.futures.ThreadPoolExecutor(settings["batch_workers"]) as executor:
+        futures = [_submit(executor, run_job, job) for job in jobs_to_run]
+        failed = sum(not future.result() for future in futures)
+
+    logger.info(f"batch finished, {failed} jobs failed, the results are in "
+        f"{results_path}")
+    return failed
+
+# Workers ######################################################################
+
+# The processors of the stages after L1A can be run on other hosts by worker
+# agents, started there with "py orchestrator.py -agent host:port", which run
+# the executables of their own configuration. The protocol is HTTP with JSON:
+#
+#   GET  /status               {"version", "slots", "running"}
+#   POST /run                  {"exe": "L2FB_EXE", "arguments", "timeout",
+#                              "stall_timeout"}, the answer is a line of JSON
+#                              for each log record {"log": "..."} and then
+#                              {"returncode", "killed_reason", "seconds"}
+#   GET  /files?path=rel       [[path, size, mtime_ns], ...] for the files in
+#                              rel, relative to the data directory of the agent
+#   GET  /file?path=rel        the content of the file
+#   PUT  /file?path=rel        writes the file, its mtime_ns is in X-Mtime-Ns,
+#                              only in HydroGNSS-x/DataRelease
+#   DELETE /file?path=rel      deletes the file, only in HydroGNSS-x/DataRelease
+#
+# If the agents see the data directory of the orchestrator at the same path (for
+# example on the NAS) worker_staging is "shared", otherwise with "copy" the
+# inputs of the stage are uploaded to the agent before running it and its
+# outputs are downloaded afterwards (only the files that differ in size or
+# modification time are transferred). The agent keeps the data between stages,
+# but what it has in the inputs and outputs of the stage and not here, left
+# by other runs, is deleted before running it and only the files that the
+# processor wrote are downloaded.
+# The arguments are split like the shell would, but no shell runs them.
+# NOTE: there is no encryption, the agents should be used only on trusted
+# networks. They refuse to start without a worker_token.
+
+_WORKER_TOKEN_HEADER = "X-Orchestrator-Token"
+_WORKER_CHUNK_SIZE = 1 << 20
+
+def _safe_relative_path(relative_path: str) -> str:
+    """Checks that the path sent to an agent does not go outside of its data
+    directory."""
+    parts = relative_path.replace("\\", "/").split("/")
+    # On Windows a colon is either a drive, and C:foo is relative to the
+    # current directory of C:, or an alternate data stream.
+    if not relative_path or parts[0] == "" or ".." in parts or ":" in relative_path:
+        raise ValueError(f"invalid path {relative_path!r}")
+    return os.path.join(*parts)
+
+def _stageable_path(relative_path: str) -> str:
+    """Like _safe_relative_path, but only the data releases, which is where the
+    inputs of the stages are, can be written by the orchestrators."""
+    path = _safe_relative_path(relative_path)
+    parts = relative_path.replace("\\", "/").split("/")
+    if len(parts) < 3 or parts[0] not in ("HydroGNSS-1", "HydroGNSS-2") \
+        or parts[1] != "DataRelease" or parts[-1].endswith(".part"):
+        raise ValueError(f"{relative_path!r} is not in a data release")
+    return path
+
+def _list_files(root: str, relative_path: str) -> list[list]:
+    """The files in root/relative_path (a directory or a file) with their size
+    and modification time, with paths relative to root."""
+    path = os.path.join(root, _safe_relative_path(relative_path))
+    if os.path.isfile(path):
+        paths = [path]
+    else:
+        paths = [os.path.join(dirpath, filename)
+            for dirpath, _, filenames in os.walk(path) for filename in filenames]
+    res = []
+    for path in paths:
+        stat = os.stat(path)
+        res.append([os.path.relpath(path, root).replace(os.sep, "/"),
+            stat.st_size, stat.st_mtime_ns])
+    return res
+
+_agent_stream: contextvars.ContextVar[typing.Optional["_AgentStreamHandler"]] = \
+    contextvars.ContextVar("agent_stream", default=None)
+
+class _AgentStreamHandler(logging.Handler):
+    """Sends the log of a processor run by an agent to the orchestrator that
+    asked for it."""
+
+    def __init__(self, wfile: typing.BinaryIO, cancel: threading.Event):
+        super().__init__()
+        self.wfile = wfile
+        self.cancel = cancel
+        self.addFilter(lambda record: _agent_stream.get() is self)
+
+    def send(self, obj: dict) -> None:
+        self.wfile.write(json.dumps(obj).encode() + b"\n")
+        self.wfile.flush()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.send({"log": record.getMessage()})
+        except OSError:
+            # The orchestrator went away, so the processor is killed. This is
+            # noticed only when the processor writes something.
+            self.cancel.set()
+
+class _AgentRequestHandler(http.server.BaseHTTPRequestHandler):
+    server: "WorkerAgent"
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug(f"agent: {self.address_string()} {format % args}")
+
+    def _authorized(self) -> bool:
+        token = self.headers.get(_WORKER_TOKEN_HEADER, "")
+        if hmac.compare_digest(token, self.server.token):
+            return True
+        self.send_error(403)
+        return False
 
-        _check_existence_of_netcdf_file(l1a_l1b_dir())
-        if end == Proc.L1A:
-            _do_backup_and_pam(start, end, conf, experiment_name, which_hydrognss, pam)
+    def _send_json(self, obj: typing.Any, status: int = 200) -> None:
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", f"{len(body)}")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _query_path(self, check: typing.Callable[[str], str] = _safe_relative_path) -> str:
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        return os.path.join(self.server.conf[Conf.DATA_DIR],
+            check(query.get("path", [""])[0]))
+
+    def do_GET(self) -> None:
+        if not self._authorized():
+            return
+        try:
+            match urllib.parse.urlsplit(self.path).path:
+                case "/status":
+                    with self.server.lock:
+                        running = self.server.running
+                    self._send_json({"version": VERSION, "slots": self.server.slots,
+                        "running": running})
+                case "/files":
+                    path = self._query_path()
+                    self._send_json(_list_files(self.server.conf[Conf.DATA_DIR],
+                        os.path.relpath(path, self.server.conf[Conf.DATA_DIR]))
+                        if os.path.exists(path) else [])
+                case "/file":
+                    path = self._query_path()
+                    with open(path, "rb") as f:
+                        self.send_response(200)
+                        self.send_header("Content-Length", f"{os.fstat(f.fileno()).st_size}")
+                        self.end_headers()
+                        shutil.copyfileobj(f, self.wfile, _WORKER_CHUNK_SIZE)
+                case other:
+                    self.send_error(404)
+        except (ValueError, FileNotFoundError) as ex:
+            self.send_error(404, f"{ex}")
+
+    def do_PUT(self) -> None:
+        if not self._authorized():
+            return
+        try:
+            path = self._query_path(_stageable_path)
+        except ValueError as ex:
+            self.send_error(403, f"{ex}")
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.part"
+        remaining = int(self.headers["Content-Length"])
+        with open(tmp_path, "wb") as f:
+            while remaining > 0:
+                chunk = self.rfile.read(min(remaining, _WORKER_CHUNK_SIZE))
+                if not chunk:
+                    break
+                f.write(chunk)
+                remaining -= len(chunk)
+        if remaining:
+            os.remove(tmp_path)
+            self.send_error(400, "truncated file")
             return
+        os.replace(tmp_path, path)
+        mtime_ns = int(self.headers.get("X-Mtime-Ns", time.time_ns()))
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+        self._send_json({})
 
-    assert _experiment_name_format.search(experiment_name), \
-        "This variable should have been assigned by now"
-    assert which_hydrognss == "HydroGNSS-1" or which_hydrognss == "HydroGNSS-2", \
-        "This variable should have been assigned by now"
+    def do_DELETE(self) -> None:
+        if not self._authorized():
+            return
+        if urllib.parse.urlsplit(self.path).path != "/file":
+            self.send_error(404)
+            return
+        try:
+            os.remove(self._query_path(_stageable_path))
+        except ValueError as ex:
+            self.send_error(403, f"{ex}")
+            return
+        except FileNotFoundError:
+            pass
+        self._send_json({})
 
-    logger.info("detecting the dates of the simulation")
+    def do_POST(self) -> None:
+        if not self._authorized():
+            return
+        if urllib.parse.urlsplit(self.path).path != "/run":
+            self.send_error(404)
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        except ValueError:
+            self.send_error(400, "invalid request")
+            return
+        if not isinstance(request, dict) or request.get("exe") not in Conf.__members__ \
+            or CONF_KINDS[Conf[request["exe"]]] != ConfKind.EXE:
+            self.send_error(400, "unknown executable")
+            return
+        arguments = request.get("arguments")
+        if not isinstance(arguments, str) \
+            or any(not char.isprintable() for char in arguments) \
+            or not all(type(request.get(key, 0)) in (int, float)
+                for key in ("timeout", "stall_timeout")):
+            self.send_error(400, "invalid arguments")
+            return
+        with self.server.lock:
+            if self.server.running >= self.server.slots:
+                self.send_error(503, "no free slots")
+                return
+            self.server.running += 1
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+            cancel = threading.Event()
+            handler = _AgentStreamHandler(self.wfile, cancel)
+            _agent_stream.set(handler)
+            _cancel_event.set(cancel)
+            logger.addHandler(handler)
+            try:
+                res = asyncio.run(run_processor_async(
+                    self.server.conf[Conf[request["exe"]]], arguments,
+                    timeout=request.get("timeout", 0),
+                    stall_timeout=request.get("stall_timeout", 0)))
+            finally:
+                logger.removeHandler(handler)
+            handler.send({"returncode": res.returncode,
+                "killed_reason": res.killed_reason, "seconds": res.seconds})
+        except Exception:
+            logger.exception("agent: unable to run the processor")
+        finally:
+            with self.server.lock:
+                self.server.running -= 1
+
+class WorkerAgent(http.server.ThreadingHTTPServer):
+    """Runs the processors of conf for the orchestrators that ask for it, at
+    most slots at a time. With port 0 a free port is chosen (see url). The
+    token is required, since whoever has it can run the processors."""
+    daemon_threads = True
+
+    def __init__(self, conf: list[str], host: str = "127.0.0.1", port: int = 0,
+        slots: int = 1, token: str = ""):
+        if not token:
+            raise ValueError("a worker_token is required")
+        super().__init__((host, port), _AgentRequestHandler)
+        self.conf = conf
+        self.slots = slots
+        self.token = token
+        self.lock = threading.Lock()
+        self.running = 0
+        self.thread: typing.Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> None:
+        """Serves in a background thread, stop it with shutdown."""
+        self.thread = threading.Thread(target=self.serve_forever, name="agent",
+            daemon=True)
+        self.thread.start()
+
+# Orchestrator side.
+
+def _worker_request(url: str, method: str, path: str, token: str,
+    body: typing.Any = None, headers: typing.Optional[dict] = None,
+    timeout: typing.Optional[float] = 30) -> http.client.HTTPResponse:
+    """Returns the response, which has to be read, if the status is 200."""
+    parsed = urllib.parse.urlsplit(url)
+    connection = http.client.HTTPConnection(parsed.hostname or "", parsed.port,
+        timeout=timeout)
+    headers = dict(headers or {}, **{_WORKER_TOKEN_HEADER: token})
+    if isinstance(body, (dict, list)):
+        body = json.dumps(body).encode()
+        headers["Content-Type"] = "application/json"
+    connection.request(method, path, body, headers)
+    response = connection.getresponse()
+    if response.status != 200:
+        response.read()
+        connection.close()
+        raise ConnectionError(f"{url}{path} answered {response.status} {response.reason}")
+    return response
+
+def _worker_load(url: str, token: str) -> float:
+    """How busy the agent is, from 0 (idle) to 1 (all slots used), inf if it
+    does not answer."""
     try:
-        year_month_format = re.compile("^[0-9]{4}-[0-9]{2}$")
-        day_format = re.compile("^[0-9]{2}$")
-
-        year_month_list = sorted(os.listdir(l1a_l1b_dir()))
-        if not all(year_month_format.search(year_month) for year_month in year_month_list):
-            raise Exception("there are files which are not directories of year and month of the data")
-        start_year_month = year_month_list[0]
-        end_year_month = year_month_list[-1]
-
-        start_year_month_dir = os.path.join(l1a_l1b_dir(), start_year_month)
-        start_days = sorted(os.listdir(start_year_month_dir))
-        if not all(day_format.search(day) for day in start_days):
-            raise Exception(f"there are files which are not named as days in {start_year_month}")
-        start_day = start_days[0]
-
-        end_year_month_dir = os.path.join(l1a_l1b_dir(), end_year_month)
-        end_days = sorted(os.listdir(end_year_month_dir))
-        if not all(day_format.search(day) for day in end_days):
-            raise Exception(f"there are files which are not named as days in {end_year_month}")
-        end_day = end_days[-1]
-
-        valid_hours = ['H00', 'H06', 'H12', 'H18']
-        start_hours = sorted(os.listdir(os.path.join(start_year_month_dir, start_day)))
-        if not all(hour in valid_hours for hour in start_hours):
-            raise Exception(f"there are directories that have incorrect hour names in {start_hours}")
-        end_hours = sorted(os.listdir(os.path.join(end_year_month_dir, end_day)))
-        if not all(hour in valid_hours for hour in end_hours):
-            raise Exception(f"there are directories that have incorrect hour names in {end_hours}")
-        start_hour = start_hours[0]
-        end_hour = end_hours[-1]
-
-        start_date = f"{start_year_month}-{start_day}"
-        end_date = f"{end_year_month}-{end_day}"
-    except Exception as ex:
-        raise Exception("unable to detect the dates of the simulation") from ex
-
-    config_file_to_use = "..\\conf\\config_H1.txt" if which_hydrognss == "HydroGNSS-1" \
-        else "..\\conf\\config_H2.txt"
-
-    # Here we expect to have QGIS correctly put in the path
-    if start == Proc.L1A or start == Proc.L1B:
-        logger.info("runnning L1B")
-        # config=C:\L1BOP\conf\hgdevConfiguration0p7_ReadL1a.xml,StartDateTime=20211212T00:00:00,StopDateTime=20211212T06:00:00
-        args_for_l1b = f"\"config={config_file_to_use}," \
-               f"StartDateTime={start_date.replace('-','')}T{start_hour[1:]}:00:00," \
-               f"StopDateTime={end_date.replace('-','')}T{end_hour[1:]}:00:00\""
-        _run_processor(
-            conf[Conf.L1B_EXE],
-            args_for_l1b
-        )
-        logger.info("runnning L1B_MM")
-        _run_processor(
-            conf[Conf.L1B_MM_EXE],
-            args_for_l1b
-        )
-        logger.info("runnning L1B_CX")
-        _run_processor(
-            conf[Conf.L1B_CX_EXE],
-            # f"-P {data_release_dir()} --Log {LOG_LEVELS_IEEC[log_level]}"
-            # f"--StartDateTime {start_date}T00:00 --StopDateTime {end_date}T23:59 --ConfigFile {config_file_to_use}"
-            f"--StartDateTime {start_date}T00:00 --StopDateTime {end_date}T23:59"
-        )
-        logger.info("runnning L1B_CC")
-        _run_processor(
-            conf[Conf.L1B_CC_EXE],
-            # f"-P {data_release_dir()}" # Is this done by IEEC too?
-            # f"--StartDateTime {start_date}T00:00 --StopDateTime {end_date}T23:59 --ConfigFile {config_file_to_use}"
-            f"--StartDateTime {start_date}T00:00 --StopDateTime {end_date}T23:59"
-        )
-        logger.info("running L1B_MM again")
-        _run_processor(
-            conf[Conf.L1B_MM_EXE],
-            args_for_l1b
-        )
-        if end == Proc.L1B:
-            _do_backup_and_pam(start, end, conf, experiment_name, which_hydrognss, pam)
+        status = json.load(_worker_request(url, "GET", "/status", token, timeout=5))
+    except (OSError, ValueError):
+        logger.warning(f"the worker {url} does not answer")
+        return float("inf")
+    return status["running"]/status["slots"] if status["slots"] else float("inf")
+
+# How often a stage that found all the processor slots busy looks again.
+_WORKER_POLL_INTERVAL = 1.0
+
+# Notified when a stage running here ends.
+_local_stages = threading.Condition()
+_local_stages_running = 0
+
+def _choose_worker(settings: Settings, excluded: set[str]) -> typing.Optional[str]:
+    """The least loaded between this host ("") and the workers that are not
+    excluded, this host wins ties, None if they are all busy. If this host is
+    chosen one of its local_processor_slots is taken. When none of the workers
+    answers this host is chosen even if it has no free slots."""
+    global _local_stages_running
+    best: typing.Optional[str] = None
+    best_load = float("inf")
+    answered = False
+    for url in settings["workers"]:
+        if url in excluded:
+            continue
+        load = _worker_load(url, settings["worker_token"])
+        answered = answered or load != float("inf")
+        if load < min(best_load, 1):
+            best, best_load = url, load
+    with _local_stages:
+        local_slots = settings["local_processor_slots"]
+        local_load = _local_stages_running/local_slots if local_slots else float("inf")
+        if local_load < 1 and local_load <= best_load or not answered:
+            _local_stages_running += 1
+            return ""
+    return best
+
+def _files_to_transfer(source: list[list], destination: list[list]) -> list[list]:
+    have = {path: (size, mtime_ns) for path, size, mtime_ns in destination}
+    return [file for file in source if have.get(file[0]) != (file[1], file[2])]
+
+def _remote_files(url: str, token: str, relative_paths: list[str]) -> list[list]:
+    """Like _list_files, for the paths on the agent."""
+    return [file for relative_path in relative_paths
+        for file in json.load(_worker_request(url, "GET",
+            f"/files?path={urllib.parse.quote(relative_path)}", token))]
+
+def _stage_in(url: str, token: str, data_dir: str, relative_paths: list[str],
+    upload: bool = True) -> int:
+    """Makes the files of the agent in relative_paths like the ones here: those
+    that it does not have are uploaded (unless upload is False) and those that
+    are not here are deleted. Returns the bytes sent."""
+    sent = 0
+    for relative_path in relative_paths:
+        remote = _remote_files(url, token, [relative_path])
+        local = _list_files(data_dir, relative_path) \
+            if os.path.exists(os.path.join(data_dir, relative_path)) else []
+        for path, size, mtime_ns in _files_to_transfer(local, remote) if upload else []:
+            with open(os.path.join(data_dir, path), "rb") as f:
+                _worker_request(url, "PUT", f"/file?path={urllib.parse.quote(path)}",
+                    token, f, {"Content-Length": f"{size}", "X-Mtime-Ns": f"{mtime_ns}"},
+                    timeout=None).read()
+            sent += size
+        local_paths = {path for path, _, _ in local}
+        for path, _, _ in remote:
+            if path not in local_paths:
+                _worker_request(url, "DELETE", f"/file?path={urllib.parse.quote(path)}",
+                    token).read()
+    return sent
+
+def _stage_out(url: str, token: str, data_dir: str, relative_paths: list[str],
+    before: list[list]) -> int:
+    """Downloads from the agent the files that the processor wrote, that is
+    those that differ from before (as returned by _remote_files before running
+    it) and from the local ones. Returns the bytes received."""
+    received = 0
+    for relative_path in relative_paths:
+        remote = _remote_files(url, token, [relative_path])
+        local = _list_files(data_dir, relative_path) \
+            if os.path.exists(os.path.join(data_dir, relative_path)) else []
+        for path, size, mtime_ns in _files_to_transfer(
+            _files_to_transfer(remote, before), local):
+            local_path = os.path.join(data_dir, _safe_relative_path(path))
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            response = _worker_request(url, "GET",
+                f"/file?path={urllib.parse.quote(path)}", token, timeout=None)
+            with open(f"{local_path}.part", "wb") as f:
+                shutil.copyfileobj(response, f, _WORKER_CHUNK_SIZE)
+            os.replace(f"{local_path}.part", local_path)
+            os.utime(local_path, ns=(mtime_ns, mtime_ns))
+            received += size
+    return received
+
+def _run_processor_remote(url: str, exe: Conf, arguments: str, token: str,
+    timeout: float = 0, stall_timeout: float = 0) -> None:
+    """Like _run_processor but on an agent. The log of the processor is logged
+    here as it arrives."""
+    host = urllib.parse.urlsplit(url).netloc
+    logger.info(f"running {exe.name} on {host}")
+    response = _worker_request(url, "POST", "/run", token, {"exe": exe.name,
+        "arguments": arguments, "timeout": timeout, "stall_timeout": stall_timeout},
+        timeout=None)
+    # On cancel the connection is closed, so that the agent kills the processor.
+    cancel = _cancel_event.get()
+    done = threading.Event()
+    def watch_cancel() -> None:
+        assert cancel is not None # Just for mypy.
+        while not done.wait(_WATCHDOG_INTERVAL):
+            if cancel.is_set():
+                response.close()
+                return
+    if cancel is not None:
+        threading.Thread(target=watch_cancel, daemon=True).start()
+    result = None
+    try:
+        for line in response:
+            message = json.loads(line)
+            if "log" in message:
+                logger.info(f"{host}: {message['log']}")
+            else:
+                result = message
+    except (OSError, ValueError) as ex:
+        _raise_if_cancelled()
+        raise ChildProcessError(f"lost the connection with {host}") from ex
+    finally:
+        done.set()
+        response.close()
+    _raise_if_cancelled()
+    if result is None:
+        raise ChildProcessError(f"{host} did not say how {exe.name} ended")
+    if result["killed_reason"]:
+        raise ChildProcessError(f"{exe.name} was killed on {host} because "
+            f"{result['killed_reason']}")
+    if result["returncode"] != 0:
+        raise ChildProcessError(f"{exe.name} exited with error code "
+            f"{result['returncode']} on {host}")
+    logger.info(f"{exe.name} exited with code 0 on {host} after "
+        f"{result['seconds']:.1f} seconds")
+
+def _run_stage_processor(stage: Stage, conf: list[str], arguments: str,
+    data_dir: str, relative_paths: tuple[list[str], list[str]],
+    settings: Settings) -> None:
+    """Runs the executable of the stage here or on the least loaded worker,
+    waiting for a free slot if they are all busy. relative_paths are the inputs
+    and outputs of the stage relative to data_dir, which are staged when
+    worker_staging is "copy"."""
+    global _local_stages_running
+    exe = STAGE_EXES[stage]
+    if not settings["workers"]:
+        _run_processor(conf[exe], arguments)
+        return
+    inputs, outputs = relative_paths
+    token = settings["worker_token"]
+    timeout, stall_timeout = _processor_timeouts.get().get(conf[exe], (0, 0))
+    # The workers on which the stage could not be run.
+    failed: set[str] = set()
+    waiting = False
+    before: list[list] = []
+    while True:
+        worker = _choose_worker(settings, failed)
+        if worker is None:
+            if not waiting:
+                logger.info(f"all the processor slots are busy, {stage.name} waits")
+                waiting = True
+            _raise_if_cancelled()
+            with _local_stages:
+                _local_stages.wait(_WORKER_POLL_INTERVAL)
+            continue
+        if not worker:
+            break
+        try:
+            with _TraceSpan(f"{stage.name} on {worker}", "remote"):
+                if settings["worker_staging"] == "copy":
+                    sent = _stage_in(worker, token, data_dir, inputs)
+                    _stage_in(worker, token, data_dir,
+                        [path for path in outputs if path not in inputs], upload=False)
+                    before = _remote_files(worker, token, outputs)
+                    logger.info(f"{sent} bytes staged in to {worker}")
+                _run_processor_remote(worker, exe, arguments, token, timeout,
+                    stall_timeout)
+                if settings["worker_staging"] == "copy":
+                    received = _stage_out(worker, token, data_dir, outputs, before)
+                    logger.info(f"{received} bytes staged out from {worker}")
             return
+        except ConnectionError:
+            # The worker got busy in the meantime or went away.
+            logger.warning(f"unable to run {stage.name} on {worker}", exc_info=True)
+            failed.add(worker)
+    try:
+        _run_processor(conf[exe], arguments)
+    finally:
+        with _local_stages:
+            _local_stages_running -= 1
+            _local_stages.notify_all()
+
+# Run controller ###############################################################
+
+class RunEvent(typing.NamedTuple):
+    # "log", "stage_started", "stage_finished", "stage_failed" or, as the last
+    # event of a run, "finished", "failed" or "cancelled".
+    kind: str
+    time: float # As returned by time.time().
+    # The log line, the name of the stage, the path of the backup or the error.
+    text: str
+    seconds: float = 0.0 # How long the stage or the run took.
+
+class _RunEventHandler(logging.Handler):
+
+    def __init__(self, controller: "RunController"):
+        super().__init__()
+        self.controller = controller
+        self.setFormatter(logging.Formatter("%(asctime)s %(levelname)s: %(message)s"))
+        # Only the records of the run of the controller.
+        self.addFilter(lambda record: _run_controller.get() is controller)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.controller.events.put(RunEvent("log", record.created, self.format(record)))
+        except Exception:
+            self.handleError(record)
+
+_run_controller: contextvars.ContextVar[typing.Optional["RunController"]] = \
+    contextvars.ContextVar("run_controller", default=None)
+
+class RunController:
+    """Runs an orchestration on a worker thread. What happens during the run is
+    put in events as RunEvent, which the GUI empties periodically with
+    tkinter.Misc.after, since tkinter can be used only from the main thread.
+    Nothing here needs tkinter so it can also be used without a display."""
+
+    def __init__(self, args: Args, conf: list[str], l1a_input_file: str,
+        log_dir: str, settings: Settings = SETTINGS_DEFAULT, job_name: str = ""):
+        self.args = args
+        self.conf = conf
+        self.l1a_input_file = l1a_input_file
+        self.log_dir = log_dir
+        self.settings = settings
+        # Like in batches, to separate the logs of runs in the same process.
+        self.job_name = job_name
+        self.events: queue.Queue[RunEvent] = queue.Queue()
+        self.backup_path = ""
+        self.log_path = ""
+        self._cancel = threading.Event()
+        self._thread = threading.Thread(target=self._work, name="orchestration",
+            daemon=True)
+
+    def start(self) -> None:
+        # The worker gets its own copy of the context.
+        self._thread.start()
+
+    def cancel(self) -> None:
+        """Kills the running processors and does not start other stages; the
+        run ends with a "cancelled" event."""
+        if self.running():
+            logger.warning("cancelling the orchestration")
+        self._cancel.set()
+
+    def running(self) -> bool:
+        return self._thread.is_alive()
+
+    def join(self, timeout: typing.Optional[float] = None) -> None:
+        self._thread.join(timeout)
+
+    def poll(self) -> list[RunEvent]:
+        """Returns the events that happened since the last call."""
+        res = []
+        while True:
+            try:
+                res.append(self.events.get_nowait())
+            except queue.Empty:
+                return res
+
+    def _on_stage(self, event: str, stage: Stage, seconds: float) -> None:
+        self.events.put(RunEvent(f"stage_{event}", time.time(), stage.name, seconds))
+
+    def _work(self) -> None:
+        _run_controller.set(self)
+        _cancel_event.set(self._cancel)
+        _stage_listener.set(self._on_stage)
+        handler = _RunEventHandler(self)
+        logger.addHandler(handler)
+        start_counter = time.perf_counter()
+        if self.job_name:
+            _batch_job_name.set(self.job_name)
+        log_context = LogToFileContext(self.args["start"].name,
+            "+".join(proc.name for proc in _ends(self.args)), self.log_dir,
+            self.job_name, self.args["log_level"] if self.job_name else LogLevel.DEBUG,
+            self.settings)
+        self.log_path = log_context.logfile_path
+        try:
+            with log_context:
+                self.backup_path = run(self.args, self.conf, self.l1a_input_file,
+                    self.settings)
+        finally:
+            logger.removeHandler(handler)
+        seconds = time.perf_counter() - start_counter
+        if log_context.exception is None:
+            self.events.put(RunEvent("finished", time.time(), self.backup_path, seconds))
+        elif self._cancel.is_set():
+            self.events.put(RunEvent("cancelled", time.time(),
+                f"{log_context.exception}", seconds))
+        else:
+            self.events.put(RunEvent("failed", time.time(),
+                f"{log_context.exception}", seconds))
+
+# Service ######################################################################
+
+# With "py orchestrator.py -service host:port" the orchestrator stays running
+# and runs the jobs that are submitted to it, one after the other or
+# batch_workers at a time, but never two jobs with the same data directory at
+# the same time. The jobs are kept in an SQLite database in the log directory,
+# so that they survive a restart of the service. The API is HTTP with JSON:
+#
+#   POST /jobs                 a job or a list of jobs like the ones of the
+#                              batch manifest (see _batch_jobs_from_json), each
+#                              with an optional "priority" (higher runs
+#                              first), the answer is the list of their ids
+#   GET  /jobs?status=queued   the jobs, all of them without status
+#   GET  /jobs/<id>            a job
+#   POST /jobs/<id>/cancel     removes a queued job or cancels a running one
+#   GET  /jobs/<id>/log        the log of the job, also while it runs, without
+#                              the parts that were rotated
+#
+# The requests must have the worker_token in the X-Orchestrator-Token header,
+# without it the service does not start. The jobs cannot change the executables
+# of the configuration, since whoever submits them would run what they want.
+
+SERVICE_DB = "orchestrator_service.sqlite3"
+JOB_STATUSES = ["queued", "running", "done", "failed", "cancelled"]
+_SERVICE_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+_SERVICE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id        INTEGER PRIMARY KEY AUTOINCREMENT,
+    name      TEXT NOT NULL,
+    job       TEXT NOT NULL, -- The JSON of the job as submitted.
+    priority  INTEGER NOT NULL DEFAULT 0,
+    status    TEXT NOT NULL DEFAULT 'queued',
+    submitted TEXT NOT NULL,
+    started   TEXT NOT NULL DEFAULT '',
+    finished  TEXT NOT NULL DEFAULT '',
+    log       TEXT NOT NULL DEFAULT '',
+    backup    TEXT NOT NULL DEFAULT '',
+    error     TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority DESC, id);
+"""
+_JOB_COLUMNS = ["id", "name", "job", "priority", "status", "submitted", "started",
+    "finished", "log", "backup", "error"]
 
-    match end:
-        case Proc.L2FT:
-            logger.info("running L2FT")
-            # This does not support logging options apparently.
-            # To decide if repr or oper shall be run the appropriate processor
-            # can be selected from the options.
-            _run_processor(
-                conf[Conf.L2FT_EXE],
-                f"{start_date} {end_date} {config_file_to_use}"
-            )
-        case Proc.L2FB:
-            logger.info("running L2FB")
-            _run_processor(
-                conf[Conf.L2FB_EXE],
-                f"{start_date} {end_date} {config_file_to_use}"
-            )
-        case Proc.L2SM:
-            logger.info("running L2SM")
-            l2sm_working_dir = os.path.dirname(os.path.dirname(conf[Conf.L2SM_EXE]))
-            _run_processor(
-                conf[Conf.L2SM_EXE],
-                f"{start_date}T00:00 {end_date}T23:59 {config_file_to_use}"
-            )
-        case Proc.L2SI:
-            logger.info("running L2SI")
-            l2si_dir = os.path.join(auxiliary_data_dir, "L2OP-SI")
-            _run_processor(
-                conf[Conf.L2SI_EXE],
-                # f"--StartDateTime {start_date}T00:00 --StopDateTime {end_date}T23:59 --ConfigFile {config_file_to_use}"
-                f"--StartDateTime {start_date}T00:00 --StopDateTime {end_date}T23:59"
-            )
-        case other:
-            assert False
+def _now_for_service() -> str:
+    return time.strftime(_SERVICE_TIME_FORMAT, time.gmtime())
+
+class _ServiceRequestHandler(http.server.BaseHTTPRequestHandler):
+    server: "OrchestratorService"
 
-    _check_existence_of_netcdf_file(os.path.join(data_release_dir(), PROC_OUTPUT_DIRS[end]))
-    _do_backup_and_pam(start, end, conf, experiment_name, which_hydrognss, pam)
+    log_message = _AgentRequestHandler.log_message
+    _authorized = _AgentRequestHandler._authorized
+    _send_json = _AgentRequestHandler._send_json
+
+    def _job_id(self, parts: list[str]) -> typing.Optional[int]:
+        try:
+            return int(parts[1])
+        except (IndexError, ValueError):
+            return None
+
+    def do_GET(self) -> None:
+        if not self._authorized():
+            return
+        url = urllib.parse.urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        job_id = self._job_id(parts)
+        if parts == ["jobs"]:
+            status = urllib.parse.parse_qs(url.query).get("status", [""])[0]
+            self._send_json(self.server.jobs(status))
+        elif parts[0] == "jobs" and job_id is not None and len(parts) == 2:
+            job = self.server.job(job_id)
+            if job is None:
+                self.send_error(404)
+            else:
+                self._send_json(job)
+        elif parts[0] == "jobs" and job_id is not None and parts[2:] == ["log"]:
+            job = self.server.job(job_id)
+            try:
+                if job is None or not job["log"]:
+                    raise FileNotFoundError()
+                # The old logs are compressed.
+                if os.path.isfile(job["log"]):
+                    with open(job["log"], "rb") as f:
+                        body = f.read()
+                else:
+                    with gzip.open(f"{job['log']}.gz", "rb") as f:
+                        body = f.read()
+            except FileNotFoundError:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", f"{len(body)}")
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_error(404)
+
+    def do_POST(self) -> None:
+        if not self._authorized():
+            return
+        parts = urllib.parse.urlsplit(self.path).path.strip("/").split("/")
+        job_id = self._job_id(parts)
+        if parts == ["jobs"]:
+            try:
+                jobs_json = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                self._send_json(self.server.submit(jobs_json))
+            except (ValueError, TypeError) as ex:
+                self.send_error(400, f"{ex}")
+        elif parts[0] == "jobs" and job_id is not None and parts[2:] == ["cancel"]:
+            if self.server.cancel(job_id):
+                self._send_json({})
+            else:
+                self.send_error(409, "the job is not queued or running")
+        else:
+            self.send_error(404)
+
+class OrchestratorService(http.server.ThreadingHTTPServer):
+    """Runs the jobs in the database as they are submitted. With port 0 a free
+    port is chosen (see url). The jobs that were running when the service
+    stopped are marked as failed. The worker_token of the settings is
+    required."""
+    daemon_threads = True
+    url = WorkerAgent.url
+
+    def __init__(self, conf: list[str], log_dir: str,
+        settings: Settings = SETTINGS_DEFAULT, host: str = "127.0.0.1",
+        port: int = 0, db_path: str = ""):
+        if not settings["worker_token"]:
+            raise ValueError("a worker_token is required")
+        super().__init__((host, port), _ServiceRequestHandler)
+        self.conf = conf
+        self.log_dir = log_dir
+        self.settings = settings
+        self.token = settings["worker_token"]
+        self.db_path = db_path or os.path.join(log_dir, SERVICE_DB)
+        # The connection is used by the HTTP threads and by the scheduler.
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.lock = threading.Condition()
+        self.controllers: dict[int, RunController] = {}
+        self.data_dirs: set[str] = set() # The ones used by the running jobs.
+        self.stopping = False
+        with self.lock, self.db:
+            self.db.executescript(_SERVICE_SCHEMA)
+            self.db.execute("UPDATE jobs SET status = 'failed', finished = ?, "
+                "error = 'the service stopped while the job was running' "
+                "WHERE status = 'running'", (_now_for_service(),))
+        self.threads: list[threading.Thread] = []
+
+    def start(self) -> None:
+        """Serves and runs the jobs in background threads, stop them with
+        shutdown."""
+        for target, name in ((self.serve_forever, "service"), (self._schedule, "scheduler")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def shutdown(self) -> None:
+        """Stops accepting requests and jobs and cancels the running ones."""
+        super().shutdown()
+        with self.lock:
+            self.stopping = True
+            for controller in self.controllers.values():
+                controller.cancel()
+            self.lock.notify_all()
+            threads = list(self.threads)
+        for thread in threads:
+            thread.join()
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.db.close()
+
+    def submit(self, jobs_json: typing.Any) -> list[int]:
+        if isinstance(jobs_json, dict):
+            jobs_json = [jobs_json]
+        # Validated now so that the mistakes are reported to who submits.
+        jobs = _batch_jobs_from_json(jobs_json, self.conf, allow_exes=False)
+        res = []
+        with self.lock, self.db:
+            for job, job_json in zip(jobs, jobs_json):
+                priority = job_json.get("priority", 0)
+                if type(priority) != int:
+                    raise TypeError("the priority must be an integer")
+                cursor = self.db.execute("INSERT INTO jobs (name, job, priority, "
+                    "submitted) VALUES (?, ?, ?, ?)", (job["name"],
+                    json.dumps(job_json), priority, _now_for_service()))
+                assert cursor.lastrowid is not None # Just for mypy.
+                res.append(cursor.lastrowid)
+            self.lock.notify_all()
+        logger.info(f"submitted the jobs {', '.join(map(str, res))}")
+        return res
+
+    def _row_to_json(self, row: sqlite3.Row) -> dict:
+        res = dict(row)
+        res["job"] = json.loads(res["job"])
+        # The log of a running job is already there.
+        if row["id"] in self.controllers:
+            res["log"] = self.controllers[row["id"]].log_path
+        return res
+
+    def jobs(self, status: str = "") -> list[dict]:
+        with self.lock:
+            rows = self.db.execute("SELECT * FROM jobs WHERE ? = '' OR status = ? "
+                "ORDER BY id", (status, status)).fetchall()
+            return [self._row_to_json(row) for row in rows]
+
+    def job(self, job_id: int) -> typing.Optional[dict]:
+        with self.lock:
+            row = self.db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            return self._row_to_json(row) if row is not None else None
+
+    def cancel(self, job_id: int) -> bool:
+        with self.lock, self.db:
+            if job_id in self.controllers:
+                self.controllers[job_id].cancel()
+                return True
+            cursor = self.db.execute("UPDATE jobs SET status = 'cancelled', "
+                "finished = ? WHERE id = ? AND status = 'queued'",
+                (_now_for_service(), job_id))
+            return cursor.rowcount == 1
+
+    def _next_job(self) -> typing.Optional[tuple[int, BatchJob]]:
+        """The queued job with the highest priority whose data directory is
+        free, it is marked as running. Must be called with the lock held."""
+        if len(self.controllers) >= self.settings["batch_workers"]:
+            return None
+        rows = self.db.execute("SELECT id, job FROM jobs WHERE status = 'queued' "
+            "ORDER BY priority DESC, id").fetchall()
+        for row in rows:
+            try:
+                # With the configuration of now, not of when it was submitted.
+                job = _batch_jobs_from_json([json.loads(row["job"])], self.conf,
+                    allow_exes=False)[0]
+            except ValueError as ex:
+                with self.db:
+                    self.db.execute("UPDATE jobs SET status = 'failed', "
+                        "finished = ?, error = ? WHERE id = ?",
+                        (_now_for_service(), f"{ex}", row["id"]))
+                continue
+            data_dir = os.path.normcase(job["conf"][Conf.DATA_DIR])
+            if data_dir in self.data_dirs:
+                continue
+            self.data_dirs.add(data_dir)
+            with self.db:
+                self.db.execute("UPDATE jobs SET status = 'running', started = ? "
+                    "WHERE id = ?", (_now_for_service(), row["id"]))
+            return row["id"], job
+        return None
+
+    def _schedule(self) -> None:
+        with self.lock:
+            while not self.stopping:
+                next_job = self._next_job()
+                if next_job is None:
+                    self.lock.wait()
+                    continue
+                job_id, job = next_job
+                controller = RunController(job["args"], job["conf"],
+                    job["l1a_input_file"], self.log_dir, self.settings,
+                    f"job{job_id}")
+                self.controllers[job_id] = controller
+                thread = threading.Thread(target=self._run_job,
+                    args=(job_id, job, controller), name=f"job{job_id}", daemon=True)
+                thread.start()
+                self.threads = [thread for thread in self.threads if thread.is_alive()]
+                self.threads.append(thread)
+
+    def _run_job(self, job_id: int, job: BatchJob, controller: RunController) -> None:
+        logger.info(f"starting the job {job_id} ({job['name']})")
+        controller.start()
+        last_event = None
+        # The events are not needed but they have to be consumed.
+        while controller.running() or not controller.events.empty():
+            for event in controller.poll():
+                if event.kind in ("finished", "failed", "cancelled"):
+                    last_event = event
+            controller.join(_WATCHDOG_INTERVAL)
+        status = last_event.kind if last_event is not None else "failed"
+        if status == "finished":
+            status = "done"
+        started = ""
+        with self.lock:
+            if status == "cancelled" and self.stopping:
+                # It is run again from the start when the service restarts.
+                status = "queued"
+            else:
+                started = self.db.execute("SELECT started FROM jobs WHERE id = ?",
+                    (job_id,)).fetchone()["started"]
+        logger.info(f"the job {job_id} ({job['name']}) is {status}")
+        with self.lock, self.db:
+            self.db.execute("UPDATE jobs SET status = ?, started = ?, finished = ?, "
+                "log = ?, backup = ?, error = ? WHERE id = ?", (status, started,
+                "" if status == "queued" else _now_for_service(), controller.log_path, controller.backup_path,
+                last_event.text if last_event is not None and status != "done" else "",
+                job_id))
+            del self.controllers[job_id]
+            self.data_dirs.discard(os.path.normcase(job["conf"][Conf.DATA_DIR]))
+            self.lock.notify_all()
+
+def _service_request(url: str, method: str, path: str, token: str,
+    body: typing.Any = None) -> typing.Any:
+    return json.load(_worker_request(url, method, path, token, body))
+
+# How often the GUI shows the events of the running orchestration.
+_GUI_POLL_INTERVAL_MS = 100
+# How many lines are kept in the log pane of the GUI.
+_GUI_LOG_LINES = 5000
+
+# The keys of the state file that were added later, missing in the older ones.
+_STATE_KEYS_ADDED_LATER = {"extra_ends"}
+
+def _read_state(state_file: typing.TextIO) -> Args:
+    """Reads the arguments saved by the GUI. The exceptions are the ones of
+    json.load, KeyError, TypeError and ValueError."""
+    state_json = json.load(state_file)
+
+    annotations = inspect.get_annotations(Args)
+    keys  = list(annotations.keys())
+    types = list(annotations.values())
+    del annotations
+
+    for i in range(len(keys)):
+        key = keys[i]
+        if key in _STATE_KEYS_ADDED_LATER and key not in state_json:
+            continue
+        actual_type = type(state_json[key])
+        # For generic aliases like list[Proc] we check only the container.
+        correct_type = typing.get_origin(types[i]) or types[i]
+        if not issubclass(correct_type, actual_type):
+            raise TypeError(f"the key {key} has type {actual_type} instead "
+                f"of {correct_type}")
+
+    if set(state_json.keys()) - set(keys):
+        logger.warning("the state file has extraneous keys")
+
+    # TODO: clamp start and end.
+    # We delay all path valitions to the run function, since the default
+    # that we give in case of error could also don't exist.
+    args: Args = {
+        "start": Proc(state_json["start"]),
+        "end": Proc(state_json["end"]),
+        "pam": state_json["pam"],
+        "backup": state_json["backup"],
+        "log_level": state_json["log_level"],
+        "extra_ends": [Proc(extra_end)
+            for extra_end in state_json.get("extra_ends", [])],
+    }
+    if not validate_arguments(args):
+        raise ValueError("the state file has an illegal configuration")
+    return args
 
 # TODO: add the name for the file object for better error messages.
 # Sadly state and configuration files have not been versioned from the start.
-def gui(state_file: typing.TextIO, config_file: typing.TextIO, conf: list[str], log_dir: str) -> None:
+def gui(state_file: typing.TextIO, config_file: typing.TextIO, conf: list[str],
+    log_dir: str, settings: Settings = SETTINGS_DEFAULT) -> None:
     """This function creates a user friendly GUI to operate the orchestrator."""
     assert len(conf) == len(Conf)
+    assert validate_settings(settings)
 
     start: Proc
     end: Proc
     pam: bool
     backup: str
+    extra_ends: list[Proc]
 
     try:
-        state_json = json.load(state_file)
-
-        annotations = inspect.get_annotations(Args)
-        keys  = list(annotations.keys())
-        types = list(annotations.values())
-        del annotations
-
-        for i in range(len(keys)):
-            key = keys[i]
-            actual_type = type(state_json[key])
-            correct_type = types[i]
-            if not issubclass(correct_type, actual_type):
-                raise TypeError(f"the key {key} has type {actual_type} instead "
-                    f"of {correct_type}")
-
-        if len(state_json.keys()) != len(keys):
-            logger.warning("the state file has extraneous keys")
-
-        # TODO: clamp start and end.
-        start = Proc(state_json["start"])
-        end = Proc(state_json["end"])
-        pam = state_json["pam"]
-        backup = state_json["backup"]
-        log_level = state_json["log_level"]
-
-        # We delay all path valitions to the run function, since the default
-        # that we give in case of error could also don't exist.
-
-        args: Args = {"start": start, "end": end, "pam": pam, "backup": backup,
-            "log_level": log_level}
-        if not validate_arguments(args):
-            raise ValueError("the state file has an illegal configuration")
+        args = _read_state(state_file)
+        start = args["start"]
+        end = args["end"]
+        pam = args["pam"]
+        backup = args["backup"]
+        log_level = args["log_level"]
+        extra_ends = args["extra_ends"]
         del args
     except (json.JSONDecodeError, KeyError, TypeError, ValueError):
         logger.exception("an error while reading the previous state file, using"
@@ -833,6 +5252,7 @@ def gui(state_file: typing.TextIO, config_file: typing.TextIO, conf: list[str],
         pam = ARGS_DEFAULT["pam"]
         backup = ARGS_DEFAULT["backup"]
         log_level = ARGS_DEFAULT["log_level"]
+        extra_ends = list(ARGS_DEFAULT["extra_ends"])
 
     # Be carefull in the way you create istances of tkinter.Variable. You have
     # to keep a reference to each one of them somewere, either in a function or
@@ -854,7 +5274,8 @@ def gui(state_file: typing.TextIO, config_file: typing.TextIO, conf: list[str],
                 "end": Proc[end_var.get()],
                 "pam": pam_var.get(),
                 "backup": backup_var.get(),
-                "log_level": LogLevel(log_level_combobox.current())
+                "log_level": LogLevel(log_level_combobox.current()),
+                "extra_ends": selected_extra_ends(),
             }
             assert validate_arguments(res)
             logger.info("saving state file")
@@ -862,7 +5283,17 @@ def gui(state_file: typing.TextIO, config_file: typing.TextIO, conf: list[str],
         except Exception:
             logger.exception("unable to save the state")
         root.destroy()
-    root.protocol("WM_DELETE_WINDOW", save_state_and_close)
+    def close() -> None:
+        if controller is not None and controller.running():
+            if not tkinter.messagebox.askokcancel("Cancel the orchestration?",
+                "An orchestration is running, closing the window cancels it."):
+                return
+            controller.cancel()
+            # The processors are killed quickly, the rest of the run has to end
+            # before the log is closed.
+            controller.join()
+        save_state_and_close()
+    root.protocol("WM_DELETE_WINDOW", close)
 
     # Settings Toplevel
 
@@ -970,6 +5401,9 @@ def gui(state_file: typing.TextIO, config_file: typing.TextIO, conf: list[str],
             f'\t"{option.name}": "{_escape_string(conf_vars[option].get())}"'
             for option in Conf
         ]
+        # The settings are not editable from the GUI but we have to write them
+        # back to not lose them.
+        res += [f'\t"{key}": {json.dumps(value)}' for key, value in settings.items()]
         res = "{\n" + ",\n".join(res) + "\n}"
 
         try:
@@ -1029,7 +5463,7 @@ def gui(state_file: typing.TextIO, config_file: typing.TextIO, conf: list[str],
 
     backup_dialog = lambda: tkinter.filedialog.askopenfilename(
         parent=root,
-        filetypes=[("ZIP Archive", ".zip")],
+        filetypes=[("ZIP Archive", ".zip"), ("Backup Store Manifest", ".json")],
         initialdir=conf_vars[Conf.BACKUP_DIR].get(),
         title="Select a backup file",
         multiple=False # type: ignore
@@ -1064,6 +5498,28 @@ def gui(state_file: typing.TextIO, config_file: typing.TextIO, conf: list[str],
     )
     log_level_combobox.grid(column=5, row=2, sticky="n")
 
+    extra_ends_label_frame = tkinter.ttk.LabelFrame(orchestrator_frame,
+        text="Also run", labelanchor="n")
+    extra_ends_label_frame.grid(column=0, row=3, columnspan=6, pady=".3c")
+    # Only the Level-2 processors can be selected.
+    extra_end_vars: dict[Proc, tkinter.BooleanVar] = {}
+    for proc in Proc:
+        if proc <= Proc.L1B:
+            continue
+        var = tkinter.BooleanVar(root, proc in extra_ends, f"extra_end_var_{proc.name}")
+        extra_end_vars[proc] = var
+        tkinter.ttk.Checkbutton(
+            extra_ends_label_frame,
+            text=proc.name,
+            variable=var,
+            onvalue=True,
+            offvalue=False
+        ).grid(column=proc.value, row=0, padx=".2c")
+    del var
+
+    def selected_extra_ends() -> list[Proc]:
+        return [proc for proc, var in extra_end_vars.items() if var.get()]
+
     def keep_ui_invariant(name1, name2, op):
         """https://tcl.tk/man/tcl8.5/TclCmd/trace.htm#M14"""
         start = Proc[start_var.get()]
@@ -1087,6 +5543,9 @@ def gui(state_file: typing.TextIO, config_file: typing.TextIO, conf: list[str],
                         start_combobox.current(end.value)
                 if end < Proc.L1B:
                     pam_var.set(False)
+                for proc, var in extra_end_vars.items():
+                    if end <= Proc.L1B or proc == end:
+                        var.set(False)
             # Both the PAM checkbox and the backup entry should be both cleared
             # and disabled if are not valid to input and enabled otherwise. This
             # is a more crude approach that is slightly simpler to implement.
@@ -1096,6 +5555,10 @@ def gui(state_file: typing.TextIO, config_file: typing.TextIO, conf: list[str],
             case "backup_var":
                 if start == Proc.L1A:
                     backup_var.set("")
+            case extra_end_var if extra_end_var.startswith("extra_end_var_"):
+                proc = Proc[extra_end_var.removeprefix("extra_end_var_")]
+                if end <= Proc.L1B or proc == end:
+                    extra_end_vars[proc].set(False)
             case other:
                 assert False
 
@@ -1104,6 +5567,9 @@ def gui(state_file: typing.TextIO, config_file: typing.TextIO, conf: list[str],
     end_var.trace_add("write", keep_ui_invariant)
     pam_var.trace_add("write", keep_ui_invariant)
     backup_var.trace_add("write", keep_ui_invariant)
+    for var in extra_end_vars.values():
+        var.trace_add("write", keep_ui_invariant)
+    del var
 
     def orchestrate_simulation() -> None:
         if Proc[start_var.get()] > Proc.L1A and not backup_var.get():
@@ -1123,17 +5589,59 @@ def gui(state_file: typing.TextIO, config_file: typing.TextIO, conf: list[str],
             "pam": pam_var.get(),
             "backup": backup_var.get(),
             "log_level": LogLevel(log_level_combobox.current()),
+            "extra_ends": selected_extra_ends(),
         }
 
-        with LogToFileContext(start_var.get(), end_var.get(), log_dir):
-            run(
-                args=args,
-                conf=conf,
-                l1a_input_file=""
-            )
-
-        # We close the window because it was the required behaviour.
-        save_state_and_close()
+        nonlocal controller
+        controller = RunController(args, conf, "", log_dir, settings)
+        log_text.configure(state="normal")
+        log_text.delete("1.0", "end")
+        log_text.configure(state="disabled")
+        run_button.state(["disabled"])
+        cancel_button.state(["!disabled"])
+        controller.start()
+        root.after(_GUI_POLL_INTERVAL_MS, show_run_events)
+
+    # The orchestration runs on another thread and the GUI shows what it does in
+    # the log pane, so that the window stays responsive.
+    controller: typing.Optional[RunController] = None
+
+    def append_to_log(line: str) -> None:
+        log_text.configure(state="normal")
+        log_text.insert("end", line + "\n")
+        # Only the last lines are kept to not slow down the GUI.
+        lines = int(log_text.index("end-1c").split(".")[0])
+        if lines > _GUI_LOG_LINES:
+            log_text.delete("1.0", f"{lines - _GUI_LOG_LINES}.0")
+        log_text.configure(state="disabled")
+        log_text.see("end")
+
+    def show_run_events() -> None:
+        assert controller is not None # Just for mypy.
+        for event in controller.poll():
+            match event.kind:
+                case "log":
+                    append_to_log(event.text)
+                case "stage_started":
+                    append_to_log(f"=== {event.text} started")
+                case "stage_finished":
+                    append_to_log(f"=== {event.text} finished in {event.seconds:.1f} s")
+                case "stage_failed":
+                    append_to_log(f"=== {event.text} failed after {event.seconds:.1f} s")
+                case "finished":
+                    append_to_log(f"=== orchestration finished in "
+                        f"{event.seconds:.1f} s, backup: {event.text}")
+                case "failed":
+                    append_to_log(f"=== orchestration failed after "
+                        f"{event.seconds:.1f} s: {event.text}")
+                case "cancelled":
+                    append_to_log(f"=== orchestration cancelled after "
+                        f"{event.seconds:.1f} s")
+        if controller.running() or not controller.events.empty():
+            root.after(_GUI_POLL_INTERVAL_MS, show_run_events)
+        else:
+            run_button.state(["!disabled"])
+            cancel_button.state(["disabled"])
 
     run_button = tkinter.ttk.Button(
         orchestrator_frame,
@@ -1142,6 +5650,23 @@ def gui(state_file: typing.TextIO, config_file: typing.TextIO, conf: list[str],
     )
     run_button.grid(column=0, row=2, columnspan=2)
 
+    cancel_button = tkinter.ttk.Button(
+        orchestrator_frame,
+        text="Cancel",
+        command=lambda: controller is not None and controller.cancel() # type: ignore
+    )
+    cancel_button.state(["disabled"])
+    cancel_button.grid(column=2, row=2)
+
+    log_frame = tkinter.ttk.Frame(orchestrator_frame)
+    log_frame.grid(column=0, row=4, columnspan=6, pady=".3c")
+    log_text = tkinter.Text(log_frame, width=100, height=20, state="disabled",
+        wrap="none")
+    log_scrollbar = tkinter.ttk.Scrollbar(log_frame, command=log_text.yview)
+    log_text.configure(yscrollcommand=log_scrollbar.set)
+    log_text.grid(column=0, row=0)
+    log_scrollbar.grid(column=1, row=0, sticky="ns")
+
     settings_button = tkinter.ttk.Button(
         orchestrator_frame,
         text="Settings",
@@ -1184,10 +5709,10 @@ def _main() -> int:
             raise Exception("unable to create a necessary file or directory for"
                 " the orchestrator") from ex
 
-    log_dir = "..\\log"
-    if not os.path.exists(log_dir) and os.name == "nt":
+    log_dir = os.path.join("..", "log")
+    if not os.path.isdir(log_dir):
         print("the orchestrator was not launched from the correct working "
-            "directory, it did not found the ..\\log directory",
+            f"directory, it did not found the {log_dir} directory",
             file=sys.stderr)
         return 1
 
@@ -1195,6 +5720,7 @@ def _main() -> int:
     formatter = logging.Formatter("%(levelname)s:%(funcName)s %(message)s")
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setFormatter(formatter)
+    console_handler.addFilter(_not_lowered_for_jobs)
     logger.addHandler(console_handler)
 
     try:
@@ -1207,16 +5733,20 @@ def _main() -> int:
                 raise TypeError(f"the key {key} has type {actual_type} instead "
                     f"of {str}")
 
-        if len(conf_json.keys()) != len(Conf):
+        known_keys = set(_enum_members_as_strings(Conf)) \
+            | set(inspect.get_annotations(Settings))
+        if not conf_json.keys() <= known_keys:
             logger.warning("the configuration file has extraneous keys")
 
         # Again we delay the path validation.
 
         conf = [conf_json[key.name] for key in Conf] # We read only the keys that we need.
+        settings = _settings_from_json(conf_json)
     except (json.JSONDecodeError, KeyError, TypeError):
         logger.exception("an error occured while reading the configuration file"
             "using the default one instead")
         conf = list(CONF_VALUES_DEFAULT)
+        settings = SETTINGS_DEFAULT.copy()
 
     # TODO: find a way to install the files the first time we run the
     #       orchestrator that does not involve a bunch of errors like now.
@@ -1224,35 +5754,307 @@ def _main() -> int:
     parser = argparse.ArgumentParser(prog='HydroGNSS Orchestrator',
         description='This is the program that coordinates the various level 1 '
         'and level 2 processors.')
-    parser.add_argument('-start', action='store', type=lambda x: Proc[x], required=True)
-    parser.add_argument('-end', action='store', type=lambda x: Proc[x], required=True)
+    parser.add_argument('-start', action='store', type=lambda x: Proc[x])
+    # More than one Level-2 processor can be given separated by commas.
+    parser.add_argument('-end', action='store',
+        type=lambda x: [Proc[proc] for proc in x.split(",")])
     parser.add_argument('-pam', action='store_true')
     parser.add_argument('-backup', action='store', default="", type=str)
     parser.add_argument('-log_level', action='store', type=lambda x: LogLevel[x], default=LogLevel.INFO)
     parser.add_argument('-hsavers', action='store', default="", type=str)
+    parser.add_argument('-l1b_shard', action='store', choices=L1B_SHARD_MODES,
+        default=settings["l1b_shard"])
+    parser.add_argument('-l1b_shard_workers', action='store', type=int,
+        default=settings["l1b_shard_workers"])
+    parser.add_argument('-max_parallel_stages', action='store', type=int,
+        default=settings["max_parallel_stages"])
+    # To run many orchestrations one after the other, see _batch_jobs_from_json
+    # for the format of the manifest. The other arguments are then ignored.
+    parser.add_argument('-batch', action='store', default="", type=str)
+    parser.add_argument('-batch_results', action='store', default="", type=str)
+    parser.add_argument('-batch_workers', action='store', type=int,
+        default=settings["batch_workers"])
+    parser.add_argument('-backup_format', action='store', choices=BACKUP_FORMATS,
+        default=settings["backup_format"])
+    parser.add_argument('-io_workers', action='store', type=int,
+        default=settings["io_workers"])
+    parser.add_argument('-zip_compression_level', action='store', type=int,
+        default=settings["zip_compression_level"])
+    parser.add_argument('-compression_workers', action='store', type=int,
+        default=settings["compression_workers"])
+    parser.add_argument('-l1a_promotion', action='store', choices=PROMOTION_MODES,
+        default=settings["l1a_promotion"])
+    parser.add_argument('-backup_cache_dir', action='store', type=str,
+        default=settings["backup_cache_dir"])
+    parser.add_argument('-backup_cache_size_mb', action='store', type=int,
+        default=settings["backup_cache_size_mb"])
+    # Shows or empties the cache of the extracted backups. The other arguments
+    # are then ignored.
+    parser.add_argument('-backup_cache', action='store', choices=["info", "purge"])
+    parser.add_argument('-stage_cache_dir', action='store', type=str,
+        default=settings["stage_cache_dir"])
+    parser.add_argument('-stage_cache_size_mb', action='store', type=int,
+        default=settings["stage_cache_size_mb"])
+    # Shows the statistics of the stage cache or empties it. The other arguments
+    # are then ignored.
+    parser.add_argument('-stage_cache', action='store', choices=["info", "purge"])
+    # Deletes from the stage cache the entries of a comma separated list of
+    # processors or stages (e.g. L1B,L1B_CX). The other arguments are then
+    # ignored.
+    parser.add_argument('-stage_cache_invalidate', action='store', default="", type=str)
+    # Updates the catalog of the backups and lists the ones of the experiments
+    # that match the pattern (all of them without it), that cover the date given
+    # with -catalog_date (e.g. 2021-12-31) and that have the outputs in the comma
+    # separated list given with -catalog_outputs (e.g. L2OP-FB,L2OP-SSM). The
+    # other arguments are then ignored.
+    parser.add_argument('-catalog', action='store', nargs='?', const="*", default="",
+        type=str)
+    parser.add_argument('-catalog_date', action='store', default="", type=str)
+    parser.add_argument('-catalog_outputs', action='store', default="", type=str)
+    # Checks all the files of a backup against their SHA-256. The other
+    # arguments are then ignored.
+    parser.add_argument('-verify', action='store', default="", type=str)
+    # Continues the orchestration in the data directory from the stages that did
+    # not finish. -start and -end can be omitted.
+    parser.add_argument('-resume', action='store_true')
+    # Writes the zip of a backup in the store next to its manifest. The other
+    # arguments are then ignored.
+    parser.add_argument('-rebuild_zip', action='store', default="", type=str)
+    # Runs a worker agent listening on HOST:PORT that runs the processors of
+    # this configuration for other orchestrators. The other arguments are then
+    # ignored.
+    parser.add_argument('-agent', action='store', default="", type=str)
+    parser.add_argument('-agent_slots', action='store', type=int, default=1)
+    # Runs the service on HOST:PORT, where the jobs can be submitted. With
+    # -submit, -jobs or -cancel_job the service is contacted instead. The other
+    # arguments are then ignored.
+    parser.add_argument('-service', action='store', default="", type=str)
+    # A batch manifest with the jobs to submit to the service.
+    parser.add_argument('-submit', action='store', default="", type=str)
+    parser.add_argument('-jobs', action='store_true')
+    parser.add_argument('-cancel_job', action='store', type=int)
     parser.add_argument('--version', action='version', version=VERSION)
 
     if len(sys.argv) == 1:
         try:
-            gui(state_file, config_file, conf, log_dir)
+            gui(state_file, config_file, conf, log_dir, settings)
         except Exception as ex:
             raise Exception("unable to create the GUI") from ex
     else:
         parsed_args = parser.parse_args()
-        args: Args = {
-            "start": parsed_args.start,
-            "end": parsed_args.end,
-            "pam": parsed_args.pam,
-            "backup": parsed_args.backup,
-            "log_level": parsed_args.log_level,
-        }
-        if not validate_arguments(args):
+        settings["l1b_shard"] = parsed_args.l1b_shard
+        settings["l1b_shard_workers"] = parsed_args.l1b_shard_workers
+        settings["max_parallel_stages"] = parsed_args.max_parallel_stages
+        settings["batch_workers"] = parsed_args.batch_workers
+        settings["backup_format"] = parsed_args.backup_format
+        settings["io_workers"] = parsed_args.io_workers
+        settings["zip_compression_level"] = parsed_args.zip_compression_level
+        settings["backup_cache_dir"] = parsed_args.backup_cache_dir
+        settings["l1a_promotion"] = parsed_args.l1a_promotion
+        settings["backup_cache_size_mb"] = parsed_args.backup_cache_size_mb
+        settings["compression_workers"] = parsed_args.compression_workers
+        settings["stage_cache_dir"] = parsed_args.stage_cache_dir
+        settings["stage_cache_size_mb"] = parsed_args.stage_cache_size_mb
+        if not validate_settings(settings):
+            logger.error("the settings are invalid")
+            return 1
+
+        if parsed_args.backup_cache:
+            cache_dir = settings["backup_cache_dir"]
+            if not cache_dir:
+                logger.error("the backup cache is not enabled")
+                return 1
+            try:
+                if parsed_args.backup_cache == "purge":
+                    _purge_backup_cache(cache_dir)
+                    logger.info("backup cache purged")
+                else:
+                    index = _read_backup_cache_index(cache_dir)
+                    for entry in sorted(index.values(), key=lambda entry: entry["last_used"]):
+                        last_used = time.strftime("%Y-%m-%d %H:%M:%S",
+                            time.localtime(entry["last_used"]))
+                        logger.info(f"{last_used} {entry['size'] >> 20:8} MB {entry['backup']}")
+                    total = sum(entry["size"] for entry in index.values())
+                    logger.info(f"{len(index)} backups, {total >> 20} MB of "
+                        f"{settings['backup_cache_size_mb']} MB")
+            except Exception:
+                logger.exception("unable to access the backup cache")
+                return 1
+            return 0
+
+        if parsed_args.stage_cache or parsed_args.stage_cache_invalidate:
+            cache_dir = settings["stage_cache_dir"]
+            if not cache_dir:
+                logger.error("the stage cache is not enabled")
+                return 1
+            try:
+                if parsed_args.stage_cache_invalidate:
+                    names = parsed_args.stage_cache_invalidate.split(",")
+                    invalid = [name for name in names
+                        if name not in Stage.__members__ and name not in Proc.__members__]
+                    if invalid:
+                        logger.error(f"unknown processors or stages: {', '.join(invalid)}")
+                        return 1
+                    deleted = _invalidate_stage_cache(cache_dir, names)
+                    logger.info(f"{deleted} entries deleted from the stage cache")
+                elif parsed_args.stage_cache == "purge":
+                    shutil.rmtree(cache_dir, ignore_errors=True)
+                    logger.info("stage cache purged")
+                else:
+                    index = _read_stage_cache_json(cache_dir, STAGE_CACHE_INDEX)
+                    stats = _read_stage_cache_json(cache_dir, STAGE_CACHE_STATS)
+                    for stage in STAGE_EXES:
+                        counts = stats.get(stage.name, {"hits": 0, "misses": 0})
+                        entries = [entry for entry in index.values()
+                            if entry["stage"] == stage.name]
+                        logger.info(f"{stage.name:12} {counts['hits']:6} hits "
+                            f"{counts['misses']:6} misses {len(entries):4} entries "
+                            f"{sum(entry['size'] for entry in entries) >> 20:8} MB")
+                    total = sum(entry["size"] for entry in index.values())
+                    logger.info(f"{len(index)} entries, {total >> 20} MB of "
+                        f"{settings['stage_cache_size_mb']} MB")
+            except Exception:
+                logger.exception("unable to access the stage cache")
+                return 1
+            return 0
+
+        if parsed_args.service:
+            host, _, port = parsed_args.service.rpartition(":")
+            url = f"http://{parsed_args.service}"
+            token = settings["worker_token"]
+            try:
+                if parsed_args.submit:
+                    with open(parsed_args.submit) as f:
+                        job_ids = _service_request(url, "POST", "/jobs", token, json.load(f))
+                    logger.info(f"submitted the jobs {', '.join(map(str, job_ids))}")
+                    return 0
+                if parsed_args.cancel_job is not None:
+                    _service_request(url, "POST", f"/jobs/{parsed_args.cancel_job}/cancel", token)
+                    logger.info(f"job {parsed_args.cancel_job} cancelled")
+                    return 0
+                if parsed_args.jobs:
+                    for job in _service_request(url, "GET", "/jobs", token):
+                        logger.info(f"{job['id']:6} {job['status']:9} {job['priority']:4} "
+                            f"{job['submitted']} {job['name']} {job['error']}")
+                    return 0
+            except Exception:
+                logger.exception(f"unable to talk with the service at {url}")
+                return 1
+            try:
+                service = OrchestratorService(conf, log_dir, settings, host, int(port))
+            except Exception:
+                logger.exception("unable to start the service")
+                return 1
+            logger.info(f"service listening on {service.url}, running "
+                f"{settings['batch_workers']} jobs at a time")
+            service.start()
+            try:
+                while True:
+                    time.sleep(1)
+            except KeyboardInterrupt:
+                pass
+            service.shutdown()
+            service.server_close()
+            return 0
+
+        if parsed_args.agent:
+            host, _, port = parsed_args.agent.rpartition(":")
+            try:
+                agent = WorkerAgent(conf, host, int(port), parsed_args.agent_slots,
+                    settings["worker_token"])
+            except Exception:
+                logger.exception("unable to start the worker agent")
+                return 1
+            logger.info(f"worker agent listening on {agent.url} with "
+                f"{parsed_args.agent_slots} slots")
+            try:
+                agent.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            agent.server_close()
+            return 0
+
+        if parsed_args.verify:
+            try:
+                report = _verify_backup(parsed_args.verify, _io_workers(settings))
+            except Exception:
+                logger.exception("unable to verify the backup")
+                return 1
+            for name in report.corrupt:
+                logger.error(f"corrupt: {name}")
+            for name in report.missing:
+                logger.error(f"missing: {name}")
+            (logger.info if report.ok() else logger.error)(report.summary())
+            return 0 if report.ok() else 1
+
+        if parsed_args.catalog:
+            try:
+                read, forgotten = _update_catalog(conf[Conf.BACKUP_DIR],
+                    _io_workers(settings))
+                logger.info(f"catalog updated, {read} backups read and {forgotten} "
+                    "forgotten")
+                entries = _query_catalog(conf[Conf.BACKUP_DIR], parsed_args.catalog,
+                    parsed_args.catalog_date, list(filter(None,
+                    parsed_args.catalog_outputs.split(","))))
+            except Exception:
+                logger.exception("unable to use the catalog of the backups")
+                return 1
+            for entry in entries:
+                logger.info(f"{entry['name']} {entry['satellite']} "
+                    f"{entry['first_window'] or '-'} .. {entry['last_window'] or '-'} "
+                    f"{','.join(entry['outputs'])}{' PAM' if entry['pam'] else ''} "
+                    f"{entry['members']} files {entry['size'] >> 20} MB"
+                    + (f" INVALID: {entry['error']}" if entry["error"] else ""))
+            logger.info(f"{len(entries)} backups")
+            return 0
+
+        if parsed_args.rebuild_zip:
+            zip_path = f"{os.path.splitext(parsed_args.rebuild_zip)[0]}.zip"
+            try:
+                _rebuild_zip_from_store(parsed_args.rebuild_zip, zip_path, settings)
+            except Exception:
+                logger.exception("unable to rebuild the zip of the backup")
+                return 1
+            logger.info(f"backup rebuilt in {zip_path}")
+            return 0
+
+        if parsed_args.batch:
+            try:
+                with open(parsed_args.batch) as f:
+                    jobs = _batch_jobs_from_json(json.load(f), conf)
+            except Exception:
+                logger.exception("unable to read the batch manifest")
+                return 1
+            results_path = parsed_args.batch_results \
+                or f"{os.path.splitext(parsed_args.batch)[0]}_results.csv"
+            return 1 if run_batch(jobs, log_dir, results_path, settings) else 0
+
+        args: Args
+        if parsed_args.resume and (parsed_args.start is None or parsed_args.end is None):
+            try:
+                args = _args_from_journal(_find_journal(conf[Conf.DATA_DIR]))
+            except Exception:
+                logger.exception("unable to read the journal of the orchestration to resume")
+                return 1
+        else:
+            if parsed_args.start is None or parsed_args.end is None:
+                parser.error("the arguments -start and -end are required")
+            end, extra_ends = _split_ends(parsed_args.start, parsed_args.end)
+            args = {
+                "start": parsed_args.start,
+                "end": end,
+                "pam": parsed_args.pam,
+                "backup": parsed_args.backup,
+                "log_level": parsed_args.log_level,
+                "extra_ends": extra_ends,
+            }
+        if not validate_arguments(args) or (parsed_args.resume and args["backup"]):
             logger.error("the argument combination is invalid")
             return 1
 
-        with LogToFileContext(_enum_members_as_strings(Proc)[parsed_args.start],
-            _enum_members_as_strings(Proc)[parsed_args.end], log_dir):
-            run(args, conf, parsed_args.hsavers)
+        with LogToFileContext(_enum_members_as_strings(Proc)[args["start"]],
+            "+".join(proc.name for proc in _ends(args)), log_dir, settings=settings):
+            run(args, conf, parsed_args.hsavers, settings, parsed_args.resume)
     return 0
 
 if __name__ == '__main__':
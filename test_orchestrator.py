@@ -1,6 +1,24 @@
 import unittest
 import orchestrator
+import asyncio
+import contextvars
+import gzip
+import hashlib
+import io
 import itertools
+import json
+import logging
+import os
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest.mock
+import zipfile
 
 
 class TestOrchestratorArgumentsValidation(unittest.TestCase):
@@ -27,6 +45,1208 @@ class TestOrchestratorArgumentsValidation(unittest.TestCase):
 
         self.assertTrue(True)
 
+    def test_state_file_before_extra_ends(self):
+        Proc = orchestrator.Proc
+        state = {"start": Proc.L1B, "end": Proc.L2SM, "pam": True,
+            "backup": "C:\\backups\\Test_1234567890.zip", "log_level": 0}
+        with self.assertNoLogs(orchestrator.logger, "WARNING"):
+            args = orchestrator._read_state(io.StringIO(json.dumps(state)))
+        self.assertEqual(args, dict(state, extra_ends=[]))
+        with self.assertRaises(TypeError):
+            orchestrator._read_state(io.StringIO(json.dumps(dict(state,
+                extra_ends=Proc.L2FB))))
+
+class TestL1BShards(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.l1a_l1b_dir = self.tmp_dir.name
+        for window in ["2021-12/31/H12", "2021-12/31/H18", "2022-01/01/H00",
+            "2022-01/01/H06", "2022-01/01/H12"]:
+            os.makedirs(os.path.join(self.l1a_l1b_dir, window))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_windows(self):
+        windows = orchestrator._l1b_windows(self.l1a_l1b_dir)
+        self.assertEqual(windows[0], ("2021-12-31", "H12"))
+        self.assertEqual(windows[-1], ("2022-01-01", "H12"))
+        self.assertEqual(len(windows), 5)
+
+    def test_day_shards(self):
+        windows = orchestrator._l1b_windows(self.l1a_l1b_dir)
+        self.assertEqual(orchestrator._l1b_shards(windows, "day"), [
+            ("20211231T12:00:00", "20211231T18:00:00"),
+            ("20220101T00:00:00", "20220101T12:00:00"),
+        ])
+
+    def test_6h_shards(self):
+        windows = orchestrator._l1b_windows(self.l1a_l1b_dir)
+        shards = orchestrator._l1b_shards(windows, "6h")
+        self.assertEqual(len(shards), 5)
+        self.assertTrue(all(start == stop for start, stop in shards))
+
+    def test_coverage(self):
+        for window, size in [("2021-12/31/H12", 10), ("2022-01/01/H06", 20)]:
+            os.makedirs(os.path.join(self.l1a_l1b_dir, window, "ReflectionFiles"))
+            with open(os.path.join(self.l1a_l1b_dir, window, "ReflectionFiles",
+                "metadata.nc"), "wb") as f:
+                f.write(bytes(size))
+        coverage = orchestrator._build_coverage(self.l1a_l1b_dir)
+        self.assertEqual(orchestrator._dates_of_coverage(coverage),
+            ("2021-12-31", "H12", "2022-01-01", "H12"))
+        self.assertEqual(sum(window["bytes"] for window in coverage["windows"]), 30)
+        self.assertEqual(orchestrator._windows_with_data(coverage),
+            [("2021-12-31", "H12"), ("2022-01-01", "H06")])
+        self.assertEqual(coverage["missing"], [["2021-12-31", "H18"],
+            ["2022-01-01", "H00"], ["2022-01-01", "H12"]])
+
+class TestNetcdfValidation(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.windows = [("2021-12-31", "H12"), ("2021-12-31", "H18")]
+        for window, content in [("2021-12/31/H12", b"\x89HDF\r\n\x1a\n" + bytes(8)),
+            ("2021-12/31/H18", b"CDF\x02" + bytes(8))]:
+            self.write(f"{window}/metadata.nc", content)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, relative_path: str, content: bytes) -> None:
+        path = os.path.join(self.tmp_dir.name, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(content)
+
+    def test_valid(self):
+        report = orchestrator._validate_netcdf_output(self.tmp_dir.name, self.windows, 2)
+        self.assertEqual(report.files, 2)
+        self.assertEqual(report.bytes, 28)
+
+    def test_problems(self):
+        self.write("2021-12/31/H12/empty.nc", b"")
+        self.write("2021-12/31/H18/truncated.nc", b"\x89HD")
+        with self.assertRaises(ChildProcessError) as cm:
+            orchestrator._validate_netcdf_output(self.tmp_dir.name,
+                self.windows + [("2022-01-01", "H00")], 2)
+        message = f"{cm.exception}"
+        self.assertIn("1 empty: 2021-12/31/H12/empty.nc", message)
+        self.assertIn("1 not NetCDF: 2021-12/31/H18/truncated.nc", message)
+        self.assertIn("1 windows without output: 2022-01-01 H00", message)
+
+    def test_no_files(self):
+        with self.assertRaises(ChildProcessError):
+            orchestrator._validate_netcdf_output(os.path.join(self.tmp_dir.name, "2021-12", "30"))
+
+class TestStageGraph(unittest.TestCase):
+
+    def test_stages_to_run(self):
+        Proc, Stage = orchestrator.Proc, orchestrator.Stage
+        self.assertEqual(orchestrator._stages_to_run(Proc.L1A, [Proc.L1A]), [Stage.L1A])
+        self.assertEqual(orchestrator._stages_to_run(Proc.L2SI, [Proc.L2SI]),
+            [Stage.DATES, Stage.L2SI])
+        self.assertEqual(len(orchestrator._stages_to_run(Proc.L1A, [Proc.L2SM])), 8)
+        self.assertEqual(orchestrator._stages_to_run(Proc.L2FB, [Proc.L2FB, Proc.L2SM]),
+            [Stage.DATES, Stage.L2FB, Stage.L2SM])
+
+    def test_serial_order(self):
+        stages = orchestrator._stages_to_run(orchestrator.Proc.L1A,
+            [orchestrator.Proc.L2FT])
+        order = []
+        orchestrator._run_stage_graph(stages, order.append, 1)
+        self.assertEqual(order, stages)
+
+    def test_independent_stages_overlap(self):
+        Stage = orchestrator.Stage
+        stages = orchestrator._stages_to_run(orchestrator.Proc.L1B,
+            [orchestrator.Proc.L1B])
+        barrier = threading.Barrier(2, timeout=5)
+        order = []
+        def run_stage(stage):
+            if stage in (Stage.L1B_CX, Stage.L1B_CC):
+                barrier.wait() # Deadlocks (and times out) if run serially.
+            order.append(stage)
+        orchestrator._run_stage_graph(stages, run_stage, 4)
+        self.assertEqual(order[:2], [Stage.DATES, Stage.L1B])
+        self.assertEqual(order[-1], Stage.L1B_MM_AGAIN)
+
+    def test_parallel_level_2(self):
+        Stage = orchestrator.Stage
+        stages = orchestrator._stages_to_run(orchestrator.Proc.L1B,
+            [orchestrator.Proc.L2FB, orchestrator.Proc.L2SM])
+        lock = threading.Lock()
+        running, most_running = set(), {}
+        barrier = threading.Barrier(2, timeout=5)
+        def run_stage(stage):
+            with lock:
+                running.add(stage)
+                most_running[stage] = set(running)
+            if stage in (Stage.L2FB, Stage.L2SM):
+                barrier.wait() # Deadlocks (and times out) if run serially.
+            time.sleep(0.05)
+            with lock:
+                running.remove(stage)
+        orchestrator._run_stage_graph(stages, run_stage, 1, 2)
+        # Only the Level-2 stages go beyond the limit.
+        self.assertEqual({stage: len(running) for stage, running in most_running.items()
+            if stage not in (Stage.L2FB, Stage.L2SM)},
+            dict.fromkeys(stages[:-2], 1))
+
+    def test_failure_stops_the_graph(self):
+        Stage = orchestrator.Stage
+        stages = orchestrator._stages_to_run(orchestrator.Proc.L1B,
+            [orchestrator.Proc.L2SM])
+        order = []
+        def run_stage(stage):
+            if stage == Stage.L1B_MM:
+                raise ChildProcessError("boom")
+            order.append(stage)
+        with self.assertRaises(ChildProcessError):
+            orchestrator._run_stage_graph(stages, run_stage, 4)
+        self.assertEqual(order, [Stage.DATES, Stage.L1B])
+
+class TestMultipleEnds(unittest.TestCase):
+
+    def args(self, **kwargs):
+        res = dict(orchestrator.ARGS_DEFAULT)
+        res.update(kwargs)
+        return res
+
+    def test_validation(self):
+        Proc = orchestrator.Proc
+        validate = lambda **kwargs: orchestrator.validate_arguments(self.args(**kwargs))
+        self.assertTrue(validate(start=Proc.L1B, end=Proc.L2FB,
+            extra_ends=[Proc.L2FT, Proc.L2SM]))
+        self.assertFalse(validate(start=Proc.L1B, end=Proc.L1B,
+            extra_ends=[Proc.L2SM]))
+        self.assertFalse(validate(start=Proc.L1B, end=Proc.L2FB,
+            extra_ends=[Proc.L1B]))
+        self.assertFalse(validate(start=Proc.L1B, end=Proc.L2FB,
+            extra_ends=[Proc.L2FB]))
+
+    def test_split_ends(self):
+        Proc = orchestrator.Proc
+        self.assertEqual(orchestrator._split_ends(Proc.L2SM, [Proc.L2FB, Proc.L2SM]),
+            (Proc.L2SM, [Proc.L2FB]))
+        self.assertEqual(orchestrator._split_ends(Proc.L1A, [Proc.L2SM, Proc.L2FB]),
+            (Proc.L2FB, [Proc.L2SM]))
+        end, extra_ends = orchestrator._split_ends(Proc.L2SM, [Proc.L2FB, Proc.L2SM])
+        self.assertTrue(orchestrator.validate_arguments(self.args(start=Proc.L2SM,
+            end=end, extra_ends=extra_ends)))
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.results_path = os.path.join(self.tmp_dir.name, "results.csv")
+        self.conf = list(orchestrator.CONF_VALUES_DEFAULT)
+        self.jobs = orchestrator._batch_jobs_from_json([
+            {"name": "a", "hsavers": "C:\\a.xml", "start": "L1A", "end": "L1B"},
+            {"name": "b", "backup": "C:\\b_1234567890.zip", "start": "L2FB",
+                "end": "L2FB,L2SM", "pam": True},
+        ], self.conf)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_manifest(self):
+        self.assertEqual(self.jobs[1]["args"]["extra_ends"], [orchestrator.Proc.L2SM])
+        with self.assertRaises(ValueError):
+            orchestrator._batch_jobs_from_json([{"start": "L2FB", "end": "L1A"}],
+                self.conf)
+        with self.assertRaises(ValueError):
+            orchestrator._batch_jobs_from_json([{"start": "L1A", "end": "L1A",
+                "conf": {"NOT_A_PATH": ""}}], self.conf)
+
+    def test_resume(self):
+        ran = []
+        def failing_run(args, conf, l1a_input_file, settings):
+            ran.append(l1a_input_file or args["backup"])
+            if args["backup"]:
+                raise ChildProcessError("boom")
+            return "backup.zip"
+        with unittest.mock.patch.object(orchestrator, "run", failing_run):
+            failed = orchestrator.run_batch(self.jobs, self.tmp_dir.name,
+                self.results_path)
+        self.assertEqual(failed, 1)
+        results = orchestrator._read_batch_results(self.results_path)
+        self.assertEqual(results["a"]["status"], "done")
+        self.assertEqual(results["a"]["backup"], "backup.zip")
+        self.assertEqual(results["b"]["status"], "failed")
+
+        ran.clear()
+        with unittest.mock.patch.object(orchestrator, "run",
+            lambda args, *_: ran.append(args["backup"]) or ""):
+            failed = orchestrator.run_batch(self.jobs, self.tmp_dir.name,
+                self.results_path)
+        self.assertEqual(failed, 0)
+        self.assertEqual(ran, ["C:\\b_1234567890.zip"]) # Only the failed one.
+        results = orchestrator._read_batch_results(self.results_path)
+        self.assertEqual(results["b"]["status"], "done")
+
+class BackupTestCase(unittest.TestCase):
+    """Makes a small data directory to backup."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.data_dir = os.path.join(self.tmp_dir.name, "data")
+        self.backup_dir = os.path.join(self.tmp_dir.name, "backup")
+        os.mkdir(self.backup_dir)
+        data_release = os.path.join(self.data_dir, "HydroGNSS-1", "DataRelease")
+        for window in ["2021-12/31/H12", "2021-12/31/H18"]:
+            window_dir = os.path.join(data_release, "L1A_L1B", window)
+            os.makedirs(window_dir)
+            with open(os.path.join(window_dir, "metadata.nc"), "wb") as f:
+                f.write(b"\x89HDF\r\n\x1a\n" + window.encode() * 1000)
+        os.makedirs(os.path.join(data_release, "L2OP-FB"))
+        with open(os.path.join(data_release, "experiment_name.txt"), "w") as f:
+            f.write("Test_01-Jan-2023_00_00_00")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+class TestBackupStore(BackupTestCase):
+
+    def objects(self):
+        return sum(len(files) for _, _, files in os.walk(os.path.join(
+            self.backup_dir, orchestrator.BACKUP_STORE_DIR, "objects")))
+
+    def test_rebuilt_zip_matches_make_archive(self):
+        expected = shutil.make_archive(os.path.join(self.tmp_dir.name, "expected"),
+            "zip", self.data_dir, "HydroGNSS-1")
+        manifest = orchestrator._backup_to_store(self.data_dir, "HydroGNSS-1",
+            self.backup_dir, "Test_1234567890", 2)
+        rebuilt = os.path.join(self.tmp_dir.name, "rebuilt.zip")
+        orchestrator._rebuild_zip_from_store(manifest, rebuilt)
+        with zipfile.ZipFile(expected) as expected_zip, \
+            zipfile.ZipFile(rebuilt) as rebuilt_zip:
+            expected_infos = expected_zip.infolist()
+            # The integrity manifest is the last member.
+            rebuilt_infos = rebuilt_zip.infolist()[:-1]
+            self.assertEqual(rebuilt_zip.infolist()[-1].filename,
+                f"HydroGNSS-1/{orchestrator.BACKUP_INTEGRITY_FILE}")
+            self.assertEqual([i.filename for i in expected_infos],
+                [i.filename for i in rebuilt_infos])
+            for expected_info, rebuilt_info in zip(expected_infos, rebuilt_infos):
+                self.assertEqual(expected_info.date_time, rebuilt_info.date_time)
+                self.assertEqual(expected_info.CRC, rebuilt_info.CRC)
+
+    def test_deduplication_and_restore(self):
+        orchestrator._backup_to_store(self.data_dir, "HydroGNSS-1",
+            self.backup_dir, "Test_1234567890", 2)
+        objects = self.objects()
+        self.assertEqual(objects, 3)
+        manifest = orchestrator._backup_to_store(self.data_dir, "HydroGNSS-1",
+            self.backup_dir, "Test_1234567891", 2)
+        self.assertEqual(self.objects(), objects)
+
+        restored_dir = os.path.join(self.tmp_dir.name, "restored")
+        orchestrator._restore_from_store(manifest, restored_dir, 2)
+        original = os.path.join(self.data_dir, "HydroGNSS-1")
+        restored = os.path.join(restored_dir, "HydroGNSS-1")
+        self.assertTrue(os.path.isdir(os.path.join(restored, "DataRelease", "L2OP-FB")))
+        for dirpath, _, filenames in os.walk(original):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                with open(path, "rb") as f1, open(os.path.join(restored,
+                    os.path.relpath(path, original)), "rb") as f2:
+                    self.assertEqual(f1.read(), f2.read())
+
+    def test_add_zip_to_store(self):
+        manifest = orchestrator._backup_to_store(self.data_dir, "HydroGNSS-1",
+            self.backup_dir, "Test_1234567890", 2)
+        zip_path = os.path.join(self.tmp_dir.name, "pam.zip")
+        orchestrator._rebuild_zip_from_store(manifest, zip_path)
+        with zipfile.ZipFile(zip_path, "a") as zipf:
+            zipf.writestr("HydroGNSS-1/DataRelease/PAM_Output/plot.png", b"png")
+        orchestrator._add_zip_to_store(zip_path, manifest, self.backup_dir)
+        self.assertIn("HydroGNSS-1/DataRelease/PAM_Output/plot.png",
+            orchestrator._backup_member_names(manifest))
+        self.assertEqual(self.objects(), 4)
+
+class TestZipWriter(BackupTestCase):
+
+    def test_make_zip_matches_make_archive(self):
+        expected = shutil.make_archive(os.path.join(self.tmp_dir.name, "expected"),
+            "zip", self.data_dir, "HydroGNSS-1")
+        made = os.path.join(self.tmp_dir.name, "made.zip")
+        settings = dict(orchestrator.SETTINGS_DEFAULT,
+            zip_stored_extensions=[".txt"], compression_workers=3)
+        orchestrator._make_zip(made, self.data_dir, "HydroGNSS-1", settings)
+        with zipfile.ZipFile(expected) as expected_zip, \
+            zipfile.ZipFile(made) as made_zip:
+            self.assertIsNone(made_zip.testzip())
+            integrity_name = f"HydroGNSS-1/{orchestrator.BACKUP_INTEGRITY_FILE}"
+            self.assertEqual([i.filename for i in expected_zip.infolist()] + [integrity_name],
+                [i.filename for i in made_zip.infolist()])
+            integrity = json.loads(made_zip.read(integrity_name))
+            self.assertEqual(integrity["sha256"], {
+                info.filename: hashlib.sha256(expected_zip.read(info)).hexdigest()
+                for info in expected_zip.infolist() if not info.is_dir()})
+            for info in made_zip.infolist()[:-1]:
+                self.assertEqual(info.CRC, expected_zip.getinfo(info.filename).CRC)
+                self.assertEqual(made_zip.read(info), expected_zip.read(info.filename))
+                if info.filename.endswith(".txt") or info.is_dir():
+                    self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+                else:
+                    self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+
+    def test_zip64(self):
+        # The zip is written without zipfile, which has to read it anyway, also
+        # when it needs the ZIP64 extensions.
+        expected = shutil.make_archive(os.path.join(self.tmp_dir.name, "expected"),
+            "zip", self.data_dir, "HydroGNSS-1")
+        made = os.path.join(self.tmp_dir.name, "made.zip")
+        with unittest.mock.patch.object(orchestrator, "_ZIP64_LIMIT", 1), \
+            unittest.mock.patch.object(orchestrator, "_ZIP64_COUNT_LIMIT", 1):
+            orchestrator._make_zip(made, self.data_dir, "HydroGNSS-1",
+                orchestrator.SETTINGS_DEFAULT)
+        with zipfile.ZipFile(expected) as expected_zip, \
+            zipfile.ZipFile(made) as made_zip:
+            self.assertIsNone(made_zip.testzip())
+            for info in expected_zip.infolist():
+                made_info = made_zip.getinfo(info.filename)
+                self.assertEqual(made_info.file_size, info.file_size)
+                self.assertEqual(made_info.date_time, info.date_time)
+                self.assertEqual(made_info.external_attr, info.external_attr)
+                self.assertEqual(made_zip.read(made_info), expected_zip.read(info))
+
+class TestSelectiveRestore(BackupTestCase):
+
+    def test_paths_to_restore(self):
+        L1B, L2FT, L2SM = orchestrator.Proc.L1B, orchestrator.Proc.L2FT, orchestrator.Proc.L2SM
+        stages = orchestrator._stages_to_run(L2SM, [L2SM])
+        self.assertEqual(orchestrator._paths_to_restore(stages),
+            ["L1A_L1B"] + orchestrator.RESTORE_ALWAYS)
+        stages = orchestrator._stages_to_run(L1B, [L2FT, L2SM])
+        self.assertEqual(orchestrator._paths_to_restore(stages),
+            ["L1A_L1B"] + orchestrator.RESTORE_ALWAYS)
+
+    def test_restore_only_needed_members(self):
+        data_release = os.path.join(self.data_dir, "HydroGNSS-1", "DataRelease")
+        os.makedirs(os.path.join(data_release, "PAM_Output"))
+        for name in ["Test_inOutReferenceFile.mat", "PAM_Output/plot.png",
+            "L2OP-FB/L2_FB.nc"]:
+            with open(os.path.join(data_release, name), "wb") as f:
+                f.write(name.encode())
+        backup = os.path.join(self.tmp_dir.name, "Test_1234567890.zip")
+        orchestrator._make_zip(backup, self.data_dir, "HydroGNSS-1",
+            orchestrator.SETTINGS_DEFAULT)
+        manifest = orchestrator._backup_to_store(self.data_dir, "HydroGNSS-1",
+            os.path.join(self.tmp_dir.name, "backup"), "Test_1234567890", 2)
+
+        paths = orchestrator._paths_to_restore(orchestrator._stages_to_run(
+            orchestrator.Proc.L2SM, [orchestrator.Proc.L2SM]))
+        for backup in [backup, manifest]:
+            members = orchestrator._members_to_restore(
+                orchestrator._backup_member_names(backup), "HydroGNSS-1", paths)
+            restored_dir = os.path.join(self.tmp_dir.name, "restored", os.path.basename(backup))
+            orchestrator._restore_backup(backup, restored_dir, members, 2)
+            restored = os.path.join(restored_dir, "HydroGNSS-1", "DataRelease")
+            for name in ["L1A_L1B/2021-12/31/H12/metadata.nc",
+                "experiment_name.txt", "Test_inOutReferenceFile.mat"]:
+                self.assertTrue(os.path.isfile(os.path.join(restored, name)), name)
+            for name in ["PAM_Output", "L2OP-FB"]:
+                self.assertFalse(os.path.exists(os.path.join(restored, name)), name)
+
+class TestBackupIntegrity(BackupTestCase):
+
+    def tamper(self, zip_path, name):
+        """Changes a member keeping its CRC right, like a bad copy would do
+        before zipping."""
+        tampered = f"{zip_path}.tmp"
+        with zipfile.ZipFile(zip_path) as src, zipfile.ZipFile(tampered, "w") as dst:
+            for info in src.infolist():
+                dst.writestr(info, b"tampered" if info.filename == name else src.read(info))
+        os.replace(tampered, zip_path)
+
+    def test_zip(self):
+        zip_path = os.path.join(self.backup_dir, "Test_1234567890.zip")
+        orchestrator._make_zip(zip_path, self.data_dir, "HydroGNSS-1",
+            orchestrator.SETTINGS_DEFAULT)
+        report = orchestrator._verify_backup(zip_path, 2)
+        self.assertTrue(report.ok())
+        self.assertEqual((report.files, report.unlisted), (3, []))
+
+        name = "HydroGNSS-1/DataRelease/L1A_L1B/2021-12/31/H18/metadata.nc"
+        self.tamper(zip_path, name)
+        self.assertEqual(orchestrator._verify_backup(zip_path, 2).corrupt, [name])
+        # Only the members to restore are read.
+        self.assertTrue(orchestrator._verify_backup(zip_path, 2,
+            ["HydroGNSS-1/DataRelease/experiment_name.txt"]).ok())
+
+    def test_store(self):
+        manifest = orchestrator._backup_to_store(self.data_dir, "HydroGNSS-1",
+            self.backup_dir, "Test_1234567890", 2)
+        self.assertTrue(orchestrator._verify_backup(manifest, 2).ok())
+        name = "HydroGNSS-1/DataRelease/experiment_name.txt"
+        sha256 = {member["name"]: member["sha256"] for member in
+            orchestrator._read_backup_store_manifest(manifest)}[name]
+        os.remove(orchestrator._backup_store_object_path(self.backup_dir, sha256))
+        self.assertEqual(orchestrator._verify_backup(manifest, 2).missing, [name])
+
+    def test_run_refuses_damaged_backup(self):
+        import benchmark_orchestrator
+        Proc = orchestrator.Proc
+        volume = dict(benchmark_orchestrator.VOLUME_DEFAULT, days=1, hours=2,
+            nc_size=4096, stdout_lines=0)
+        conf = benchmark_orchestrator.make_installation(self.tmp_dir.name, volume)
+        args = dict(orchestrator.ARGS_DEFAULT, start=Proc.L1A, end=Proc.L1B)
+        backup = orchestrator.run(args, conf, "input.xml")
+        data_release = os.path.join(conf[orchestrator.Conf.DATA_DIR],
+            "HydroGNSS-1", "DataRelease")
+        with zipfile.ZipFile(backup) as zipf:
+            name = next(name for name in zipf.namelist() if name.endswith(".nc"))
+        self.tamper(backup, name)
+        with open(os.path.join(data_release, "marker.txt"), "w") as f:
+            pass
+        with self.assertRaisesRegex(ValueError, "damaged"):
+            orchestrator.run(dict(args, start=Proc.L1B, backup=backup), conf, "")
+        self.assertTrue(os.path.isfile(os.path.join(data_release, "marker.txt")))
+
+class TestBackupCache(BackupTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = os.path.join(self.tmp_dir.name, "cache")
+        self.backup = os.path.join(self.tmp_dir.name, "Test_1234567890.zip")
+        orchestrator._make_zip(self.backup, self.data_dir, "HydroGNSS-1",
+            orchestrator.SETTINGS_DEFAULT)
+        self.names = orchestrator._backup_member_names(self.backup)
+
+    def restore(self, backup, restored_dir, copied, max_bytes=1 << 30):
+        return orchestrator._restore_backup_cached(backup, restored_dir,
+            orchestrator._backup_member_names(backup), copied, self.cache_dir,
+            max_bytes, 2)
+
+    def test_hit_links_and_copies(self):
+        copied = {name for name in self.names if name.endswith("H12/metadata.nc")}
+        self.assertFalse(self.restore(self.backup, os.path.join(self.tmp_dir.name, "r1"), copied))
+        restored_dir = os.path.join(self.tmp_dir.name, "r2")
+        self.assertTrue(self.restore(self.backup, restored_dir, copied))
+        l1a_l1b = os.path.join(restored_dir, "HydroGNSS-1", "DataRelease", "L1A_L1B")
+        self.assertEqual(os.stat(os.path.join(l1a_l1b, "2021-12/31/H12/metadata.nc")).st_nlink, 1)
+        self.assertGreater(os.stat(os.path.join(l1a_l1b, "2021-12/31/H18/metadata.nc")).st_nlink, 1)
+        self.assertTrue(os.path.isdir(os.path.join(restored_dir, "HydroGNSS-1", "DataRelease", "L2OP-FB")))
+
+        # A changed backup is a different entry.
+        with zipfile.ZipFile(self.backup, "a") as zipf:
+            zipf.writestr("HydroGNSS-1/DataRelease/new.txt", b"new")
+        self.assertFalse(self.restore(self.backup, os.path.join(self.tmp_dir.name, "r3"), set()))
+
+    def test_eviction(self):
+        other = os.path.join(self.tmp_dir.name, "Other_1234567890.zip")
+        shutil.copy(self.backup, other)
+        self.restore(self.backup, os.path.join(self.tmp_dir.name, "r1"), set())
+        size = orchestrator._dir_size(self.cache_dir)
+        self.restore(other, os.path.join(self.tmp_dir.name, "r2"), set(), size + 1)
+        index = orchestrator._read_backup_cache_index(self.cache_dir)
+        self.assertEqual([entry["backup"] for entry in index.values()], [other])
+        orchestrator._purge_backup_cache(self.cache_dir)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+class TestBackupCatalog(BackupTestCase):
+
+    def test_incremental_update_and_query(self):
+        zip_path = os.path.join(self.backup_dir, "Test_01-Jan-2023_00_00_00_1234567890.zip")
+        orchestrator._make_zip(zip_path, self.data_dir, "HydroGNSS-1",
+            orchestrator.SETTINGS_DEFAULT)
+        manifest = orchestrator._backup_to_store(self.data_dir, "HydroGNSS-1",
+            self.backup_dir, "Other_01-Jan-2023_00_00_00_1234567891", 2)
+        self.assertEqual(orchestrator._update_catalog(self.backup_dir, 2), (2, 0))
+        self.assertEqual(orchestrator._update_catalog(self.backup_dir, 2), (0, 0))
+
+        entry, names = orchestrator._catalog_entry(zip_path)
+        self.assertEqual(names, orchestrator._backup_member_names(zip_path))
+        self.assertEqual((entry["satellite"], entry["first_window"],
+            entry["last_window"], entry["windows"], entry["outputs"], entry["pam"],
+            entry["error"]), ("HydroGNSS-1", "2021-12-31 H12", "2021-12-31 H18", 2,
+            ["L1A_L1B"], False, ""))
+        self.assertEqual([entry["name"] for entry in orchestrator._query_catalog(
+            self.backup_dir, "Other*", "2021-12-31", ["L1A_L1B"])],
+            [os.path.basename(manifest)])
+        self.assertEqual(orchestrator._query_catalog(self.backup_dir,
+            date="2022-01-01"), [])
+
+        # The changed backups are read again, and the ones removed forgotten.
+        with zipfile.ZipFile(zip_path, "a") as zipf:
+            zipf.writestr("HydroGNSS-1/DataRelease/PAM_Output/plot.png", b"png")
+            zipf.writestr("wrong/place.txt", b"")
+        os.remove(manifest)
+        self.assertEqual(orchestrator._update_catalog(self.backup_dir, 2), (1, 1))
+        entry, _ = orchestrator._catalog_entry(zip_path)
+        self.assertTrue(entry["pam"])
+        self.assertIn("not all the files", entry["error"])
+
+    def test_without_catalog(self):
+        zip_path = os.path.join(self.backup_dir, "Test_01-Jan-2023_00_00_00_1234567890.zip")
+        orchestrator._make_zip(zip_path, self.data_dir, "HydroGNSS-1",
+            orchestrator.SETTINGS_DEFAULT)
+        # Like in a read-only directory.
+        with unittest.mock.patch.object(orchestrator, "_open_catalog",
+            side_effect=sqlite3.OperationalError("unable to open database file")), \
+            self.assertLogs(orchestrator.logger, "WARNING"):
+            entry, names = orchestrator._catalog_entry(zip_path)
+        self.assertEqual(entry["satellite"], "HydroGNSS-1")
+        self.assertEqual(names, orchestrator._backup_member_names(zip_path))
+        self.assertFalse(os.path.exists(os.path.join(self.backup_dir,
+            orchestrator.BACKUP_CATALOG)))
+
+class TestPromotion(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp_dir.name, "L1A_L1B")
+        os.makedirs(os.path.join(self.src, "2021-12", "31", "H12"))
+        os.makedirs(os.path.join(self.src, "2021-12", "31", "H18"))
+        self.content = bytes(range(256)) * 1000
+        with open(os.path.join(self.src, "2021-12", "31", "H12", "metadata.nc"), "wb") as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_modes(self):
+        for mode in orchestrator.PROMOTION_MODES:
+            dst = os.path.join(self.tmp_dir.name, mode)
+            with unittest.mock.patch.object(orchestrator, "_COPY_CHUNK_SIZE", 10000):
+                files = orchestrator._files_of_tree(self.src, dst)
+                linked, copied = orchestrator._promote_files(files, mode, 3)
+            self.assertEqual((linked, copied), (0, len(self.content)) if mode == "copy"
+                else (len(self.content), 0))
+            self.assertTrue(os.path.isdir(os.path.join(dst, "2021-12", "31", "H18")))
+            with open(os.path.join(dst, "2021-12", "31", "H12", "metadata.nc"), "rb") as f:
+                self.assertEqual(f.read(), self.content)
+        self.assertFalse(os.path.exists(files[0][0]))
+
+class TestRunProcessorAsync(unittest.TestCase):
+
+    def run_script(self, script, **kwargs):
+        command = [sys.executable, "-c", script]
+        with unittest.mock.patch.object(orchestrator, "_processor_command",
+            return_value=command), self.assertLogs(orchestrator.logger, "INFO") as logs:
+            res = asyncio.run(orchestrator.run_processor_async("proc.exe", "", **kwargs))
+        return res, [line for record in logs.records
+            for line in record.getMessage().split("\n")]
+
+    def test_output_is_tagged_and_status_returned(self):
+        res, lines = self.run_script("import sys; print('out'); "
+            "print('err', file=sys.stderr); print('x' * 100000, end=''); sys.exit(3)")
+        self.assertEqual(res.returncode, 3)
+        self.assertEqual(res.name, "proc")
+        self.assertGreaterEqual(res.seconds, 0)
+        self.assertIn("proc: out", lines)
+        self.assertIn("proc: err", lines)
+        self.assertIn("proc: " + "x" * 100000, lines)
+        self.assertLess(lines.index("proc: out"), lines.index("proc: err"))
+
+    def test_arguments_are_not_run_by_a_shell(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            script = os.path.join(tmp_dir, "proc.py")
+            with open(script, "w") as f:
+                f.write("import sys; print(sys.argv[1:])")
+            with self.assertLogs(orchestrator.logger, "INFO") as logs:
+                res = asyncio.run(orchestrator.run_processor_async(script,
+                    "'a b' c; echo INJECTED $HOME"))
+        self.assertEqual(res.returncode, 0)
+        output = [record.getMessage() for record in logs.records
+            if record.getMessage().startswith("proc: ")]
+        self.assertEqual(output, ["proc: ['a b', 'c;', 'echo', 'INJECTED', '$HOME']"])
+
+    def test_many_at_once(self):
+        async def main():
+            return await asyncio.gather(*(orchestrator.run_processor_async(
+                "proc.exe", "", f"proc{i}") for i in range(3)))
+        command = [sys.executable, "-c", "print(1)"]
+        with unittest.mock.patch.object(orchestrator, "_processor_command",
+            return_value=command), self.assertLogs(orchestrator.logger, "INFO"):
+            results = asyncio.run(main())
+        self.assertEqual([res.returncode for res in results], [0, 0, 0])
+
+    def test_telemetry(self):
+        telemetry = []
+        token = orchestrator._telemetry.set(telemetry)
+        try:
+            res, _ = self.run_script("import time; data = bytearray(50 << 20); "
+                "open('/dev/null', 'wb').write(data); time.sleep(0.5)")
+            with orchestrator._MeasureStep("step"):
+                pass
+        finally:
+            orchestrator._telemetry.reset(token)
+        self.assertEqual([record["name"] for record in telemetry], ["proc", "step"])
+        record = telemetry[0]
+        self.assertEqual(record["returncode"], 0)
+        self.assertEqual(res.usage["write_bytes"], record["write_bytes"])
+        if os.path.isdir("/proc"):
+            self.assertGreater(record["peak_memory_bytes"], 50 << 20)
+            self.assertGreaterEqual(record["write_bytes"], 50 << 20)
+
+    @unittest.skipUnless(os.path.isdir("/proc"), "uses /proc")
+    def test_process_tree(self):
+        process = subprocess.Popen([sys.executable, "-c", "import subprocess, sys, time; "
+            "subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(10)']); "
+            "time.sleep(10)"], start_new_session=True)
+        self.addCleanup(process.wait)
+        self.addCleanup(os.killpg, process.pid, signal.SIGKILL)
+        sampler = orchestrator._ProcessTreeSampler(process.pid)
+        deadline = time.monotonic() + 5
+        while len(tree := sampler._tree()) < 2:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+        sampler.children_files = False
+        self.assertEqual(sorted(tree), sorted(sampler._tree()))
+        sampler.sample()
+        self.assertGreater(sampler.usage()["peak_memory_bytes"], 0)
+
+    @unittest.skipIf(os.name == "nt", "uses the POSIX process groups")
+    def test_timeout_kills_the_process_tree(self):
+        res, lines = self.run_script("import subprocess, sys, time; "
+            "child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)']); "
+            "print(child.pid, flush=True); time.sleep(60)", timeout=0.5)
+        self.assertIn("more than 0.5 seconds", res.killed_reason)
+        self.assertLess(res.seconds, 10)
+        child_pid = int(next(line for line in lines if line.startswith("proc: "))[6:])
+        # Either gone or a zombie waiting to be reaped, it may take a moment.
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            try:
+                with open(f"/proc/{child_pid}/stat") as f:
+                    if f.read().rpartition(")")[2].split()[0] == "Z":
+                        break
+            except FileNotFoundError:
+                break
+            time.sleep(0.05)
+        else:
+            self.fail("the child of the processor is still running")
+
+    @unittest.skipIf(os.name == "nt", "uses the POSIX sessions")
+    def test_survivors_do_not_block(self):
+        # The child is in a session of its own, so it is not killed with the
+        # processor, and it keeps the pipe open.
+        with unittest.mock.patch.object(orchestrator, "_KILL_GRACE_SECONDS", 0.5):
+            res, lines = self.run_script("import subprocess, sys, time; "
+                "child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'], "
+                "start_new_session=True); print(child.pid, flush=True); time.sleep(60)",
+                timeout=0.5)
+        child_pid = int(next(line for line in lines if line.startswith("proc: "))[6:])
+        os.kill(child_pid, signal.SIGKILL)
+        self.assertIn("more than 0.5 seconds", res.killed_reason)
+        self.assertLess(res.seconds, 10)
+        # Without anything to kill it, the processor that exits is not waited
+        # for as long as the child.
+        with unittest.mock.patch.object(orchestrator, "_KILL_GRACE_SECONDS", 0.5):
+            res, lines = self.run_script("import subprocess, sys; "
+                "child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'], "
+                "start_new_session=True); print(child.pid, flush=True)")
+        child_pid = int(next(line for line in lines if line.startswith("proc: "))[6:])
+        os.kill(child_pid, signal.SIGKILL)
+        self.assertEqual((res.returncode, res.killed_reason), (0, ""))
+        self.assertLess(res.seconds, 10)
+        self.assertIn("some processes started by proc are still running, their "
+            "output is ignored", lines)
+
+    def test_stall(self):
+        res, _ = self.run_script("import time; print('start', flush=True); "
+            "time.sleep(60)", stall_timeout=0.5, timeout=30)
+        self.assertIn("wrote nothing for 0.5 seconds", res.killed_reason)
+        res, _ = self.run_script("import time\nfor i in range(5): "
+            "print(i, flush=True); time.sleep(0.2)", stall_timeout=1)
+        self.assertEqual((res.returncode, res.killed_reason), (0, ""))
+
+    def test_timeouts_from_settings(self):
+        conf = [f"/opt/{option.name}" for option in orchestrator.Conf]
+        settings = dict(orchestrator.SETTINGS_DEFAULT,
+            processor_timeouts={"L1B_EXE": 3600},
+            processor_stall_timeouts={"L1B_EXE": 600, "L2SM_EXE": 60})
+        self.assertTrue(orchestrator.validate_settings(settings))
+        timeouts = orchestrator._timeouts_of_executables(conf, settings)
+        self.assertEqual(timeouts["/opt/L1B_EXE"], (3600, 600))
+        self.assertEqual(timeouts["/opt/L2SM_EXE"], (0, 60))
+        self.assertEqual(timeouts["/opt/PAM_EXE"], (0, 0))
+        self.assertFalse(orchestrator.validate_settings(dict(settings,
+            processor_timeouts={"DATA_DIR": 10})))
+
+    def test_trace(self):
+        events = []
+        token = orchestrator._trace.set(events)
+        try:
+            with unittest.mock.patch.object(orchestrator, "_STALL_SECONDS", 0.2):
+                with orchestrator._TraceSpan("outer"):
+                    res, _ = self.run_script("import sys, time; print('a', flush=True); "
+                        "time.sleep(0.5); print('b', file=sys.stderr, flush=True); "
+                        "time.sleep(0.5)")
+        finally:
+            orchestrator._trace.reset(token)
+        self.assertEqual(res.returncode, 0)
+        trace = orchestrator._chrome_trace(events)["traceEvents"]
+        spans = {event["name"]: event for event in trace if event["ph"] == "X"}
+        self.assertEqual(set(spans), {"outer", "proc", "launch", "no output"})
+        self.assertEqual(spans["proc"]["tid"], spans["no output"]["tid"])
+        # Also the one at the end, before it exits.
+        stalls = [event for event in trace if event["name"] == "no output"]
+        self.assertEqual(len(stalls), 2)
+        self.assertNotEqual(spans["proc"]["tid"], spans["outer"]["tid"])
+        self.assertGreaterEqual(spans["outer"]["dur"], spans["proc"]["dur"])
+        tracks = {event["args"]["name"] for event in trace if event["name"] == "thread_name"}
+        self.assertIn(threading.current_thread().name, tracks)
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_pipeline_with_stubs(self):
+        import benchmark_orchestrator
+        volume = dict(benchmark_orchestrator.VOLUME_DEFAULT, days=1, hours=2,
+            nc_size=4096, stdout_lines=10)
+        with tempfile.TemporaryDirectory() as root:
+            results = benchmark_orchestrator.run_benchmarks(root, volume,
+                orchestrator.SETTINGS_DEFAULT, 1)
+            backups = os.listdir(os.path.join(root, "E2ES_backups"))
+        self.assertIn("pipeline", results)
+        self.assertEqual(len([name for name in backups if name.endswith(".zip")]), 2)
+
+class TestJournal(unittest.TestCase):
+
+    def test_resume_after_failure(self):
+        import benchmark_orchestrator
+        Proc = orchestrator.Proc
+        volume = dict(benchmark_orchestrator.VOLUME_DEFAULT, days=1, hours=2,
+            nc_size=4096, stdout_lines=0)
+        with tempfile.TemporaryDirectory() as root:
+            conf = benchmark_orchestrator.make_installation(root, volume)
+            l2sm_exe = conf[orchestrator.Conf.L2SM_EXE]
+            with open(l2sm_exe) as f:
+                l2sm_stub = f.read()
+            with open(l2sm_exe, "w") as f:
+                f.write("import sys; sys.exit(1)")
+            args = dict(orchestrator.ARGS_DEFAULT, start=Proc.L1A, end=Proc.L2FB,
+                extra_ends=[Proc.L2SM])
+            with self.assertRaises(Exception):
+                orchestrator.run(args, conf, "input.xml")
+            data_release = os.path.join(conf[orchestrator.Conf.DATA_DIR],
+                "HydroGNSS-1", "DataRelease")
+            journal = orchestrator._read_journal(data_release)
+            self.assertEqual(journal["stages"]["L2SM"]["status"], "failed")
+            self.assertEqual(journal["stages"]["L2FB"]["status"], "finished")
+            self.assertEqual(orchestrator._args_from_journal(
+                orchestrator._find_journal(conf[orchestrator.Conf.DATA_DIR])), args)
+
+            with open(l2sm_exe, "w") as f:
+                f.write(l2sm_stub)
+            with unittest.mock.patch.object(orchestrator, "_run_stage_graph",
+                wraps=orchestrator._run_stage_graph) as run_stage_graph:
+                backup = orchestrator.run(args, conf, "", resume=True)
+            self.assertEqual(run_stage_graph.call_args.args[0], [orchestrator.Stage.L2SM])
+            self.assertTrue(os.path.isfile(backup))
+            journal = orchestrator._read_journal(data_release)
+            self.assertEqual(journal["stages"]["L2SM"]["status"], "finished")
+            self.assertEqual(journal["backup"], backup)
+
+            # A stage of the L1B chain failed: the ones before it are not run
+            # again, since L1A_L1B did not change after it.
+            Stage = orchestrator.Stage
+            stages = [Stage.L1A, Stage.DATES, Stage.L1B, Stage.L1B_MM, Stage.L1B_CX,
+                Stage.L1B_CC, Stage.L1B_MM_AGAIN, Stage.L2FB, Stage.L2SM]
+            self.assertEqual(journal["stages"]["L1B_MM_AGAIN"]["dir_summaries"],
+                {"L1A_L1B": orchestrator._dir_summary(os.path.join(data_release, "L1A_L1B"))})
+            self.assertEqual(journal["stages"]["L2FB"]["dir_summaries"], {})
+            journal["stages"]["L1B_MM_AGAIN"]["status"] = "failed"
+            self.assertEqual(orchestrator._stages_to_resume(stages, journal, data_release),
+                [Stage.L1B_MM_AGAIN, Stage.L2FB, Stage.L2SM])
+
+            # The output of a stage of the L1B chain is gone, even if L1A_L1B
+            # is full of other files: the whole chain is run again.
+            for dirpath, _, filenames in os.walk(os.path.join(data_release, "L1A_L1B")):
+                for filename in filenames:
+                    if filename == "L1B_CX_EXE.nc":
+                        os.remove(os.path.join(dirpath, filename))
+            self.assertEqual(orchestrator._stages_to_resume(stages, journal,
+                data_release), stages[1:])
+            for entry in journal["stages"].values():
+                del entry["dir_summaries"]
+            self.assertEqual(orchestrator._stages_to_resume(stages, journal,
+                data_release), stages[1:])
+
+class TestStageCache(unittest.TestCase):
+
+    def test_hits_and_invalidation(self):
+        import benchmark_orchestrator
+        Proc = orchestrator.Proc
+        volume = dict(benchmark_orchestrator.VOLUME_DEFAULT, days=1, hours=2,
+            nc_size=4096, stdout_lines=0)
+        with tempfile.TemporaryDirectory() as root:
+            conf = benchmark_orchestrator.make_installation(root, volume)
+            args = dict(orchestrator.ARGS_DEFAULT, start=Proc.L1A, end=Proc.L2FB)
+            backup = orchestrator.run(args, conf, "input.xml")
+            settings = dict(orchestrator.SETTINGS_DEFAULT,
+                stage_cache_dir=os.path.join(root, "stage_cache"))
+            args = dict(args, start=Proc.L1B, backup=backup)
+
+            def run_processors() -> list[str]:
+                with unittest.mock.patch.object(orchestrator, "_run_processor",
+                    wraps=orchestrator._run_processor) as run_processor:
+                    orchestrator.run(args, conf, "", settings)
+                return [call.args[0] for call in run_processor.call_args_list]
+
+            stages = [stage for stage in orchestrator.STAGE_EXES
+                if Proc.L1B <= orchestrator.STAGE_PROC[stage] <= Proc.L2FB]
+            self.assertEqual(len(run_processors()), len(stages))
+            data_release = os.path.join(conf[orchestrator.Conf.DATA_DIR],
+                "HydroGNSS-1", "DataRelease")
+            l2fb_files = sorted(os.listdir(os.path.join(data_release, "L2OP-FB")))
+            # The restored files are not hashed again, the backup has their SHA-256.
+            with unittest.mock.patch.object(orchestrator, "_sha256_of_file",
+                wraps=orchestrator._sha256_of_file) as sha256_of_file:
+                self.assertEqual(run_processors(), [])
+            self.assertEqual([call.args[0] for call in sha256_of_file.call_args_list
+                if call.args[0].startswith(data_release)], [])
+            self.assertEqual(sorted(os.listdir(os.path.join(data_release, "L2OP-FB"))),
+                l2fb_files)
+            stats = orchestrator._read_stage_cache_json(settings["stage_cache_dir"],
+                orchestrator.STAGE_CACHE_STATS)
+            self.assertEqual(stats["L2FB"], {"hits": 1, "misses": 1})
+
+            self.assertEqual(orchestrator._invalidate_stage_cache(
+                settings["stage_cache_dir"], ["L2FB"]), 1)
+            self.assertEqual(run_processors(), [conf[orchestrator.Conf.L2FB_EXE]])
+
+class TestWorkers(unittest.TestCase):
+
+    def test_run_on_agent(self):
+        import benchmark_orchestrator
+        Proc = orchestrator.Proc
+        volume = dict(benchmark_orchestrator.VOLUME_DEFAULT, days=1, hours=2,
+            nc_size=4096, stdout_lines=3)
+        with tempfile.TemporaryDirectory() as root, \
+            tempfile.TemporaryDirectory() as remote_root:
+            conf = benchmark_orchestrator.make_installation(root, volume)
+            remote_conf = benchmark_orchestrator.make_installation(remote_root, volume)
+            # Left on the agent by another experiment.
+            stale = os.path.join(remote_conf[orchestrator.Conf.DATA_DIR],
+                "HydroGNSS-1", "DataRelease", "L2OP-FB", "stale.nc")
+            os.makedirs(os.path.dirname(stale))
+            with open(stale, "wb") as f:
+                f.write(b"stale")
+            agent = orchestrator.WorkerAgent(remote_conf, token="secret")
+            agent.start()
+            self.addCleanup(agent.server_close)
+            self.addCleanup(agent.shutdown)
+            settings = dict(orchestrator.SETTINGS_DEFAULT, workers=[agent.url],
+                worker_token="secret", worker_staging="copy", local_processor_slots=0)
+            args = dict(orchestrator.ARGS_DEFAULT, start=Proc.L1A, end=Proc.L2FB)
+            with unittest.mock.patch.object(orchestrator, "_run_processor",
+                wraps=orchestrator._run_processor) as run_processor, \
+                self.assertLogs(orchestrator.logger, "INFO") as logs:
+                backup = orchestrator.run(args, conf, "input.xml", settings)
+            # Only L1A runs here.
+            self.assertEqual([call.args[0] for call in run_processor.call_args_list],
+                [conf[orchestrator.Conf.L1A_EXE]])
+            self.assertTrue(any("L2OP_FB: " in line for line in logs.output))
+            with zipfile.ZipFile(backup) as z:
+                self.assertTrue(any(name.endswith(".nc") and "L2OP-FB" in name
+                    for name in z.namelist()))
+                self.assertFalse(any(name.endswith("stale.nc") for name in z.namelist()))
+            self.assertFalse(os.path.exists(stale))
+
+            with self.assertRaises(ConnectionError):
+                orchestrator._worker_request(agent.url, "GET", "/status", "wrong")
+            with self.assertRaises(ConnectionError):
+                orchestrator._worker_request(agent.url, "GET",
+                    "/file?path=../conf.json", "secret")
+            for path in ["conf.json", "HydroGNSS-1/run.bat", "C:conf.json",
+                "HydroGNSS-1/DataRelease/../../conf.json"]:
+                with self.assertRaises(ConnectionError):
+                    orchestrator._worker_request(agent.url, "PUT",
+                        f"/file?path={path}", "secret", b"x")
+            with self.assertRaises(ConnectionError):
+                orchestrator._worker_request(agent.url, "POST", "/run", "secret",
+                    {"exe": "L2FB_EXE", "arguments": ["a"]})
+
+    def test_slots(self):
+        settings = dict(orchestrator.SETTINGS_DEFAULT, worker_token="secret",
+            workers=["http://a:1", "http://b:1"], local_processor_slots=1)
+        loads = {"http://a:1": 1.0, "http://b:1": 0.5}
+        self.addCleanup(setattr, orchestrator, "_local_stages_running",
+            orchestrator._local_stages_running)
+        with unittest.mock.patch.object(orchestrator, "_worker_load",
+            side_effect=lambda url, token: loads[url]):
+            orchestrator._local_stages_running = 0
+            self.assertEqual(orchestrator._choose_worker(settings, set()), "")
+            self.assertEqual(orchestrator._local_stages_running, 1)
+            self.assertEqual(orchestrator._choose_worker(settings, set()), "http://b:1")
+            self.assertIsNone(orchestrator._choose_worker(settings, {"http://b:1"}))
+            loads = dict.fromkeys(loads, float("inf"))
+            # Nobody answers, so it runs here anyway.
+            self.assertEqual(orchestrator._choose_worker(settings, set()), "")
+
+    def test_token_is_required(self):
+        with self.assertRaises(ValueError):
+            orchestrator.WorkerAgent([])
+        self.assertFalse(orchestrator.validate_settings(dict(orchestrator.SETTINGS_DEFAULT,
+            workers=["http://localhost:8765"])))
+
+class TestService(unittest.TestCase):
+
+    def test_jobs(self):
+        import benchmark_orchestrator
+        volume = dict(benchmark_orchestrator.VOLUME_DEFAULT, days=1, hours=2,
+            nc_size=4096, stdout_lines=3)
+        with tempfile.TemporaryDirectory() as root:
+            conf = benchmark_orchestrator.make_installation(root, volume)
+            log_dir = os.path.join(root, "log")
+            os.mkdir(log_dir)
+            settings = dict(orchestrator.SETTINGS_DEFAULT, worker_token="secret")
+            # Like in main, the jobs do not change the level of the logger.
+            self.addCleanup(orchestrator.logger.setLevel, orchestrator.logger.level)
+            orchestrator.logger.setLevel("INFO")
+            service = orchestrator.OrchestratorService(conf, log_dir, settings)
+            service.start()
+            request = lambda method, path, body=None: orchestrator._service_request(
+                service.url, method, path, "secret", body)
+            try:
+                first, second = request("POST", "/jobs", [
+                    {"name": "first", "hsavers": "input.xml", "start": "L1A", "end": "L2FB"},
+                    {"name": "second", "hsavers": "input.xml", "start": "L1A", "end": "L1B"},
+                ])
+                # They use the same data directory so the second one waits.
+                request("POST", f"/jobs/{second}/cancel")
+                with self.assertRaises(ConnectionError):
+                    request("POST", "/jobs", {"start": "L2FB", "end": "L1A"})
+                with self.assertRaises(ConnectionError):
+                    request("POST", "/jobs", {"hsavers": "input.xml", "start": "L1A",
+                        "end": "L1B", "conf": {"L1B_EXE": "C:\\evil.exe"}})
+                deadline = time.monotonic() + 60
+                while request("GET", "/jobs?status=running") \
+                    or request("GET", "/jobs?status=queued"):
+                    self.assertLess(time.monotonic(), deadline)
+                    time.sleep(0.05)
+                job = request("GET", f"/jobs/{first}")
+                self.assertEqual(job["status"], "done", job["error"])
+                self.assertTrue(os.path.isfile(job["backup"]))
+                self.assertEqual(request("GET", f"/jobs/{second}")["status"], "cancelled")
+                log = orchestrator._worker_request(service.url, "GET",
+                    f"/jobs/{first}/log", "secret").read().decode()
+                self.assertIn("L2OP_FB: ", log)
+            finally:
+                service.shutdown()
+                service.server_close()
+
+            with self.assertRaises(ValueError):
+                orchestrator.OrchestratorService(conf, log_dir)
+            # The jobs are still there after a restart.
+            service = orchestrator.OrchestratorService(conf, log_dir, settings)
+            try:
+                self.assertEqual([job["status"] for job in service.jobs()],
+                    ["done", "cancelled"])
+            finally:
+                service.server_close()
+
+class TestLogging(unittest.TestCase):
+
+    def test_log_dir_is_required(self):
+        # On every OS, otherwise the log files and the database of the service
+        # could not be created later.
+        with tempfile.TemporaryDirectory() as root:
+            working_dir = os.path.join(root, "bin")
+            os.mkdir(working_dir)
+            cwd = os.getcwd()
+            os.chdir(working_dir)
+            self.addCleanup(os.chdir, cwd)
+            with unittest.mock.patch.object(sys, "argv", ["orchestrator.py"]), \
+                unittest.mock.patch.object(sys, "stderr") as stderr:
+                self.assertEqual(orchestrator._main(), 1)
+            self.assertIn(os.path.join("..", "log"),
+                "".join(call.args[0] for call in stderr.write.call_args_list))
+
+    def test_token_is_not_logged(self):
+        import benchmark_orchestrator
+        Proc = orchestrator.Proc
+        self.addCleanup(orchestrator.logger.setLevel, orchestrator.logger.level)
+        volume = dict(benchmark_orchestrator.VOLUME_DEFAULT, days=1, hours=1,
+            nc_size=1024, stdout_lines=0)
+        with tempfile.TemporaryDirectory() as root:
+            conf = benchmark_orchestrator.make_installation(root, volume)
+            args = dict(orchestrator.ARGS_DEFAULT, start=Proc.L1A, end=Proc.L1B)
+            settings = dict(orchestrator.SETTINGS_DEFAULT, worker_token="secret-token")
+            log_dir = os.path.join(root, "log")
+            os.mkdir(log_dir)
+            with orchestrator.LogToFileContext("L1A", "L1B", log_dir,
+                settings=settings) as log_context:
+                orchestrator.run(args, conf, "input.xml", settings)
+            with open(log_context.logfile_path) as f:
+                log = f.read()
+            self.assertIn("'worker_token': '***'", log)
+            self.assertNotIn("secret-token", log)
+
+        with tempfile.TemporaryDirectory() as log_dir:
+            old_log = os.path.join(log_dir, "L1AL2FB_20200101_000000.log")
+            with open(old_log, "w") as f:
+                f.write("old\n")
+            os.utime(old_log, (0, 0))
+            settings = dict(orchestrator.SETTINGS_DEFAULT, log_rotate_mb=1)
+            line = "x"*1000
+            with orchestrator.LogToFileContext("L1A", "L2FB", log_dir,
+                settings=settings) as log_context:
+                orchestrator.logger.setLevel("INFO")
+                for i in range(1500):
+                    orchestrator.logger.info(f"{i} {line}")
+            orchestrator._log_compressor.submit(lambda: None).result()
+
+            self.assertEqual(sorted(os.listdir(log_dir)), sorted([
+                "L1AL2FB_20200101_000000.log.gz",
+                os.path.basename(log_context.logfile_path),
+                os.path.basename(log_context.telemetry_path),
+                os.path.basename(log_context.trace_path),
+                os.path.basename(log_context.logfile_path)[:-4] + ".1.log.gz",
+            ]))
+            with gzip.open(f"{old_log}.gz", "rt") as f:
+                self.assertEqual(f.read(), "old\n")
+            with gzip.open(log_context.logfile_path[:-4] + ".1.log.gz", "rt") as f:
+                lines = f.readlines()
+            with open(log_context.logfile_path) as f:
+                lines += f.readlines()
+            self.assertEqual([int(line.split(": ")[2].split()[0]) for line in lines],
+                list(range(1500)))
+
+    def test_level_of_each_job(self):
+        self.addCleanup(orchestrator.logger.setLevel, orchestrator.logger.level)
+        orchestrator.logger.setLevel("INFO")
+        with tempfile.TemporaryDirectory() as log_dir:
+            contexts = {name: orchestrator.LogToFileContext("L1A", "L1B", log_dir,
+                name, level) for name, level in (("debug", orchestrator.LogLevel.DEBUG),
+                ("info", orchestrator.LogLevel.INFO))}
+            def job(name):
+                orchestrator._batch_job_name.set(name)
+                with contexts[name]:
+                    barrier.wait()
+                    orchestrator.logger.debug(f"debug of {name}")
+                    orchestrator.logger.info(f"info of {name}")
+                    barrier.wait()
+            barrier = threading.Barrier(2, timeout=5)
+            threads = [threading.Thread(target=contextvars.copy_context().run,
+                args=(job, name)) for name in contexts]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            logs = {}
+            for name, context in contexts.items():
+                with open(context.logfile_path) as f:
+                    logs[name] = [line.split(": ")[-1].strip() for line in f]
+        self.assertEqual(logs, {"debug": ["debug of debug", "info of debug"],
+            "info": ["info of info"]})
+        self.assertEqual(orchestrator.logger.level, logging.INFO)
+
+class TestCleanup(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.settings = dict(orchestrator.SETTINGS_DEFAULT, cleanup_mode="delete")
+
+    def tearDown(self):
+        orchestrator._trash.wait()
+        self.tmp_dir.cleanup()
+
+    def make_tree(self, name: str) -> str:
+        path = os.path.join(self.tmp_dir.name, name)
+        os.makedirs(os.path.join(path, "sub"))
+        with open(os.path.join(path, "sub", "file.nc"), "wb") as f:
+            f.write(bytes(1000))
+        return path
+
+    def test_background(self):
+        trash_dir = os.path.join(self.tmp_dir.name, orchestrator.TRASH_DIR)
+        os.makedirs(os.path.join(trash_dir, "leftover_1"))
+        path = self.make_tree("HydroGNSS-1")
+        orchestrator._clean_up(path, self.settings)
+        self.assertFalse(os.path.exists(path))
+        # The same name can be used right away.
+        os.mkdir(path)
+        orchestrator._trash.wait()
+        self.assertEqual(os.listdir(trash_dir), [])
+        self.assertEqual(orchestrator._trash.pending_bytes, 0)
+
+    def test_synchronous(self):
+        path = self.make_tree("PAM_Output")
+        orchestrator._clean_up(path, dict(self.settings, background_cleanup=False))
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir.name,
+            orchestrator.TRASH_DIR)))
+
+    def test_retries_and_bound(self):
+        remove = orchestrator._remove
+        failures = []
+        def flaky_remove(path, mode):
+            if not failures:
+                failures.append(path)
+                raise PermissionError(path)
+            remove(path, mode)
+        with unittest.mock.patch.object(orchestrator, "_remove", flaky_remove), \
+            unittest.mock.patch.object(orchestrator, "_TRASH_RETRY_SECONDS", 0.01):
+            for i in range(3):
+                # With no room in the trash each one waits for the previous.
+                orchestrator._trash.put(self.make_tree(f"dir{i}"), "delete", 0)
+            orchestrator._trash.wait()
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(os.listdir(os.path.join(self.tmp_dir.name,
+            orchestrator.TRASH_DIR)), [])
+
+class TestRunController(unittest.TestCase):
+
+    def setUp(self):
+        import benchmark_orchestrator
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        volume = dict(benchmark_orchestrator.VOLUME_DEFAULT, days=1, hours=2,
+            nc_size=4096, stdout_lines=5)
+        self.conf = benchmark_orchestrator.make_installation(self.tmp_dir.name, volume)
+        self.log_dir = os.path.join(self.tmp_dir.name, "log")
+        os.mkdir(self.log_dir)
+        self.args = dict(orchestrator.ARGS_DEFAULT, start=orchestrator.Proc.L1A,
+            end=orchestrator.Proc.L2FB)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def wait_for(self, controller, kind, text=""):
+        events = []
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            events += controller.poll()
+            if any(event.kind == kind and text in event.text for event in events):
+                return events
+            time.sleep(0.05)
+        self.fail(f"no {kind} event")
+
+    def test_events(self):
+        controller = orchestrator.RunController(self.args, self.conf, "input.xml",
+            self.log_dir)
+        controller.start()
+        events = self.wait_for(controller, "finished")
+        controller.join()
+        self.assertTrue(os.path.isfile(events[-1].text))
+        self.assertEqual(events[-1].text, controller.backup_path)
+        finished = [event.text for event in events if event.kind == "stage_finished"]
+        self.assertEqual(finished, [stage.name for stage in orchestrator._stages_to_run(
+            orchestrator.Proc.L1A, [orchestrator.Proc.L2FB])])
+        self.assertTrue(any(event.kind == "log" and "L1B_CX_DR: " in event.text
+            for event in events))
+
+    def test_cancel(self):
+        with open(self.conf[orchestrator.Conf.L2FB_EXE], "w") as f:
+            f.write("import time; print('sleeping', flush=True); time.sleep(60)")
+        controller = orchestrator.RunController(self.args, self.conf, "input.xml",
+            self.log_dir)
+        started = time.monotonic()
+        controller.start()
+        self.wait_for(controller, "log", "L2OP_FB: sleeping")
+        controller.cancel()
+        controller.join(30)
+        self.assertFalse(controller.running())
+        self.assertLess(time.monotonic() - started, 30)
+        events = controller.poll()
+        self.assertEqual(events[-1].kind, "cancelled")
+        self.assertIn("stage_failed", [event.kind for event in events])
+
 if __name__ == '__main__':
     unittest.main()
 